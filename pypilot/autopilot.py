@@ -109,6 +109,12 @@ class Autopilot(object):
         self.heading_error_int = self.register(SensorValue, 'heading_error_int')
         self.heading_error_int_time = time.monotonic()
 
+        # age of the imu sample when the pilot computes the command
+        self.imu_latency = self.register(SensorValue, 'imu_latency')
+        self.latency_compensation = self.register(BooleanProperty, 'latency_compensation', False, persistent=True)
+        self.imu_timestamp = 0
+        self.predicted_heading = self.predicted_headingrate = 0
+
         self.tack = tacking.Tack(self)
 
         self.gps_compass_offset = HeadingOffset()
@@ -258,6 +264,27 @@ class Autopilot(object):
                 heading_command = self.heading_command.value + self.compass_change
                 self.heading_command.set(resolv(heading_command, 180))
           
+    def predict_heading(self, data, period):
+        if data:
+            self.imu_timestamp = data['timestamp']
+        # imu timestamps are from the same monotonic clock in the imu process
+        age = time.monotonic() - self.imu_timestamp
+        self.imu_latency.set(age if self.imu_timestamp else False)
+
+        heading = self.boatimu.SensorValues['heading_lowpass'].value
+        headingrate = self.boatimu.SensorValues['headingrate_lowpass'].value
+        headingraterate = self.boatimu.SensorValues['headingraterate_lowpass'].value
+
+        # extrapolate the heading forward to the current time,
+        # but not if the imu data is older than a period (stale)
+        if self.latency_compensation.value and heading is not False and \
+           age > 0 and age < period:
+            heading = resolv(heading + headingrate*age + .5*headingraterate*age**2, 180)
+            headingrate += headingraterate*age
+
+        self.predicted_heading = heading
+        self.predicted_headingrate = headingrate
+
     def compute_heading_error(self, t):
         heading = self.heading.value
         windmode = 'wind' in self.mode.value
@@ -331,6 +358,7 @@ class Autopilot(object):
         pilot = self.pilots[self.pilot.value] # select pilot
 
         self.adjust_mode(pilot)
+        self.predict_heading(data, period)
         pilot.compute_heading()
         self.compute_heading_error(t0)
 
@@ -13,11 +13,11 @@
 # giving it the ability to auto-calibrate the inertial sensors
 
 import os, sys
-import time, math, multiprocessing, select
+import time, math, multiprocessing, select, array, struct
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 t0=time.monotonic()
-import vector, quaternion
+import vector, quaternion, pyjson
 from client import pypilotClient
 from values import *
 
@@ -29,9 +29,123 @@ except ImportError:
     RTIMU = False
     print('RTIMU library not detected, please install it')
 
+# sigma point parameters, shared with the calibration process
+calibration_sigma = {'accel': .05, 'compass': 1.1}
+calibration_min_count = {'accel': 10, 'compass': 3}
+precluster_max_count = 20 # send a stationary cluster at least this often
+
+# in oversample mode the fifo is drained this many times per control period
+oversample_bursts = 4
+oversample_max_burst = 16 # at most this many samples read per burst
+
+# average the high rate samples read in bursts into one output sample
+# the boxcar average acts as the anti-alias filter for the decimation,
+# while the fusion pose is taken from the newest sample since RTIMU
+# already fused every sample at its own timestamp
+class IMUDecimator(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sums = {'gyro': [0, 0, 0], 'accel': [0, 0, 0], 'compass': [0, 0, 0]}
+        self.last = False
+        self.timestamp = 0
+
+    def add(self, data, timestamp):
+        for name, total in self.sums.items():
+            v = data[name]
+            for i in range(3):
+                total[i] += v[i]
+        self.count += 1
+        self.last = data
+        self.timestamp = timestamp
+
+    def output(self):
+        data = dict(self.last)
+        for name, total in self.sums.items():
+            data[name] = [total[0]/self.count, total[1]/self.count, total[2]/self.count]
+        data['fusionQPose'] = list(self.last['fusionQPose'])
+        data['timestamp'] = self.timestamp # time of newest sample
+        data['samples'] = self.count
+        return data
+
+# keep the most recent raw imu samples in a preallocated ring buffer
+# which is written to a file when the imu fails, or on request
+# the file has a header (magic, sample count, fields per sample)
+# followed by samples of: timestamp, gyro, accel, compass, fusionQPose
+flight_recorder_magic = b'PYIMUFR1'
+flight_recorder_fields = 14
+flight_recorder_path = os.path.expanduser('~') + '/.pypilot/imu_flight_recorder_'
+
+class IMUFlightRecorder(object):
+    def __init__(self, size=1024):
+        self.size = size
+        self.data = array.array('d', bytes(8*size*flight_recorder_fields))
+        self.index = 0
+        self.count = 0
+        self.updated = False
+
+    def add(self, data, timestamp):
+        d, i = self.data, self.index*flight_recorder_fields
+        d[i] = timestamp
+        gyro, accel, compass, q = data['gyro'], data['accel'], data['compass'], data['fusionQPose']
+        d[i+1], d[i+2], d[i+3] = gyro[0], gyro[1], gyro[2]
+        d[i+4], d[i+5], d[i+6] = accel[0], accel[1], accel[2]
+        d[i+7], d[i+8], d[i+9] = compass[0], compass[1], compass[2]
+        d[i+10], d[i+11], d[i+12], d[i+13] = q[0], q[1], q[2], q[3]
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+        if self.count < self.size:
+            self.count += 1
+        self.updated = True
+
+    # write samples oldest first, one file for each reason
+    def dump(self, reason):
+        if not self.updated: # avoid writing the same samples repeatedly
+            return
+        self.updated = False
+        filename = flight_recorder_path + reason + '.bin'
+        try:
+            f = open(filename, 'wb')
+            f.write(struct.pack('<8sII', flight_recorder_magic, self.count, flight_recorder_fields))
+            start = (self.index - self.count) % self.size
+            end = start + self.count
+            n = flight_recorder_fields
+            if end > self.size:
+                self.data[start*n:].tofile(f)
+                self.data[:(end-self.size)*n].tofile(f)
+            else:
+                self.data[start*n:end*n].tofile(f)
+            f.close()
+            print('imu flight recorder wrote', self.count, 'samples to', filename)
+        except Exception as e:
+            print('imu flight recorder failed to write', filename, e)
+
+# read a flight recorder file as a list of imu data dictionaries
+def load_flight_recorder(filename):
+    f = open(filename, 'rb')
+    magic, count, fields = struct.unpack('<8sII', f.read(16))
+    if magic != flight_recorder_magic or fields != flight_recorder_fields:
+        raise Exception('invalid imu flight recorder file ' + filename)
+    data = array.array('d')
+    data.fromfile(f, count*fields)
+    f.close()
+    samples = []
+    for i in range(0, count*fields, fields):
+        samples.append({'timestamp': data[i], 'gyro': list(data[i+1:i+4]),
+                        'accel': list(data[i+4:i+7]), 'compass': list(data[i+7:i+10]),
+                        'fusionQPose': list(data[i+10:i+14])})
+    return samples
+
+# an imu driver provides Settings and RTIMU constructors compatible with the
+# RTIMU module, this allows replacing the hardware with recorded data (imureplay)
 class IMU(object):
-    def __init__(self, server):
+    def __init__(self, server, driver=False, record=False):
         self.client = pypilotClient(server)
+        self.driver = driver if driver else RTIMU
+        self.record = record
         self.multiprocessing = server.multiprocessing
         if self.multiprocessing:
             self.pipe, pipe = NonBlockingPipe('imu_pipe', self.multiprocessing)
@@ -45,13 +159,17 @@ class IMU(object):
         self.client.watch('imu.accel.calibration')
         self.client.watch('imu.compass.calibration')
         self.client.watch('imu.rate')
+        self.client.watch('imu.oversample')
 
         self.gyrobias = self.client.register(SensorValue('imu.gyrobias', persistent=True))
         self.lastgyrobiastime = time.monotonic()
 
+        self.flight_recorder = IMUFlightRecorder()
+        self.flight_recorder_dump = self.client.register(BooleanProperty('imu.flight_recorder.dump', False))
+
         SETTINGS_FILE = "RTIMULib"
         print("Using settings file " + SETTINGS_FILE + ".ini")
-        s = RTIMU.Settings(SETTINGS_FILE)
+        s = self.driver.Settings(SETTINGS_FILE)
         s.FusionType = 1
         s.CompassCalValid = False
 
@@ -75,12 +193,18 @@ class IMU(object):
         self.s = s
         while not self.init():
             time.sleep(1)
+        if self.record:
+            print('recording imu data to', self.record)
+            self.record = open(self.record, 'w')
+
         self.lastdata = False
         self.rate = 10
+        self.oversample = False
+        self.decimator = IMUDecimator()
 
     def init(self):
         self.s.IMUType = 0 # always autodetect imu
-        rtimu = RTIMU.RTIMU(self.s)
+        rtimu = self.driver.RTIMU(self.s)
         if rtimu.IMUName() == 'Null IMU':
             print('no IMU detected... try again')
             return False
@@ -105,7 +229,7 @@ class IMU(object):
 
     def process(self, pipe):
         print('imu process', os.getpid())
-        if not RTIMU:
+        if not self.driver:
             while True:
                 time.sleep(10) # do nothing
 
@@ -117,7 +241,10 @@ class IMU(object):
         self.setup()
         while True:
             t0 = time.monotonic()
-            data = self.read()
+            if self.oversample:
+                data = self.read_oversampled(t0)
+            else:
+                data = self.read()
             pipe.send(data, not data)
 
             if not self.s.GyroBiasValid:
@@ -142,13 +269,17 @@ class IMU(object):
         t0 = time.monotonic()
         if not self.rtimu.IMURead():
             print('failed to read IMU!')
+            self.flight_recorder.dump('read')
             self.init() # reinitialize imu
             return False 
          
         data = self.rtimu.getIMUData()
+        self.flight_recorder.add(data, t0)
         data['accel.residuals'] = list(self.rtimu.getAccelResiduals())
 
         data['timestamp'] = t0 # imu timestamp is perfectly accurate
+        if self.record:
+            self.record.write(pyjson.dumps(data) + '\n')
         
         if self.compass_calibration_updated:
             data['compass_calibration_updated'] = True
@@ -157,6 +288,44 @@ class IMU(object):
         self.lastdata = list(data['gyro']), list(data['compass'])
         return data
 
+    # read the imu in several bursts per control period, draining all samples
+    # queued in the imu fifo each time, and decimate them to a single output
+    def read_oversampled(self, t0):
+        period = 1/self.rate
+        burst_period = period/oversample_bursts
+        self.decimator.reset()
+        for burst in range(oversample_bursts):
+            for i in range(oversample_max_burst):
+                if not self.rtimu.IMURead():
+                    break
+                # each sample is fused by RTIMU with its own timestamp
+                data = self.rtimu.getIMUData()
+                t = time.monotonic()
+                self.flight_recorder.add(data, t)
+                self.decimator.add(data, t)
+            if burst < oversample_bursts - 1:
+                t = t0 + (burst+1)*burst_period - time.monotonic()
+                if t > 0:
+                    time.sleep(t)
+
+        if not self.decimator.count:
+            print('failed to read IMU!')
+            self.flight_recorder.dump('read')
+            self.init() # reinitialize imu
+            return False
+
+        data = self.decimator.output()
+        data['accel.residuals'] = list(self.rtimu.getAccelResiduals())
+        if self.record:
+            self.record.write(pyjson.dumps(data) + '\n')
+
+        if self.compass_calibration_updated:
+            data['compass_calibration_updated'] = True
+            self.compass_calibration_updated = False
+
+        self.lastdata = list(data['gyro']), list(data['compass'])
+        return data
+
     def poll(self):
         msgs = self.client.receive()
         for name in msgs:
@@ -174,6 +343,13 @@ class IMU(object):
             elif name == 'imu.rate':
                 self.rate = value
                 print('imu rate set to rate', value)
+            elif name == 'imu.oversample':
+                self.oversample = value
+                print('imu oversample', 'on' if value else 'off')
+
+        if self.flight_recorder_dump.value:
+            self.flight_recorder.dump('request')
+            self.flight_recorder_dump.set(False)
 
         if not self.lastdata:
             return
@@ -187,11 +363,13 @@ class IMU(object):
             self.avggyro[i] = (1-d)*self.avggyro[i] + d*gyro[i]
         if vector.norm(self.avggyro) > .8: # 55 degrees/s
             print('too high standing gyro bias, resetting sensors', gyro, self.avggyro)
+            self.flight_recorder.dump('gyro')
             self.init()
 
         # detects the problem even faster:
         if any(map(lambda x : abs(x) > 1000, compass)):
             print('compass out of range, resetting', compass)
+            self.flight_recorder.dump('compass')
             self.init()
 
 class FrequencyValue(SensorValue):
@@ -281,6 +459,55 @@ def heading_filter(lp, a, b):
         result += 360
     return result
 
+# the math for each sample after fusion, returns the values in the order:
+# pitchrate, rollrate, headingrate, roll, pitch, heading, headingraterate, heel,
+# gyro (3 values in degrees), heading_lowpass, headingrate_lowpass,
+# headingraterate_lowpass and the aligned quaternion (4 values)
+def boatimu_python(fusionQPose, gyro, alignmentQ, timestamp, lasttimestamp,
+                   last_headingrate, heel, heading_lowpass, headingrate_lowpass,
+                   headingraterate_lowpass, heading_lowpass_constant,
+                   headingrate_lowpass_constant, headingraterate_lowpass_constant):
+    # apply alignment calibration
+    gyro_q = quaternion.rotvecquat(gyro, fusionQPose)
+    pitchrate, rollrate, headingrate = map(math.degrees, gyro_q)
+
+    aligned = quaternion.multiply(fusionQPose, alignmentQ)
+    aligned = quaternion.normalize(aligned) # floating point precision errors
+
+    roll, pitch, heading = map(math.degrees, quaternion.toeuler(aligned))
+    if heading < 0:
+        heading += 360
+
+    dt = timestamp - lasttimestamp
+    if dt > .01 and dt < .2:
+        headingraterate = (headingrate - last_headingrate) / dt
+    else:
+        headingraterate = 0
+
+    heel = roll*.03 + heel*.97
+
+    gyro = list(map(math.degrees, gyro))
+
+    # lowpass heading and rate
+    llp = heading_lowpass_constant
+    heading_lowpass = heading_filter(llp, heading, heading_lowpass)
+
+    llp = headingrate_lowpass_constant
+    headingrate_lowpass = llp*headingrate + (1-llp)*headingrate_lowpass
+
+    llp = headingraterate_lowpass_constant
+    headingraterate_lowpass = llp*headingraterate + (1-llp)*headingraterate_lowpass
+
+    return [pitchrate, rollrate, headingrate, roll, pitch, heading, headingraterate, heel] + \
+        gyro + [heading_lowpass, headingrate_lowpass, headingraterate_lowpass] + aligned
+
+try:
+    from pypilot.imu_math import imu_math
+    boatimu_compute = imu_math.boatimu_compute
+except Exception as e:
+    print('falling back to python imu math, will consume more cpu', e)
+    boatimu_compute = boatimu_python
+
 def CalibrationProcess(cal_pipe, client):
     if os.system('sudo chrt -po 0 %d 2> /dev/null > /dev/null' % os.getpid()):
         print('warning, failed to make calibration process other')
@@ -301,6 +528,43 @@ def CalibrationProcess(cal_pipe, client):
             print('failed import calibration fit', e)
             time.sleep(30) # maybe numpy or scipy isn't ready yet
 
+# average consecutive samples within sigma of each other, the same way
+# SigmaPoints forms candidate points, so only the averaged clusters
+# are sent to the calibration process instead of every sample
+class CalibrationPreclusterer(object):
+    def __init__(self, sigma, min_count):
+        self.sigma2 = sigma**2
+        self.min_count = min_count
+        self.locked = False
+        self.count = 0
+
+    # returns the averaged cluster when one is complete
+    def add(self, sensor, down=False):
+        if self.locked:
+            self.count = 0
+            return False
+
+        sample = list(sensor) + (list(down) if down else [])
+        cluster = False
+        if self.count:
+            mean = list(map(lambda s : s / self.count, self.sum))
+            if vector.dist2(mean[:3], sample[:3]) < self.sigma2:
+                self.sum = list(map(lambda s, x : s + x, self.sum, sample))
+                self.count += 1
+                if self.count < precluster_max_count:
+                    return False
+                sample, mean = False, list(map(lambda s : s / self.count, self.sum))
+            if self.count >= self.min_count:
+                cluster = {'count': self.count, 'sensor': mean[:3]}
+                if down:
+                    cluster['down'] = mean[3:]
+
+        if sample:
+            self.sum, self.count = sample, 1
+        else:
+            self.count = 0
+        return cluster
+
 class AutomaticCalibrationProcess():
     def __init__(self, server):
         if True:
@@ -313,16 +577,44 @@ class AutomaticCalibrationProcess():
         self.process = multiprocessing.Process(target=CalibrationProcess, args=(self.cal_pipe_process, self.client), daemon=True)
         self.process.start()
 
+        self.preclusterers = {}
+        for name in ['accel', 'compass']:
+            self.preclusterers[name] = CalibrationPreclusterer(calibration_sigma[name], calibration_min_count[name])
+
+    # send candidate sigma points to the calibration process
+    def send(self, data):
+        # the calibration process sends the lock flags when they change
+        msg = self.cal_pipe.recv()
+        while msg:
+            if 'locked' in msg:
+                for name, locked in msg['locked'].items():
+                    self.preclusterers[name].locked = locked
+            msg = self.cal_pipe.recv()
+
+        cluster = self.preclusterers['accel'].add(data['accel'])
+        if cluster:
+            self.cal_pipe.send({'accel': cluster['sensor'], 'count': cluster['count']})
+
+        compass = self.preclusterers['compass']
+        if compass.locked:
+            return
+        down = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(data['fusionQPose']))
+        cluster = compass.add(data['compass'], down)
+        if cluster:
+            self.cal_pipe.send({'compass': cluster['sensor'], 'down': cluster['down'], 'count': cluster['count']})
+
     def __del__(self):
         print('terminate calibration process')
         self.process.terminate()
 
 
 class BoatIMU(object):
-    def __init__(self, client):
+    def __init__(self, client, driver=False, record=False):
         self.client = client
 
         self.rate = self.register(EnumProperty, 'rate', 10, [10, 20], persistent=True)
+        # sample the imu at the full sensor rate and decimate to the control rate
+        self.oversample = self.register(BooleanProperty, 'oversample', False, persistent=True)
 
         self.frequency = self.register(FrequencyValue, 'frequency')
         self.alignmentQ = self.register(QuaternionValue, 'alignmentQ', [1, 0, 0, 0], persistent=True)
@@ -358,7 +650,7 @@ class BoatIMU(object):
         #sensornames += ['fusionQPose']
         self.SensorValues['fusionQPose'] = self.register(SensorValue, 'fusionQPose', fmt='%.8f')
     
-        self.imu = IMU(client.server)
+        self.imu = IMU(client.server, driver, record)
 
         self.last_imuread = time.monotonic() + 4 # ignore failed readings at startup
 
@@ -397,6 +689,7 @@ class BoatIMU(object):
         if not data:
             if time.monotonic() - self.last_imuread > 1 and self.frequency.value:
                 print('IMURead failed!')
+                self.client.set('imu.flight_recorder.dump', True)
                 self.frequency.set(False)
                 for name in self.SensorValues:
                     self.SensorValues[name].set(False)
@@ -410,42 +703,25 @@ class BoatIMU(object):
         self.last_imuread = time.monotonic()
         self.frequency.strobe()
   
-        # apply alignment calibration
-        gyro_q = quaternion.rotvecquat(data['gyro'], data['fusionQPose'])
-    
-        data['pitchrate'], data['rollrate'], data['headingrate'] = map(math.degrees, gyro_q)
-        
-        aligned = quaternion.multiply(data['fusionQPose'], self.alignmentQ.value)
-        aligned = quaternion.normalize(aligned) # floating point precision errors
-    
-        data['roll'], data['pitch'], data['heading'] = map(math.degrees, quaternion.toeuler(aligned))
-  
-        if data['heading'] < 0:
-            data['heading'] += 360
-  
-        dt = data['timestamp'] - self.lasttimestamp
+        r = boatimu_compute(data['fusionQPose'], data['gyro'], self.alignmentQ.value,
+                            data['timestamp'], self.lasttimestamp, self.headingrate, self.heel,
+                            self.SensorValues['heading_lowpass'].value,
+                            self.SensorValues['headingrate_lowpass'].value,
+                            self.SensorValues['headingraterate_lowpass'].value,
+                            self.heading_lowpass_constant.value,
+                            self.headingrate_lowpass_constant.value,
+                            self.headingraterate_lowpass_constant.value)
+
+        data['pitchrate'], data['rollrate'], data['headingrate'] = r[0], r[1], r[2]
+        data['roll'], data['pitch'], data['heading'] = r[3], r[4], r[5]
+        data['headingraterate'], data['heel'] = r[6], r[7]
+        data['gyro'] = [r[8], r[9], r[10]]
+        data['heading_lowpass'], data['headingrate_lowpass'], data['headingraterate_lowpass'] = r[11], r[12], r[13]
+        aligned = [r[14], r[15], r[16], r[17]]
+
         self.lasttimestamp = data['timestamp']
-        if dt > .01 and dt < .2:
-            data['headingraterate'] = (data['headingrate'] - self.headingrate) / dt
-        else:
-            data['headingraterate'] = 0
-  
         self.headingrate = data['headingrate']
-  
-        data['heel'] = self.heel = data['roll']*.03 + self.heel*.97
-        #data['roll'] -= data['heel']
-  
-        data['gyro'] = list(map(math.degrees, data['gyro']))
-  
-        # lowpass heading and rate
-        llp = self.heading_lowpass_constant.value
-        data['heading_lowpass'] = heading_filter(llp, data['heading'], self.SensorValues['heading_lowpass'].value)
-
-        llp = self.headingrate_lowpass_constant.value
-        data['headingrate_lowpass'] = llp*data['headingrate'] + (1-llp)*self.SensorValues['headingrate_lowpass'].value
-  
-        llp = self.headingraterate_lowpass_constant.value
-        data['headingraterate_lowpass'] = llp*data['headingraterate'] + (1-llp)*self.SensorValues['headingraterate_lowpass'].value
+        self.heel = data['heel']
 
         # set sensors
         for name in self.SensorValues:
@@ -483,18 +759,7 @@ class BoatIMU(object):
 
 
         if self.auto_cal.cal_pipe:
-            #print('warning, cal pipe always sending despite locks')
-            cal_data = {}
-            #how to check this here??  if not 'imu.accel.calibration.locked'
-            cal_data['accel'] = list(data['accel'])
-            
-            #how to check this here??  if not 'imu.compass.calibration.locked'
-            cal_data['compass'] = list(data['compass'])
-            cal_data['fusionQPose'] = list(data['fusionQPose'])
-
-            if cal_data:
-                #print('send', cal_data)
-                self.auto_cal.cal_pipe.send(cal_data)
+            self.auto_cal.send(data)
 
         return data
 
@@ -510,7 +775,16 @@ def main():
     from server import pypilotServer
     server = pypilotServer()
     client = pypilotClient(server)
-    boatimu = BoatIMU(client)
+
+    # replay recorded imu data instead of reading the sensors
+    driver, record = False, False
+    if '--replay' in sys.argv:
+        import imureplay
+        filename = sys.argv[sys.argv.index('--replay')+1]
+        driver = imureplay.ReplayDriver(filename, realtime = not '--fast' in sys.argv)
+    if '--record' in sys.argv:
+        record = sys.argv[sys.argv.index('--record')+1]
+    boatimu = BoatIMU(client, driver, record)
 
     quiet = '-q' in sys.argv
 
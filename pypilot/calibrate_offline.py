@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# evaluate calibration parameters offline using recorded imu data
+# from pypilot_boatimu --record or the imu flight recorder
+#
+# each variant of sigma, max sigma points and fit dimensionality
+# streams the recording through SigmaPoints and the fit functions
+# the same way the calibration process does, in a pool of processes
+
+import os, sys, time, multiprocessing
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import quaternion
+import calibration_fit
+from imureplay import load_recording
+
+# default variants evaluated
+compass_sigmas = [.8, 1.1, 1.5]
+compass_max_points = [24, 48, 96]
+compass_dimensions = ['auto', 2, 3]
+accel_sigmas = [.03, .05]
+accel_max_points = [12, 24]
+
+def lmap(*cargs):
+    return list(map(*cargs))
+
+samples = []
+def init_worker(filenames):
+    global samples
+    for filename in filenames:
+        samples += load_recording(filename)
+
+def debug(*args):
+    pass
+
+# compass fit forcing a particular dimension, or the same logic as
+# the calibration process if dimensions is 'auto'
+# returns the fit, 'unchanged' or False
+def fit_compass(compass_points, current, norm, dimensions, stats):
+    if dimensions == 'auto':
+        # FitCompass returns nothing when the new fit matches the current
+        # calibration, which is not a failure
+        stats['unchanged'] = False
+        fit = calibration_fit.FitCompass(debug, compass_points, current, norm, stats)
+        if not fit and stats['unchanged']:
+            return 'unchanged'
+        return fit
+
+    p = compass_points.Points(True)
+    if len(p) < 8:
+        return False
+    fit = calibration_fit.FitPointsCompass(debug, p, current, norm, stats)
+    if not fit or not fit[dimensions-1]:
+        return False
+    fit = fit[dimensions-1]
+    # same test as FitCompass so the variants are comparable
+    if calibration_fit.SameCalibration(fit[0], current):
+        return 'unchanged'
+    return fit
+
+def evaluate_variant(variant):
+    sensor, sigma, max_points, dimensions, period = variant
+    if sensor == 'compass':
+        points = calibration_fit.SigmaPoints(sigma**2, max_points, 3)
+        current = [0, 0, 0, 30, 0]
+    else:
+        points = calibration_fit.SigmaPoints(sigma**2, max_points, 10)
+        current = [0, 0, 0, 1]
+    norm = [0, 0, 1]
+
+    stats = {'iterations': 0}
+    fits = successful = unchanged = 0
+    fit_time = 0
+    lastfit = False
+    for data in samples:
+        if sensor == 'compass':
+            down = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(data['fusionQPose']))
+            points.AddPoint(list(data['compass']), down)
+        else:
+            points.AddPoint(list(data['accel']))
+
+        # refit when the points changed using the recorded time
+        t = data['timestamp']
+        if points.changes < 1 or (lastfit is not False and t - lastfit < period):
+            continue
+        points.changes = 0
+        lastfit = t
+
+        t0 = time.monotonic()
+        if sensor == 'compass':
+            fit = fit_compass(points, current, norm, dimensions, stats)
+        else:
+            fit = calibration_fit.FitAccel(debug, points, current, stats)
+        fit_time += time.monotonic() - t0
+        fits += 1
+        if fit == 'unchanged':
+            unchanged += 1
+        elif fit:
+            successful += 1
+            current = lmap(float, fit[0])
+
+    result = {'fits': fits, 'successful': successful, 'unchanged': unchanged, 'fit_time': fit_time,
+              'iterations': stats['iterations'], 'points': len(points.Points()),
+              'calibration': current}
+    p = points.Points(sensor == 'compass')
+    if p and (successful or unchanged):
+        result['deviation'] = calibration_fit.ComputeDeviation(p, current)
+        if sensor == 'compass':
+            result['coverage'] = calibration_fit.ComputeCoverage(p, current[:3], norm)
+    return variant, result
+
+def variants(period):
+    v = []
+    for sigma in compass_sigmas:
+        for max_points in compass_max_points:
+            for dimensions in compass_dimensions:
+                v.append(('compass', sigma, max_points, dimensions, period))
+    for sigma in accel_sigmas:
+        for max_points in accel_max_points:
+            v.append(('accel', sigma, max_points, 3, period))
+    return v
+
+def format_result(variant, result):
+    sensor, sigma, max_points, dimensions, period = variant
+    s = '%-8s %5.2f %4d %5s ' % (sensor, sigma, max_points, dimensions)
+    s += '%4d %4d/%-4d %6.3f %6d ' % (result['successful'], result['unchanged'], result['fits'],
+                                      result['fit_time'], result['iterations'])
+    if 'deviation' in result:
+        s += '%7.4f %7.3f ' % tuple(result['deviation'])
+    else:
+        s += '%7s %7s ' % ('-', '-')
+    if 'coverage' in result:
+        s += '%3d ' % result['coverage']
+    else:
+        s += '%3s ' % '-'
+    s += ' '.join(map(lambda x : '%.3f' % x, result['calibration']))
+    return s
+
+def main():
+    import getopt
+    def usage():
+        print('usage: pypilot_calibrate_offline [-j jobs] [-p fit period] recording...')
+        exit(1)
+
+    try:
+        opts, filenames = getopt.getopt(sys.argv[1:], 'j:p:h')
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+
+    jobs, period = multiprocessing.cpu_count(), calibration_fit.calibration_fit_min_period
+    for opt, arg in opts:
+        if opt == '-j':
+            jobs = int(arg)
+        elif opt == '-p':
+            period = float(arg)
+        else:
+            usage()
+    if not filenames:
+        usage()
+
+    v = variants(period)
+    print('evaluating', len(v), 'calibration variants with', jobs, 'processes')
+    t0 = time.monotonic()
+    pool = multiprocessing.Pool(jobs, init_worker, (filenames,))
+    results = pool.map(evaluate_variant, v)
+    pool.close()
+    pool.join()
+
+    print('sensor   sigma  max   dim   ok same/fits   time  iters  devrad  devinc cov calibration')
+    for variant, result in results:
+        print(format_result(variant, result))
+    print('total %.2f seconds' % (time.monotonic() - t0))
+
+if __name__ == '__main__':
+    main()
@@ -7,20 +7,21 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import sys, time, math, numpy, scipy.optimize
-import vector, resolv, quaternion
+import sys, time, math, numpy, scipy.optimize, threading
+import vector, quaternion
 import boatimu
-resolv = resolv.resolv
 
 from values import *
 from client import pypilotClientFromArgs
     
-calibration_fit_period = 30  # run every 30 seconds
+calibration_fit_period = 30  # remove old points every 30 seconds
+calibration_fit_min_period = 5  # refit at most every 5 seconds when points change
 
 def lmap(*cargs):
     return list(map(*cargs))
 
-def FitLeastSq(beta0, f, zpoints, debug, dimensions=1):
+# stats if given accumulates the number of iterations
+def FitLeastSq(beta0, f, zpoints, debug, dimensions=1, Dfun=None, stats=None):
     try:
         import scipy.optimize
     except Exception as e:
@@ -28,9 +29,104 @@ def FitLeastSq(beta0, f, zpoints, debug, dimensions=1):
         debug('cannot perform calibration update!')
         return False
 
-    leastsq = scipy.optimize.leastsq(f, beta0, zpoints)
+    leastsq = scipy.optimize.leastsq(f, beta0, zpoints, Dfun=Dfun, full_output=True)
+    if stats is not None:
+        info = leastsq[2]
+        # each iteration evaluates the jacobian once
+        stats['iterations'] += info['njev'] if 'njev' in info else info['nfev']
     return list(leastsq[0])
 
+# choose the initial guess with the smallest residuals
+def BestInitial(f, zpoints, candidates):
+    best, bestcost = False, 0
+    for beta in candidates:
+        if not beta:
+            continue
+        cost = numpy.sum(f(numpy.array(beta, dtype=float), zpoints)**2)
+        if numpy.isfinite(cost) and (not best or cost < bestcost):
+            best, bestcost = beta, cost
+    return best
+
+# residuals and jacobians of points on a sphere with a constant dip angle
+# m is the points minus the bias (3xn), g is the down vectors (3xn)
+# R the radius and s the sine of the dip angle, the bias is parameterized
+# as the initial bias plus a linear combination of the rows of D
+def SphereResiduals(m, R):
+    return R - numpy.sqrt(numpy.sum(m*m, axis=0))
+
+def SphereJacobian(m, D):
+    nm = numpy.sqrt(numpy.sum(m*m, axis=0))
+    J = numpy.empty((m.shape[1], len(D) + 1))
+    J[:, :len(D)] = (numpy.dot(D, m)/nm).T
+    J[:, len(D)] = 1
+    return J
+
+def SphereDipResiduals(m, g, R, s):
+    nm = numpy.sqrt(numpy.sum(m*m, axis=0))
+    dip = numpy.clip(numpy.sum(m*g, axis=0)/nm, -1, 1)
+    return numpy.concatenate((R - nm, R*(s - dip)))
+
+def SphereDipJacobian(m, g, D, R, s):
+    n, k = m.shape[1], len(D)
+    nm = numpy.sqrt(numpy.sum(m*m, axis=0))
+    mg = numpy.sum(m*g, axis=0)
+    dip = mg/nm
+    clipped = numpy.abs(dip) > 1
+    dip = numpy.clip(dip, -1, 1)
+    mD = numpy.dot(D, m) # derivative of bias along each parameter is -D
+    gD = numpy.dot(D, g)
+    ddip = mg*mD/nm**3 - gD/nm
+    ddip[:, clipped] = 0
+
+    J = numpy.zeros((2*n, k + 2))
+    J[:n, :k] = (mD/nm).T
+    J[n:, :k] = (-R*ddip).T
+    J[:n, k] = 1
+    J[n:, k] = s - dip
+    J[n:, k+1] = R
+    return J
+
+# closed form algebraic fits used to seed the nonlinear fits, and as a
+# fallback if they fail.  These minimize the algebraic rather than
+# geometric distance, so the result is biased slightly with noisy data
+def AlgebraicSphereFit(zpoints):
+    # |x|^2 = 2 b.x + c  where c = R^2 - |b|^2
+    x = zpoints[:3]
+    A = numpy.vstack((2*x, numpy.ones(x.shape[1]))).T
+    y = numpy.sum(x*x, axis=0)
+    try:
+        s, res, rank, sv = numpy.linalg.lstsq(A, y, rcond=None)
+    except numpy.linalg.LinAlgError:
+        return False
+    if rank < 4:
+        return False
+    R2 = s[3] + numpy.dot(s[:3], s[:3])
+    if R2 <= 0:
+        return False
+    return lmap(float, s[:3]) + [math.sqrt(R2)]
+
+def AlgebraicEllipsoidFit(zpoints):
+    # a x^2 + b y^2 + c z^2 + 2d xy + 2e xz + 2f yz + 2g x + 2h y + 2i z = 1
+    x, y, z = zpoints[:3]
+    A = numpy.vstack((x*x, y*y, z*z, 2*x*y, 2*x*z, 2*y*z, 2*x, 2*y, 2*z)).T
+    try:
+        v, res, rank, sv = numpy.linalg.lstsq(A, numpy.ones(len(x)), rcond=None)
+        if rank < 9:
+            return False
+        Q = numpy.array([[v[0], v[3], v[4]],
+                         [v[3], v[1], v[5]],
+                         [v[4], v[5], v[2]]])
+        center = -numpy.linalg.solve(Q, v[6:])
+        # scale of the quadric once translated to the center
+        k = 1 + numpy.dot(center, numpy.dot(Q, center))
+        evals, evecs = numpy.linalg.eigh(Q/k)
+    except numpy.linalg.LinAlgError:
+        return False
+    if k <= 0 or min(evals) <= 0:
+        return False # not an ellipsoid
+    radii = 1/numpy.sqrt(evals)
+    return lmap(float, center), lmap(float, radii), evecs
+
 def FitLeastSq_odr(beta0, f, zpoints, dimensions=1):
     try:
         import scipy.odr
@@ -48,21 +144,19 @@ def FitLeastSq_odr(beta0, f, zpoints, dimensions=1):
         return False
 
 def ComputeDeviation(points, fit):
-    m, d  = 0, 0
-    for p in points:
-        v = vector.sub(p[:3], fit[:3])
-        m += (1 - vector.dot(v, v) / fit[3]**2)**2
-
-        if len(fit) > 4:
-            n = vector.dot(v, p[3:]) / vector.norm(v)
-            if abs(n) <= 1:
-                ang = math.degrees(math.asin(n))
-                d += (fit[4] - ang)**2
-            else:
-                d += 1e111
-    m /= len(points)
-    d /= len(points)
-    return [m**.5, d**.5]
+    points = numpy.array(points, dtype=float)
+    v = points[:, :3] - numpy.array(fit[:3], dtype=float)
+    vv = numpy.sum(v*v, axis=1)
+    m = numpy.mean((1 - vv / fit[3]**2)**2)
+
+    d = 0
+    if len(fit) > 4:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            n = numpy.sum(v*points[:, 3:6], axis=1) / numpy.sqrt(vv)
+        valid = numpy.abs(n) <= 1
+        ang = numpy.degrees(numpy.arcsin(n[valid]))
+        d = (numpy.sum((fit[4] - ang)**2) + 1e111*numpy.sum(~valid)) / len(points)
+    return [float(m**.5), float(d**.5)]
 
 def AvgPoint(points):
     # find average point
@@ -124,10 +218,8 @@ def LinearFit(points):
     plane = [plane_fit, plane_dev**.5, max_plane_dev**.5]
     return line, plane
 
-def FitPointsAccel(debug, points):
-    zpoints = [[], [], []]
-    for i in range(3):
-        zpoints[i] = lmap(lambda x : x[i], points)
+def FitPointsAccel(debug, points, current=False, stats=None):
+    zpoints = numpy.array(points, dtype=float).T[:3]
         
     # determine if we have 0D, 1D, 2D, or 3D set of points
     point_fit, point_dev, point_max_dev = PointFit(points)
@@ -135,28 +227,35 @@ def FitPointsAccel(debug, points):
         debug('insufficient data for accel fit %.1f %.1f < 1' % (point_dev, point_max_dev))
         return False
 
+    D = numpy.identity(3)
     def f_sphere3(beta, x):
-        bias = beta[:3]
-        b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = lmap(lambda y : beta[3] - vector.norm(y), m)
-        return r0
+        m = x - numpy.reshape(beta[:3], (3, 1))
+        return SphereResiduals(m, beta[3])
+
+    def Df_sphere3(beta, x):
+        m = x - numpy.reshape(beta[:3], (3, 1))
+        return SphereJacobian(m, D)
 
-    sphere3d_fit = FitLeastSq([0, 0, 0, 1], f_sphere3, zpoints, debug)
+    # seed from the algebraic fit or the current calibration
+    algebraic_fit = AlgebraicSphereFit(zpoints)
+    initial = BestInitial(f_sphere3, zpoints, [algebraic_fit, current, [0, 0, 0, 1]])
+    sphere3d_fit = FitLeastSq(initial, f_sphere3, zpoints, debug, Dfun=Df_sphere3, stats=stats)
     if not sphere3d_fit or sphere3d_fit[3] < 0:
         debug('FitLeastSq sphere failed!!!! ', len(points))
-        return False
+        if not algebraic_fit:
+            return False
+        debug('using algebraic sphere fit')
+        sphere3d_fit = algebraic_fit
     debug('accel sphere3 fit', sphere3d_fit, ComputeDeviation(points, sphere3d_fit))
     return sphere3d_fit
 
-def FitPointsCompass(debug, points, current, norm):
+def FitPointsCompass(debug, points, current, norm, stats=None):
     # ensure current and norm are float
     current = lmap(float, current)
     norm = lmap(float, norm)
 
-    zpoints = [[], [], [], [], [], []]
-    for i in range(6):
-        zpoints[i] = lmap(lambda x : x[i], points)
+    zpoints = numpy.array(points, dtype=float).T
+    g = zpoints[3:]
         
     # determine if we have 0D, 1D, 2D, or 3D set of points
     point_fit, point_dev, point_max_dev = PointFit(points)
@@ -201,19 +300,17 @@ def FitPointsCompass(debug, points, current, norm):
     debug('sphere1 fit', sphere1d_fit, ComputeDeviation(points, sphere1d_fit))
     '''
 
+    D1 = numpy.array([norm])
+    def sphere1_points(beta, x):
+        bias = numpy.array(initial[:3]) + beta[0]*D1[0]
+        return x[:3] - numpy.reshape(bias, (3, 1))
+
     def f_new_sphere1(beta, x):
-        bias = lmap(lambda x, n: x + beta[0]*n, initial[:3], norm)
-        b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = lmap(lambda y : beta[1] - vector.norm(y), m)
-        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-        fac = 1 # weight deviation
-        def dip(y, z):
-            n = min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
-            return n
-        r1 = lmap(lambda y, z : fac*beta[1]*(beta[2]-dip(y, z)), m, g)
-        return r0 + r1
-    new_sphere1d_fit = FitLeastSq([0, initial[3], 0], f_new_sphere1, zpoints, debug, 2)
+        return SphereDipResiduals(sphere1_points(beta, x), g, beta[1], beta[2])
+
+    def Df_new_sphere1(beta, x):
+        return SphereDipJacobian(sphere1_points(beta, x), g, D1, beta[1], beta[2])
+    new_sphere1d_fit = FitLeastSq([0, initial[3], 0], f_new_sphere1, zpoints, debug, 2, Df_new_sphere1, stats)
     if not new_sphere1d_fit or new_sphere1d_fit[1] < 0 or abs(new_sphere1d_fit[2]) > 1:
         debug('FitLeastSq new_sphere1 failed!!!! ', len(points), new_sphere1d_fit)
         new_sphere1d_fit = current
@@ -253,20 +350,17 @@ def FitPointsCompass(debug, points, current, norm):
     debug('sphere2 fit', sphere2d_fit, ComputeDeviation(points, sphere2d_fit))
     '''
 
+    D2 = numpy.array([u, v])
+    def sphere2_points(beta, x):
+        bias = numpy.array(initial[:3]) + numpy.dot(beta[:2], D2)
+        return x[:3] - numpy.reshape(bias, (3, 1))
+
     def f_new_sphere2(beta, x):
-        bias = lmap(lambda x, a, b: x + beta[0]*a + beta[1]*b, initial[:3], u, v)
-        b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = lmap(lambda y : beta[2] - vector.norm(y), m)
-        #r0 = lmap(lambda y : 1 - vector.norm(y)/beta[2], m)
-        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-        fac = 1 # weight deviation
-        def dip(y, z):
-            n = min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
-            return n
-        r1 = lmap(lambda y, z : fac*beta[2]*(beta[3]-dip(y, z)), m, g)
-        return r0 + r1
-    new_sphere2d_fit = FitLeastSq([0, 0, initial[3], 0], f_new_sphere2, zpoints, debug, 2)
+        return SphereDipResiduals(sphere2_points(beta, x), g, beta[2], beta[3])
+
+    def Df_new_sphere2(beta, x):
+        return SphereDipJacobian(sphere2_points(beta, x), g, D2, beta[2], beta[3])
+    new_sphere2d_fit = FitLeastSq([0, 0, initial[3], 0], f_new_sphere2, zpoints, debug, 2, Df_new_sphere2, stats)
     if not new_sphere2d_fit or new_sphere2d_fit[2] < 0 or abs(new_sphere2d_fit[3]) >= 1:
         debug('FitLeastSq sphere2 failed!!!! ', len(points), new_sphere2d_fit)
         return False
@@ -283,8 +377,20 @@ def FitPointsCompass(debug, points, current, norm):
 
         return [new_sphere1d_fit, new_sphere2d_fit, False]
 
-    # ok to use best guess for 3d fit
-    initial = guess
+    # ok to use best guess for 3d fit, but the algebraic fit is better
+    # the ellipsoid center is another candidate if the points are close to
+    # a sphere, it can be far off when heel limits the coverage so the
+    # residuals decide between them
+    seeds = [guess]
+    algebraic_fit = AlgebraicSphereFit(zpoints)
+    if algebraic_fit:
+        seeds = [algebraic_fit]
+        ellipsoid_fit = AlgebraicEllipsoidFit(zpoints)
+        if ellipsoid_fit:
+            center, radii, axes = ellipsoid_fit
+            if max(radii) / min(radii) < 1.2:
+                seeds.append(center + [sum(radii)/3])
+            debug('ellipsoid fit', center, radii)
     '''
     def f_sphere3(beta, x):
         bias = beta[:3]
@@ -298,23 +404,31 @@ def FitPointsCompass(debug, points, current, norm):
         return False
     debug('sphere3 fit', sphere3d_fit, ComputeDeviation(points, sphere3d_fit))
     '''
+    D3 = numpy.identity(3)
+    def sphere3_points(beta, x):
+        return x[:3] - numpy.reshape(beta[:3], (3, 1))
+
     def f_new_sphere3(beta, x):
-        b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], beta[:3]))
-        m = list(numpy.array(b.transpose()))
-        r0 = lmap(lambda y : beta[3] - vector.norm(y), m)
-        #r0 = lmap(lambda y : 1 - vector.norm(y)/beta[3], m)
-        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-        fac = 1 # weight deviation
-        def dip(y, z):
-            n = min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
-            return n
-        r1 = lmap(lambda y, z : fac*beta[3]*(beta[4]-dip(y, z)), m, g)
-
-        return r0 + r1
-    new_sphere3d_fit = FitLeastSq(initial[:4] + [0], f_new_sphere3, zpoints, debug, 2)
+        return SphereDipResiduals(sphere3_points(beta, x), g, beta[3], beta[4])
+
+    def Df_new_sphere3(beta, x):
+        return SphereDipJacobian(sphere3_points(beta, x), g, D3, beta[3], beta[4])
+    def average_dip(beta):
+        m = sphere3_points(beta, zpoints)
+        dip = numpy.mean(numpy.sum(m*g, axis=0)/numpy.sqrt(numpy.sum(m*m, axis=0)))
+        return float(numpy.clip(dip, -.99, .99))
+
+    seeds = [seed[:4] + [average_dip(seed) if algebraic_fit else 0] for seed in seeds]
+    # warm start from the current calibration if it fits better
+    warm = current[:4] + [math.sin(math.radians(current[4]))]
+    initial = BestInitial(f_new_sphere3, zpoints, seeds + [warm])
+    new_sphere3d_fit = FitLeastSq(initial, f_new_sphere3, zpoints, debug, 2, Df_new_sphere3, stats)
     if not new_sphere3d_fit or new_sphere3d_fit[3] < 0 or abs(new_sphere3d_fit[4]) >= 1:
         debug('FitLeastSq sphere3 failed!!!! ', len(points))
-        return False
+        if not algebraic_fit:
+            return False
+        debug('using algebraic sphere3 fit')
+        new_sphere3d_fit = algebraic_fit + [average_dip(algebraic_fit)]
     new_sphere3d_fit[4] = math.degrees(math.asin(new_sphere3d_fit[4]))
     new_sphere3d_fit = [new_sphere3d_fit, ComputeDeviation(points, new_sphere3d_fit), 3]
     #debug('new sphere3 fit', new_sphere3d_fit)
@@ -342,6 +456,8 @@ class SigmaPoint(object):
 
 # store averaged sensore measurements over time for
 # calibration curve fitting
+# the points are kept in preallocated numpy arrays so that
+# the nearest point test and replacement scoring are vectorized
 class SigmaPoints(object):
     def __init__(self, sigma, max_sigma_points, min_count):
         self.sigma = sigma
@@ -358,119 +474,132 @@ class SigmaPoints(object):
 
     # forget all knowledge of stored sensor points
     def Reset(self):
-        self.sigma_points = []
+        n = self.max_sigma_points
+        self.sensor = numpy.zeros((n, 3))
+        self.down = numpy.zeros((n, 3))
+        self.count = numpy.zeros(n, dtype=int)
+        self.time = numpy.zeros(n)
+        self.n = 0
         self.lastpoint = False
+        self.changes = 0 # accumulated change since the last fit
 
     def Points(self, down=False):
-        def pt(p):
-            if down:
-                return p.sensor + p.down
-            else:
-                return p.sensor
+        if down:
+            return numpy.hstack((self.sensor[:self.n], self.down[:self.n])).tolist()
+        return self.sensor[:self.n].tolist()
 
-        return lmap(pt, self.sigma_points)
+    # store sigma point at index i
+    def set(self, i, sensor, down):
+        self.sensor[i] = sensor
+        if down:
+            self.down[i] = down
+        self.count[i] = 1
+        self.time[i] = time.monotonic()
+
+    # remove points given a boolean mask, preserving order
+    def remove(self, mask):
+        keep = numpy.logical_not(mask)
+        n = int(numpy.sum(keep))
+        self.changes += self.n - n
+        for a in [self.sensor, self.down, self.count, self.time]:
+            a[:n] = a[:self.n][keep]
+        self.n = n
 
     # store a new sensor
-    def AddPoint(self, sensor, down=False):
-        if not self.lastpoint:
-            self.lastpoint = SigmaPoint(sensor, down)
-            return
+    # count is the number of samples already averaged into sensor
+    def AddPoint(self, sensor, down=False, count=1):
+        if count < self.min_count:
+            if not self.lastpoint:
+                self.lastpoint = SigmaPoint(sensor, down)
+                return
 
-        if self.lastpoint.count < self.min_count: # require x measurements
-            if vector.dist2(self.lastpoint.sensor, sensor) < self.sigma:
-                self.lastpoint.add_measurement(sensor, down)
+            if self.lastpoint.count < self.min_count: # require x measurements
+                if vector.dist2(self.lastpoint.sensor, sensor) < self.sigma:
+                    self.lastpoint.add_measurement(sensor, down)
+                    return
+
+                self.lastpoint = False
                 return
-            
-            self.lastpoint = False
-            return
 
-        # use lastpoint as better sample
-        sensor, down = self.lastpoint.sensor, self.lastpoint.down
-        self.lastpoint = False
+            # use lastpoint as better sample
+            sensor, down = self.lastpoint.sensor, self.lastpoint.down
+            self.lastpoint = False
 
-        ind = 0
-        for point in self.sigma_points:
-            if point.count > 100:
-                continue
-            if vector.dist2(point.sensor, sensor) < self.sigma:
-                point.add_measurement(sensor, down)
-                if ind > 0:
-                    # move toward front of list to speed up future tests
-                    self.sigma_points = self.sigma_points[:ind-1] + [point] + [self.sigma_points[ind-1]] + self.sigma_points[ind+1:]
+        n = self.n
+        if n:
+            # average into the nearest point within sigma
+            d2 = numpy.sum((self.sensor[:n] - sensor)**2, axis=1)
+            d2[self.count[:n] > 100] = 1e20
+            i = int(numpy.argmin(d2))
+            if d2[i] < self.sigma:
+                self.count[i] += 1
+                fac = max(1/self.count[i], .01)
+                # moving points a total of sigma counts as one change
+                self.changes += fac*math.sqrt(d2[i]/self.sigma)
+                self.sensor[i] += fac*(numpy.array(sensor) - self.sensor[i])
+                if down:
+                    self.down[i] += fac*(numpy.array(down) - self.down[i])
+                self.time[i] = time.monotonic()
                 return
-            ind += 1
 
         self.updated = True
-        index = len(self.sigma_points)
-        p = SigmaPoint(sensor, down)
-        if index < self.max_sigma_points:
-            # push to front of list
-            self.sigma_points = [p] + self.sigma_points
+        self.changes += 1
+        if n < self.max_sigma_points:
+            self.set(n, sensor, down)
+            self.n += 1
             return
 
-
         # replace point that is closest to other points
-        mindi = 0
-        mind = 1e20
-        for i in range(len(self.sigma_points)):
-            dt = time.monotonic() - self.sigma_points[i].time
-            d = []
-            for j in range(len(self.sigma_points)):
-                if i == j:
-                    continue
-                dist = vector.dist(self.sigma_points[i].sensor, self.sigma_points[j].sensor)
-                count = min(self.sigma_points[i].count, 100)
-                d.append(dist)
-
-            d.sort()
-            # weight based on distance to closest 2 points and time
-            total = (d[0]+d[1])*1/dt**.2
-            if total < mind:
-                mindi = i
-                mind = total
-
-        self.sigma_points[mindi] = p
+        diff = self.sensor[:, None, :] - self.sensor[None, :, :]
+        dist = numpy.sqrt(numpy.sum(diff**2, axis=2))
+        numpy.fill_diagonal(dist, 1e20)
+        closest = numpy.partition(dist, 1, axis=1)[:, :2]
+        dt = numpy.maximum(time.monotonic() - self.time, 1e-3)
+        # weight based on distance to closest 2 points and time
+        total = numpy.sum(closest, axis=1)/dt**.2
+        self.set(int(numpy.argmin(total)), sensor, down)
 
     def RemoveOlder(self, dt=3600):
-        p = []
-        for sigma in self.sigma_points:
-            if time.monotonic() - sigma.time < dt:
-                p.append(sigma)
-        self.sigma_points = p
+        self.remove(time.monotonic() - self.time[:self.n] >= dt)
 
     def RemoveOldest(self):
-        oldest_sigma = self.sigma_points[0]
-        for sigma in self.sigma_points:
-            if sigma.time < oldest_sigma.time:
-                oldest_sigma = sigma
+        if not self.n:
+            return
+        i = int(numpy.argmin(self.time[:self.n]))
 
         # don't remove if < 1 minute old
-        if time.monotonic() - oldest_sigma.time >= 60:
-            self.sigma_points.remove(oldest_sigma)
+        if time.monotonic() - self.time[i] >= 60:
+            mask = numpy.zeros(self.n, dtype=bool)
+            mask[i] = True
+            self.remove(mask)
 
 # calculate how well these datapoints cover the space by
 # counting how many 20 degree segments have at least 1 datapoint
 def ComputeCoverage(p, bias, norm):
+    # rotation matrix for the quaternion rotating norm to vertical
     q = quaternion.vec2vec2quat(norm, [0, 0, 1])
-    def ang(p):
-        c = quaternion.rotvecquat(vector.sub(p[:3], bias), q)
-        d = quaternion.rotvecquat(p[3:6], q)
-        v = quaternion.rotvecquat(c, quaternion.vec2vec2quat(d, [0, 0, 1]))
-        v = vector.normalize(v)
-        return math.degrees(math.atan2(v[1], v[0]))
-    #, abs(math.degrees(math.acos(v[2])))
+    R = numpy.array(lmap(lambda e : quaternion.rotvecquat(e, q), numpy.identity(3))).T
+
+    p = numpy.array(p, dtype=float)
+    c = numpy.dot(p[:, :3] - numpy.array(bias, dtype=float), R.T)
+    d = numpy.dot(p[:, 3:6], R.T)
+
+    # rotate each c by the rotation taking d to vertical (rodrigues formula)
+    k = numpy.column_stack((d[:, 1], -d[:, 0], numpy.zeros(len(d)))) # d cross z
+    kn = numpy.sqrt(numpy.sum(k*k, axis=1))
+    cosa = numpy.clip(d[:, 2] / numpy.sqrt(numpy.sum(d*d, axis=1)), -1, 1)
+    sina = numpy.sqrt(1 - cosa**2)
+    k /= numpy.where(kn > 0, kn, 1)[:, None]
+    kc = numpy.sum(k*c, axis=1)
+    v = c*cosa[:, None] + numpy.cross(k, c)*sina[:, None] + k*(kc*(1-cosa))[:, None]
+    a = numpy.degrees(numpy.arctan2(v[:, 1], v[:, 0]))
 
     spacing = 20 # 20 degree segments
-    angles = [False] * int(360 / spacing)
-    count = 0
-    for a in lmap(ang, p):
-        i = int(resolv(a, 180) / spacing)
-        if not angles[i]:
-            angles[i] = True
-            count += 1
-    return count
-
-def FitAccel(debug, accel_cal):
+    a = numpy.where(a < 0, a + 360, a) # resolv(a, 180)
+    i = numpy.minimum((a / spacing).astype(int), int(360 / spacing) - 1)
+    return len(numpy.unique(i))
+
+def FitAccel(debug, accel_cal, current=False, stats=None):
     p = accel_cal.Points()
     if len(p) < 5:
         return False
@@ -484,7 +613,7 @@ def FitAccel(debug, accel_cal):
     if sum(diff) < 4.5:
         debug('need more spread', sum(diff))
         return # require more spread
-    fit = FitPointsAccel(debug, p)
+    fit = FitPointsAccel(debug, p, current, stats)
     if not fit:
         debug('FitPointsAccel failed', fit)
         return False
@@ -496,12 +625,17 @@ def FitAccel(debug, accel_cal):
     dev = ComputeDeviation(p, fit)
     return [fit, dev]
 
-def FitCompass(debug, compass_points, compass_calibration, norm):
+# true if a compass fit is too close to the current calibration to report
+def SameCalibration(fit, current):
+    return vector.dist2(fit, current) < .1
+
+# stats['unchanged'] is set if the fit matched the current calibration
+def FitCompass(debug, compass_points, compass_calibration, norm, stats=None):
     p = compass_points.Points(True)
     if len(p) < 8:
         return False
 
-    fit = FitPointsCompass(debug, p, compass_calibration, norm)
+    fit = FitPointsCompass(debug, p, compass_calibration, norm, stats)
     if not fit:
         return
     #debug('FitCompass', fit)
@@ -564,8 +698,10 @@ def FitCompass(debug, compass_points, compass_calibration, norm):
 
     # if the bias has not sufficiently changed,
     # the fit didn't change much, so don't bother to report this update
-    if vector.dist2(c[0], compass_calibration) < .1:
+    if SameCalibration(c[0], compass_calibration):
         debug('new calibration same as previous')
+        if stats is not None:
+            stats['unchanged'] = True
         return
 
     return c
@@ -612,11 +748,14 @@ def RegisterCalibration(client, name, default):
     calibration.sigmapoints = client.register(RoundedValue(name+'.calibration.sigmapoints', False))
     calibration.points = client.register(RoundedValue(name+'.calibration.points', False, persistent=True))
     calibration.log = client.register(Property(name+'.calibration.log', ''))
+    calibration.fit_duration = client.register(SensorValue(name+'.calibration.fit_duration'))
+    calibration.fit_iterations = client.register(Value(name+'.calibration.fit_iterations', 0))
     return calibration
         
 def CalibrationProcess(cal_pipe, client):
-    accel_points = SigmaPoints(.05**2, 12, 10)
-    compass_points = SigmaPoints(1.1**2, 24, 3)
+    sigma, min_count = boatimu.calibration_sigma, boatimu.calibration_min_count
+    accel_points = SigmaPoints(sigma['accel']**2, 12, min_count['accel'])
+    compass_points = SigmaPoints(sigma['compass']**2, 24, min_count['compass'])
 
     norm = [0, 0, 1]
 
@@ -629,219 +768,122 @@ def CalibrationProcess(cal_pipe, client):
         client.watch('imu.compass')
         client.watch('imu.fusionQPose')
 
+    # the fits run in threads, so collect the log messages
+    # and send them from this thread once the fits complete
+    logs = {'accel': [], 'compass': []}
     def debug(name):
         def debug_by_name(*args):
             s = ''
             for a in args:
                 s += str(a) + ' '
-            client.set('imu.'+name+'.calibration.log', s)
+            logs[name].append(s)
         return debug_by_name
-    
+
+    fits = {}
+    def run_fit(name, fit_func, *args):
+        stats = {'iterations': 0}
+        t0 = time.monotonic()
+        fit = fit_func(debug(name), *args, stats=stats)
+        fits[name] = fit, time.monotonic() - t0, stats['iterations']
+
+    down = sent_locked = False
+    last_fit = last_prune = time.monotonic()
     while True:
-        t = time.monotonic()
-        addedpoint = False
-        down = False
-        while time.monotonic() - t < calibration_fit_period:
-            # receive pypilot messages
-            msg = client.receive(1)
-            for name in msg:
-                value = msg[name]
-                if name == 'imu.alignmentQ' and value:
-                    norm = quaternion.rotvecquat([0, 0, 1], value)
-                    compass_points.Reset()
-                elif name == 'imu.accel':
-                    if value:
-                        accel_points.AddPoint(value)
-                    addedpoint = True
-                elif name == 'imu.compass' and down:
-                    if value and down:
-                        compass_points.AddPoint(value, down)
-                    addedpoint = True
-                elif name == 'imu.fusionQPose':
-                    if value:
-                        down = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(value))
-
-            # receive calibration data
-            if cal_pipe:
+        # receive pypilot messages
+        msg = client.receive(1)
+        for name in msg:
+            value = msg[name]
+            if name == 'imu.alignmentQ' and value:
+                norm = quaternion.rotvecquat([0, 0, 1], value)
+                compass_points.Reset()
+            elif name == 'imu.accel':
+                if value:
+                    accel_points.AddPoint(value)
+            elif name == 'imu.compass' and down:
+                if value and down:
+                    compass_points.AddPoint(value, down)
+            elif name == 'imu.fusionQPose':
+                if value:
+                    down = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(value))
+
+        # receive calibration data, already averaged by the imu process
+        if cal_pipe:
+            p = cal_pipe.recv()
+            while p:
+                #print('calpipe!!!!!!!!!!!!', type(p))
+                if 'accel' in p:
+                    accel_points.AddPoint(p['accel'], count=p['count'])
+                if 'compass' in p:
+                    compass_points.AddPoint(p['compass'], p['down'], p['count'])
                 p = cal_pipe.recv()
-                while p:
-                    #print('calpipe!!!!!!!!!!!!', type(p))
-                    if 'accel' in p:
-                        accel_points.AddPoint(p['accel'])
-                        addedpoint = True
-                    if 'compass' in p:
-                        down = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(p['fusionQPose']))
-                        compass_points.AddPoint(p['compass'], down)
-                        addedpoint = True
-                    p = cal_pipe.recv()
-
-            cals = [(accel_calibration, accel_points), (compass_calibration, compass_points)]
-            for calibration, points in cals:
-                calibration.age.update()
-                if points.Updated():
-                    calibration.sigmapoints.set(points.Points())
-
-        if not addedpoint: # don't bother to run fit if no new data
-            continue
 
-        accel_points.RemoveOlder(10*60) # 10 minutes
-        fit = FitAccel(debug('accel'), accel_points)
-        if fit: # reset compass sigmapoints on accel cal
-            dist = vector.dist(fit[0][:3], accel_calibration.value[0][:3])
-            if dist > .01: # only update when bias changes more than this
-                if dist > .08: # reset compass cal from large change in accel bias
-                    compass_points.Reset()
-                accel_calibration.set(fit)
-                accel_calibration.points.set(accel_points.Points())
-
-        compass_points.RemoveOlder(20*60) # 20 minutes
-        fit = FitCompass(debug('compass'), compass_points, compass_calibration.value[0], norm)
-        if fit:
-            compass_calibration.set(fit)
-            compass_calibration.points.set(compass_points.Points())
-
-def ExtraFit():
-    ellipsoid_fit = False
-    '''
-    if len(points) >= 10:
-        def f_ellipsoid3(beta, x):
-            return (x[0]-beta[0])**2 + (beta[4]*(x[1]-beta[1]))**2 + (beta[5]*(x[2]-beta[2]))**2 - beta[3]**2
-        ellipsoid_fit = FitLeastSq(sphere_fit + [1, 1], f_ellipsoid3, zpoints)
-        print('ellipsoid_fit', ellipsoid_fit)
-    '''
+            # so the imu process only sends unlocked sensors
+            locked = {'accel': accel_calibration.locked.value,
+                      'compass': compass_calibration.locked.value}
+            if locked != sent_locked:
+                cal_pipe.send({'locked': locked})
+                sent_locked = locked
 
-#        return [sphere_fit, 1, ellipsoid_fit]
-    def f_rotellipsoid3(beta, x):
-        return x[0]**2 + (beta[1]*x[1] + beta[3]*x[0])**2 + (beta[2]*x[2] + beta[4]*x[0] + beta[5]*x[1])**2 - beta[0]**2
-        a = x[0]-beta[0]
-        b = x[1]-beta[1]
-        c = x[2]-beta[2]
-        return (a)**2 + (beta[4]*b + beta[6]*a)**2 + (beta[5]*c + beta[7]*a + beta[8]*b)**2 - beta[3]**2
-    def f_ellipsoid3_cr(beta, x, cr):
-        a = x[0]-beta[0]
-        b = x[1]-beta[1]
-        c = x[2]-beta[2]
-        return (a)**2 + (beta[4]*b + cr[0]*a)**2 + (beta[5]*c + cr[1]*a + cr[2]*b)**2 - beta[3]**2
-
-        # if the ellipsoid fit is sane
-    if abs(ellipsoid_fit[4]-1) < .2 and abs(ellipsoid_fit[5]-1) < .2:
-        cpoints = lmap(lambda a, b : a - b, zpoints[:3], ellipsoid_fit[:3])
-        rotellipsoid_fit = FitLeastSq(ellipsoid_fit[3:] + [0, 0, 0], f_rotellipsoid3, cpoints)
-        #print('rotellipsoid_fit', rotellipsoid_fit)
-        ellipsoid_fit2 = FitLeastSq(ellipsoid_fit[:3] + rotellipsoid_fit[:3], f_ellipsoid3_cr, (zpoints, rotellipsoid_fit[3:]))
-        #print('ellipsoid_fit2', ellipsoid_fit2)
-
-        cpoints = lmap(lambda a, b : a - b, zpoints[:3], ellipsoid_fit2[:3])
-        rotellipsoid_fit2 = FitLeastSq(ellipsoid_fit[3:] + [0, 0, 0], f_rotellipsoid3, cpoints)
-        print('rotellipsoid_fit2', rotellipsoid_fit2)
-    else:
-        ellipsoid_fit = False
-
-    def f_uppermatrixfit(beta, x):
-            b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], beta[:3]))
-            r = numpy.matrix([beta[3:6], [0]+list(beta[6:8]), [0, 0]+[beta[8]]])
-            print('b', beta)
-
-            m = r * b
-            m = list(numpy.array(m.transpose()))
-            r0 = lmap(lambda y : 1 - vector.dot(y, y), m)
-
-            return r0
-
-    def f_matrixfit(beta, x, efit):
-            b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], efit[:3]))
-            r = numpy.matrix([[1,       beta[0], beta[1]],
-                              [beta[2], efit[4], beta[3]],
-                              [beta[4], beta[5], efit[5]]])
-
-            m = r * b
-            m = list(numpy.array(m.transpose()))
-            r0 = lmap(lambda y : efit[3]**2 - vector.dot(y, y), m)
-            #return r0
-
-            g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-            r1 = lmap(lambda y, z : beta[6] - vector.dot(y, z), m, g)
-
-            return r0+r1
-
-    def f_matrix2fit(beta, x, efit):
-            b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], beta[:3]))
-            r = numpy.matrix([[1,       efit[0], efit[1]],
-                              [efit[2], beta[4], efit[3]],
-                              [efit[4], efit[5], beta[5]]])
-
-            m = r * b
-            m = list(numpy.array(m.transpose()))
-            r0 = lmap(lambda y : beta[3]**2 - vector.dot(y, y), m)
-            #return r0
-
-            g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-            r1 = lmap(lambda y, z : beta[6] - vector.dot(y, z), m, g)
-
-            return r0+r1
-
-    if False:
-         matrix_fit = FitLeastSq([0, 0, 0, 0, 0, 0, 0], f_matrixfit, (zpoints, ellipsoid_fit))
-         #print('matrix_fit', matrix_fit)
-
-         matrix2_fit = FitLeastSq(ellipsoid_fit + [matrix_fit[6]], f_matrix2fit, (zpoints, matrix_fit))
-         #print('matrix2_fit', matrix2_fit)
-
-         matrix_fit2 = FitLeastSq(matrix_fit, f_matrixfit, (zpoints, matrix2_fit))
-         print('matrix_fit2', matrix_fit2)
-
-         matrix2_fit2 = FitLeastSq(matrix2_fit[:6] + [matrix_fit2[6]], f_matrix2fit, (zpoints, matrix_fit2))
-         print('matrix2_fit2', matrix2_fit2)
-
-    def rot(v, beta):
-        sin, cos = math.sin, math.cos
-        v = vector.normalize(v)
-        #            q = angvec2quat(beta[0], [0, 1, 0])
-        #            return rotvecquat(v, q)
-        v1 = [v[0]*cos(beta[0]) + v[2]*sin(beta[0]),
-              v[1],
-              v[2]*cos(beta[0]) - v[0]*sin(beta[0])]
-
-        v2 = [v1[0],
-              v1[1]*cos(beta[1]) + v1[2]*sin(beta[1]),
-              v1[2]*cos(beta[1]) - v1[1]*sin(beta[1])]
-
-        v3 = [v2[0]*cos(beta[2]) + v2[1]*sin(beta[2]),
-              v2[1]*cos(beta[2]) - v2[0]*sin(beta[1]),
-              v2[2]]
-            
-        return v3
-
-    def f_quat(beta, x, sphere_fit):
-        sphere_fit = numpy.array(sphere_fit)
-        n = [x[0]-sphere_fit[0], x[1]-sphere_fit[1], x[2]-sphere_fit[2]]
-        q = [1 - vector.norm(beta[:3])] + list(beta[:3])
-        q = angvec2quat(vector.norm(beta[:3]), beta[:3])
-        m = lmap(lambda v : rotvecquat(vector.normalize(v), q), list(zip(n[0], n[1], n[2])))
-#        m = lmap(lambda v : rot(v, beta), list(zip(n[0], n[1], n[2])))
-
-        m = numpy.array(list(zip(*m)))
-        d = m[0]*x[3] + m[1]*x[4] + m[2]*x[5]
-        return beta[3] - d
-
-    quat_fit = FitLeastSq([0, 0, 0, 0], f_quat, (zpoints, sphere_fit))
-    #    q = [1 - vector.norm(quat_fit[:3])] + list(quat_fit[:3])
-    q = angvec2quat(vector.norm(quat_fit[:3]), quat_fit[:3])
-
-    print('quat fit', q, math.degrees(angle(q)), math.degrees(math.asin(quat_fit[3])))
-    
-    def f_rot(beta, x, sphere_fit):
-        sphere_fit = numpy.array(sphere_fit)
-        n = [x[0]-sphere_fit[0], x[1]-sphere_fit[1], x[2]-sphere_fit[2]]
-        m = lmap(lambda v : rot(v, beta), zip(n[0], n[1], n[2]))
-        m = numpy.array(list(zip(*m)))
+        cals = [(accel_calibration, accel_points), (compass_calibration, compass_points)]
+        for calibration, points in cals:
+            calibration.age.update()
+            if points.Updated():
+                calibration.sigmapoints.set(points.Points())
 
-        d = m[0]*x[3] + m[1]*x[4] + m[2]*x[5]
-        return beta[3] - d
+        t = time.monotonic()
+        if t - last_prune > calibration_fit_period:
+            accel_points.RemoveOlder(10*60) # 10 minutes
+            compass_points.RemoveOlder(20*60) # 20 minutes
+            last_prune = t
 
-    rot_fit = FitLeastSq([0, 0, 0, 0], f_rot, (zpoints, sphere_fit))
-    print('rot fit', rot_fit, math.degrees(rot_fit[0]), math.degrees(rot_fit[1]), math.degrees(rot_fit[2]), math.degrees(math.asin(min(1, max(-1, rot_fit[3])))))
-    
+        # only refit when the sigma points changed enough
+        if t - last_fit < calibration_fit_min_period:
+            continue
+
+        threads = []
+        if accel_points.changes >= 1:
+            accel_points.changes = 0
+            threads.append(threading.Thread(target=run_fit, args=('accel', FitAccel, accel_points, accel_calibration.value[0])))
+        if compass_points.changes >= 1:
+            compass_points.changes = 0
+            threads.append(threading.Thread(target=run_fit, args=('compass', FitCompass, compass_points, compass_calibration.value[0], norm)))
+        if not threads:
+            continue
+
+        last_fit = t
+        fits.clear()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for name, calibration in [('accel', accel_calibration), ('compass', compass_calibration)]:
+            if not name in fits:
+                continue
+            for s in logs[name]:
+                calibration.log.set(s)
+            logs[name] = []
+            fit, duration, iterations = fits[name]
+            calibration.fit_duration.set(duration)
+            calibration.fit_iterations.set(iterations)
+
+        if 'accel' in fits:
+            fit = fits['accel'][0]
+            if fit: # reset compass sigmapoints on accel cal
+                dist = vector.dist(fit[0][:3], accel_calibration.value[0][:3])
+                if dist > .01: # only update when bias changes more than this
+                    if dist > .08: # reset compass cal from large change in accel bias
+                        compass_points.Reset()
+                        fits.pop('compass', None) # fit used the old points
+                    accel_calibration.set(fit)
+                    accel_calibration.points.set(accel_points.Points())
+
+        if 'compass' in fits:
+            fit = fits['compass'][0]
+            if fit: # only returned when the calibration changed
+                compass_calibration.set(fit)
+                # publish the points the new calibration was fit to for the calibration plot
+                compass_calibration.points.set(compass_points.Points())
 
 def main():
     print('running remote calibration')
@@ -7,7 +7,7 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import multiprocessing, time, socket, select
+import multiprocessing, time, socket, select, os, errno
 from nonblockingpipe import NonBlockingPipe
 from bufferedsocket import LineBufferedNonBlockingSocket
 from values import *
@@ -24,40 +24,86 @@ def gps_json_loads(line):
     line = line[:i]+act+':"'+line[i+12:j+1]+'"'+line[j+1:]
     return pyjson.loads(line)
 
+# gpsd always sends the class first, so messages which are not used,
+# like SKY which is large, are skipped without decoding them
+gpsd_classes = ['TPV', 'DEVICES', 'DEVICE', 'VERSION']
+def gpsd_class(line):
+    if not line.startswith('{"class":"'):
+        return False
+    return line[10:line.find('"', 10)]
+
+gpsd_address = ('127.0.0.1', 2947)
+gpsd_control_socket = os.getenv('GPSD_SOCKET', '/var/run/gpsd.sock')
+gpsd_response_timeout = 5
+
+# talk to gpsd without blocking, each state is handled as the socket
+# becomes ready so a lost connection is retried in a fraction of a second
+#   disconnected -> connecting -> watching (sent ?WATCH) -> connected (gpsd answered)
 class gpsProcess(multiprocessing.Process):
     def __init__(self):
         # split pipe ends
         self.pipe, pipe = NonBlockingPipe('gps_pipe', True)
         super(gpsProcess, self).__init__(target=self.gps_process, args=(pipe,), daemon=True)
-        
-    def connect(self):
-        time.sleep(2)
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(('127.0.0.1', 2947))
-            self.poller.register(sock, select.POLLIN)
-            sock.settimeout(0)
-            sock.send('?WATCH={"enable":true,"json":true};'.encode())
-            self.gpsd_socket = LineBufferedNonBlockingSocket(sock, 'gpsd')
-            self.gpsconnecttime = time.monotonic()
-            self.devices = []
-            print('gpsd connected')
-        #except socket.error:
-        except ConnectionRefusedError:
-            print('gpsd failed to connect')
-            self.gpsd_socket = False
-            time.sleep(30)
-        except Exception as e:
-            self.gpsd_socket = False
-            print('exception connecting to gps', e)
-            time.sleep(60)
 
-    def disconnect(self):
+    def set_state(self, state, t):
+        self.state = state
+        self.state_time = t
+
+    def connect(self, t):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex(gpsd_address)
+        if err and err != errno.EINPROGRESS:
+            sock.close()
+            self.failed(t, os.strerror(err))
+            return
+        self.sock = sock
+        self.poller.register(sock, select.POLLOUT)
+        self.set_state('connecting', t)
+
+    def connected(self, t):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.poller.unregister(self.sock)
+            self.sock.close()
+            self.sock = False
+            self.failed(t, os.strerror(err))
+            return
+        self.poller.modify(self.sock, select.POLLIN)
+        self.gpsd_socket = LineBufferedNonBlockingSocket(self.sock, 'gpsd')
+        self.gpsd_socket.write('?WATCH={"enable":true,"json":true};')
+        self.gpsd_socket.flush()
+        self.set_state('watching', t)
+
+    # retry quickly at first, backing off while gpsd is not running
+    def failed(self, t, reason=False):
+        if not self.failures and reason:
+            print('gpsd failed to connect', reason)
+        self.retry_time = t + min(.25 * 2**self.failures, 16)
+        self.failures += 1
+        self.set_state('disconnected', t)
+
+    def disconnect(self, t, pipe):
         print('gpsd disconnected')
-        self.poller.unregister(self.gpsd_socket.socket)
+        self.poller.unregister(self.sock)
         self.gpsd_socket.close()
         self.gpsd_socket = False
+        self.sock = False
         self.devices = []
+        pipe.send({'devices': self.devices})
+        self.failed(t)
+
+    # add a device with the gpsd control socket, gpsd probes it itself
+    def add_device(self, device):
+        print('gpsd adding device', device)
+        try:
+            control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            control.setblocking(0)
+            control.connect(gpsd_control_socket)
+            control.send(('+' + os.path.realpath(device) + '\r\n').encode())
+            control.close()
+        except Exception as e:
+            print('gpsd failed to add device', device, e)
 
     def read_pipe(self, pipe):
         while True:
@@ -65,36 +111,25 @@ class gpsProcess(multiprocessing.Process):
             if not device:
                 break
             if self.gpsd_socket and not self.devices: # only probe if there are no gpsd devices
-                print('gpsd PROBING...', device)                    
-                if not os.system('timeout -s KILL -t 30 gpsctl -f ' + device + ' 2> /dev/null'):
-                    print('gpsd PROBE success', device)
-                    # probe was success
-                    os.environ['GPSD_SOCKET'] = '/tmp/gpsd.sock'
-                    os.environ['GPSD_OPTIONS'] = '-N -G -F /tmp/gpsd.sock' # should not run gpsd..
-                    realpath = os.path.realpath(device)
-                    os.system('gpsdctl add ' + realpath)
-                    print('gpsd probe success: ' + device)
-                    self.devices = [device]
-                else:
-                    print('gpsd probe failed')
-            # always reply with devices when asked to probe
+                self.add_device(device)
+            # always reply with devices when asked to probe, gpsd reports
+            # the device once it is activated
             print('GPSD send devices', self.devices)
             pipe.send({'devices': self.devices})
 
     def parse_gpsd(self, msg, pipe):
-        if not 'class' in msg:
-            return False# unrecognized
-
         ret = False
         cls = msg['class']
         if cls  == 'DEVICES':
             self.devices = []
             for dev in msg['devices']:
                 self.devices.append(dev['path'])
+                self.update_bps(dev)
             ret = True
         elif cls == 'DEVICE':
             device = msg['path']
-            if msg['activated']:
+            if msg.get('activated'):
+                self.update_bps(msg)
                 if not device in self.devices:
                     self.devices.append(device)
                     ret = True
@@ -111,7 +146,7 @@ class gpsProcess(multiprocessing.Process):
                         fix[key] = msg[key]
                 fix['speed'] *= 1.944 # knots
                 device = msg['device']
-                if self.baud_boot_device_hint != device:
+                if self.baud_boot_device_hint != device and device in self.bps:
                     self.write_baud_boot_hint(device)
                 if not device in self.devices:
                     self.devices.append(device)
@@ -119,61 +154,102 @@ class gpsProcess(multiprocessing.Process):
                 pipe.send(fix, False)
         return ret
 
+    # gpsd reports the baud rate of each device, and again when it changes
+    def update_bps(self, msg):
+        if not 'bps' in msg:
+            return
+        device = msg['path']
+        changed = self.bps.get(device) != msg['bps']
+        self.bps[device] = msg['bps']
+        if changed and self.baud_boot_device_hint == device:
+            self.write_baud_boot_hint(device)
+
     def write_baud_boot_hint(self, device):
         self.baud_boot_device_hint = device
         try:
-            stty=os.popen('sudo stty -F ' + device)
-            line = stty.readline()
-            stty.close()
-            speed = line.index('speed')
-            baud = line.index('baud')
-            bps = int(line[speed+6:baud-1])
             f = open(os.getenv('HOME') + '/.pypilot/gpsd_baud_hint', 'w')
-            f.write(str(bps))
+            f.write(str(self.bps[device]))
             f.close()
         except Exception as e:
-            print('gpsd failed to determine serial baud rate of device')
-            
+            print('gpsd failed to write baud rate of device', e)
+
+    def receive(self, t, pipe):
+        if not self.gpsd_socket.recvdata():
+            self.disconnect(t, pipe)
+            return
+        while True:
+            line = self.gpsd_socket.readline()
+            if not line:
+                break
+            cls = gpsd_class(line)
+            if not cls in gpsd_classes:
+                continue
+            if self.state == 'watching':
+                print('gpsd connected')
+                self.set_state('connected', t)
+                self.failures = 0
+            try:
+                if self.parse_gpsd(gps_json_loads(line), pipe):
+                    pipe.send({'devices': self.devices})
+            except Exception as e:
+                print('gpsd received invalid message', line, e)
+
     def gps_process(self, pipe):
         print('gps process', os.getpid())
         self.gpsd_socket = False
+        self.sock = False
+        self.devices = []
+        self.bps = {}
+        self.failures = 0
+        self.retry_time = 0
+        self.set_state('disconnected', 0)
         self.poller = select.poll()
+        self.poller.register(pipe.fileno(), select.POLLIN)
         self.baud_boot_device_hint = ''
         while True:
-            self.read_pipe(pipe)
-            if not self.gpsd_socket:
-                self.connect()
-                continue
+            t = time.monotonic()
+            if self.state == 'disconnected':
+                if t >= self.retry_time:
+                    self.connect(t)
+            elif self.state != 'connected' and t - self.state_time > gpsd_response_timeout:
+                print('gpsd timeout', self.state)
+                if self.gpsd_socket:
+                    self.disconnect(t, pipe)
+                else:
+                    self.poller.unregister(self.sock)
+                    self.sock.close()
+                    self.sock = False
+                    self.failed(t, 'timeout')
 
-            events = self.poller.poll(1000)
-            #print('gpsd poll', events)
-            if not events:
-                if self.gpsconnecttime and time.monotonic() - self.gpsconnecttime > 10:
-                    print('gpsd timeout from lack of data')
-                    self.disconnect();
-                continue
+            if self.state == 'disconnected':
+                timeout = max(self.retry_time - t, 0)
+            elif self.state == 'connected':
+                timeout = 1
+            else:
+                timeout = max(self.state_time + gpsd_response_timeout - t, 0)
 
-            self.gpsconnecttime = False
-            fd, flag = events.pop()
-            if flag & select.POLLIN and self.gpsd_socket.recvdata():
-                while True:
-                    line = self.gpsd_socket.readline()
-                    if not line:
-                        break
-                    try:
-                        if self.parse_gpsd(gps_json_loads(line), pipe):
-                            pipe.send({'devices': self.devices})                    
-                    except Exception as e:
-                        print('gpsd received invalid message', line, e)
-            else: # gpsd connection lost
-                self.disconnect()
-                pipe.send({'devices': self.devices})                    
+            for fd, flag in self.poller.poll(timeout*1000):
+                t = time.monotonic()
+                if fd == pipe.fileno():
+                    self.read_pipe(pipe)
+                elif self.state == 'connecting':
+                    self.connected(t)
+                elif flag & select.POLLIN:
+                    self.receive(t, pipe)
+                elif self.gpsd_socket: # gpsd connection lost
+                    self.disconnect(t, pipe)
 
 class gpsd(object):
     def __init__(self, sensors):
         self.sensors = sensors
         self.devices = False # list of devices used by gpsd, or False if not connected
 
+        self.fix_age = sensors.client.register(SensorValue('gpsd.fix_age'))
+        self.rate = sensors.client.register(SensorValue('gpsd.rate', 0, fmt='%.1f'))
+        self.fixes = 0
+        self.last_fix_time = False
+        self.last_stats_time = time.monotonic()
+
         self.process = gpsProcess()
         self.process.start()
 
@@ -194,8 +270,20 @@ class gpsd(object):
                 serialprobe.gpsddevices(self.devices)
             else:
                 self.sensors.write('gps', data, 'gpsd')
+                self.fixes += 1
+                self.last_fix_time = time.monotonic()
             data = self.process.pipe.recv()
 
+    # fix age and rate are updated once a second
+    def update_stats(self, t):
+        dt = t - self.last_stats_time
+        if dt < 1:
+            return
+        self.rate.set(self.fixes / dt)
+        self.fix_age.set(t - self.last_fix_time if self.last_fix_time else False)
+        self.fixes = 0
+        self.last_stats_time = t
+
     def poll(self):
         # no gpsd devices: probe
         t0 = time.monotonic()
@@ -214,6 +302,7 @@ class gpsd(object):
                 self.last_read_time = t0
                 self.read()
 
+        self.update_stats(t0)
         return # don't probe gpsd anymore
         if (not self.devices is False) and (t0 - self.last_read_time > 20 or not self.devices):
             device_path = serialprobe.probe('gpsd', [4800], 4)
@@ -0,0 +1,118 @@
+/* Copyright (C) 2020 Sean D'Epagnier <seandepagnier@gmail.com>
+ *
+ * This Program is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU General Public
+ * License as published by the Free Software Foundation; either
+ * version 3 of the License, or (at your option) any later version.
+ */
+
+#include <math.h>
+
+#include "imu_math.h"
+
+// the math performed by BoatIMU.read for each imu sample after fusion
+// in a single call for efficiency, see boatimu_python in boatimu.py
+
+static void quaternion_multiply(const double *a, const double *b, double *r)
+{
+    r[0] = a[0]*b[0] - a[1]*b[1] - a[2]*b[2] - a[3]*b[3];
+    r[1] = a[0]*b[1] + a[1]*b[0] + a[2]*b[3] - a[3]*b[2];
+    r[2] = a[0]*b[2] - a[1]*b[3] + a[2]*b[0] + a[3]*b[1];
+    r[3] = a[0]*b[3] + a[1]*b[2] - a[2]*b[1] + a[3]*b[0];
+}
+
+// rotate the vector v by quaternion q
+static void rotvecquat(const double *v, const double *q, double *r)
+{
+    double w[4] = {0, v[0], v[1], v[2]}, c[4] = {q[0], -q[1], -q[2], -q[3]};
+    double t[4], s[4];
+    quaternion_multiply(q, w, t);
+    quaternion_multiply(t, c, s);
+    r[0] = s[1], r[1] = s[2], r[2] = s[3];
+}
+
+static double degrees(double x)
+{
+    return x * (180.0 / M_PI);
+}
+
+static double heading_filter(double lp, double a, double b)
+{
+    if(!a)
+        return b;
+    if(!b)
+        return a;
+    if(a - b > 180)
+        a -= 360;
+    else if(b - a > 180)
+        b -= 360;
+    double result = lp*a + (1-lp)*b;
+    if(result < 0)
+        result += 360;
+    return result;
+}
+
+std::vector<double> boatimu_compute(const std::vector<double> &fusionQPose,
+                                    const std::vector<double> &gyro,
+                                    const std::vector<double> &alignmentQ,
+                                    double timestamp, double lasttimestamp,
+                                    double last_headingrate, double heel,
+                                    double heading_lowpass, double headingrate_lowpass,
+                                    double headingraterate_lowpass,
+                                    double heading_lowpass_constant,
+                                    double headingrate_lowpass_constant,
+                                    double headingraterate_lowpass_constant)
+{
+    if(fusionQPose.size() < 4 || gyro.size() < 3 || alignmentQ.size() < 4)
+        return std::vector<double>();
+    std::vector<double> r(BOATIMU_COMPUTE_SIZE);
+
+    const double *q = fusionQPose.data();
+
+    // gyro rates in the earth frame
+    double gyro_q[3];
+    rotvecquat(gyro.data(), q, gyro_q);
+    r[PITCHRATE] = degrees(gyro_q[0]);
+    r[ROLLRATE] = degrees(gyro_q[1]);
+    r[HEADINGRATE] = degrees(gyro_q[2]);
+
+    // apply alignment calibration
+    double aligned[4];
+    quaternion_multiply(q, alignmentQ.data(), aligned);
+    double d = sqrt(aligned[0]*aligned[0] + aligned[1]*aligned[1] +
+                    aligned[2]*aligned[2] + aligned[3]*aligned[3]);
+    for(int i=0; i<4; i++)
+        aligned[i] /= d;
+
+    r[ROLL] = degrees(atan2(2.0 * (aligned[2] * aligned[3] + aligned[0] * aligned[1]),
+                            1 - 2.0 * (aligned[1] * aligned[1] + aligned[2] * aligned[2])));
+    double s = 2.0 * (aligned[0] * aligned[2] - aligned[1] * aligned[3]);
+    r[PITCH] = degrees(asin(fmin(fmax(s, -1), 1)));
+    r[HEADING] = degrees(atan2(2.0 * (aligned[1] * aligned[2] + aligned[0] * aligned[3]),
+                               1 - 2.0 * (aligned[2] * aligned[2] + aligned[3] * aligned[3])));
+    if(r[HEADING] < 0)
+        r[HEADING] += 360;
+
+    double dt = timestamp - lasttimestamp;
+    if(dt > .01 && dt < .2)
+        r[HEADINGRATERATE] = (r[HEADINGRATE] - last_headingrate) / dt;
+    else
+        r[HEADINGRATERATE] = 0;
+
+    r[HEEL] = r[ROLL]*.03 + heel*.97;
+
+    r[GYRO_X] = degrees(gyro[0]);
+    r[GYRO_Y] = degrees(gyro[1]);
+    r[GYRO_Z] = degrees(gyro[2]);
+
+    // lowpass heading and rate
+    r[HEADING_LOWPASS] = heading_filter(heading_lowpass_constant, r[HEADING], heading_lowpass);
+    double llp = headingrate_lowpass_constant;
+    r[HEADINGRATE_LOWPASS] = llp*r[HEADINGRATE] + (1-llp)*headingrate_lowpass;
+    llp = headingraterate_lowpass_constant;
+    r[HEADINGRATERATE_LOWPASS] = llp*r[HEADINGRATERATE] + (1-llp)*headingraterate_lowpass;
+
+    for(int i=0; i<4; i++)
+        r[ALIGNED_W+i] = aligned[i];
+    return r;
+}
@@ -0,0 +1,25 @@
+/* Copyright (C) 2020 Sean D'Epagnier <seandepagnier@gmail.com>
+ *
+ * This Program is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU General Public
+ * License as published by the Free Software Foundation; either
+ * version 3 of the License, or (at your option) any later version.
+ */
+
+#include <vector>
+
+// indexes of the values returned by boatimu_compute
+enum {PITCHRATE, ROLLRATE, HEADINGRATE, ROLL, PITCH, HEADING, HEADINGRATERATE, HEEL,
+      GYRO_X, GYRO_Y, GYRO_Z, HEADING_LOWPASS, HEADINGRATE_LOWPASS, HEADINGRATERATE_LOWPASS,
+      ALIGNED_W, ALIGNED_X, ALIGNED_Y, ALIGNED_Z, BOATIMU_COMPUTE_SIZE};
+
+std::vector<double> boatimu_compute(const std::vector<double> &fusionQPose,
+                                    const std::vector<double> &gyro,
+                                    const std::vector<double> &alignmentQ,
+                                    double timestamp, double lasttimestamp,
+                                    double last_headingrate, double heel,
+                                    double heading_lowpass, double headingrate_lowpass,
+                                    double headingraterate_lowpass,
+                                    double heading_lowpass_constant,
+                                    double headingrate_lowpass_constant,
+                                    double headingraterate_lowpass_constant);
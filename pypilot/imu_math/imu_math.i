@@ -0,0 +1,22 @@
+/* File: imu_math.i */
+%module imu_math
+
+%{
+#include "imu_math.h"
+%}
+
+%include "std_vector.i"
+namespace std {
+    %template(DoubleVector) vector<double>;
+};
+
+std::vector<double> boatimu_compute(const std::vector<double> &fusionQPose,
+                                    const std::vector<double> &gyro,
+                                    const std::vector<double> &alignmentQ,
+                                    double timestamp, double lasttimestamp,
+                                    double last_headingrate, double heel,
+                                    double heading_lowpass, double headingrate_lowpass,
+                                    double headingraterate_lowpass,
+                                    double heading_lowpass_constant,
+                                    double headingrate_lowpass_constant,
+                                    double headingraterate_lowpass_constant);
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# replay imu data recorded with: pypilot_boatimu --record file
+# in place of the RTIMU library so that BoatIMU and the calibration
+# can be tested and benchmarked without imu hardware
+
+import os, sys, time, math
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import pyjson
+
+def load_recording(filename):
+    if filename.endswith('.bin'): # imu flight recorder dump
+        from boatimu import load_flight_recorder
+        return load_flight_recorder(filename)
+
+    samples = []
+    f = open(filename)
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                samples.append(pyjson.loads(line))
+            except Exception as e:
+                print('imureplay skipping invalid line', e)
+    f.close()
+    return samples
+
+# stores the settings assigned by IMU.setup, the same as RTIMU.Settings
+class ReplaySettings(object):
+    def __init__(self, name):
+        self.name = name
+
+# emulates the methods of RTIMU.RTIMU used by boatimu
+class ReplayRTIMU(object):
+    def __init__(self, settings, samples, realtime=True, loop=True):
+        self.settings = settings
+        self.samples = samples
+        self.realtime = realtime
+        self.loop = loop
+        self.index = -1
+        self.starttime = False
+
+    def IMUName(self):
+        if not self.samples:
+            return 'Null IMU'
+        return 'Replay IMU'
+
+    def IMUInit(self):
+        self.index = -1
+        self.starttime = False
+        return True
+
+    def setSlerpPower(self, power):
+        pass
+
+    def setGyroEnable(self, enable):
+        pass
+
+    def setAccelEnable(self, enable):
+        pass
+
+    def setCompassEnable(self, enable):
+        pass
+
+    def resetFusion(self):
+        pass
+
+    # advance to the next sample, or in realtime to the newest sample
+    # which was due based on the recorded timestamps
+    def IMURead(self):
+        if self.index + 1 >= len(self.samples):
+            if not self.loop:
+                return False
+            self.index = -1
+            self.starttime = False
+
+        if not self.realtime:
+            self.index += 1
+            return True
+
+        t = time.monotonic()
+        if self.starttime is False:
+            self.starttime = t - self.samples[0]['timestamp']
+            self.index = 0
+            return True
+
+        index = self.index
+        while index + 1 < len(self.samples) and \
+              self.samples[index + 1]['timestamp'] + self.starttime <= t:
+            index += 1
+        if index == self.index:
+            return False
+        self.index = index
+        return True
+
+    def getIMUData(self):
+        data = dict(self.samples[self.index])
+        if 'accel.residuals' in data:
+            del data['accel.residuals']
+        return data
+
+    def getAccelResiduals(self):
+        data = self.samples[self.index]
+        if 'accel.residuals' in data:
+            return data['accel.residuals']
+        return [0, 0, 0]
+
+# pass to BoatIMU or IMU as the driver in place of the RTIMU module
+class ReplayDriver(object):
+    def __init__(self, filename, realtime=True, loop=True):
+        self.samples = load_recording(filename)
+        self.realtime = realtime
+        self.loop = loop
+        print('imureplay loaded', len(self.samples), 'samples from', filename)
+
+    def Settings(self, name):
+        return ReplaySettings(name)
+
+    def RTIMU(self, settings):
+        return ReplayRTIMU(settings, self.samples, self.realtime, self.loop)
+
+def benchmark_boatimu(filename):
+    from server import pypilotServer
+    from client import pypilotClient
+    from boatimu import BoatIMU
+
+    server = pypilotServer()
+    server.multiprocessing = False # read the imu in this process
+    client = pypilotClient(server)
+    driver = ReplayDriver(filename, realtime=False, loop=False)
+    boatimu = BoatIMU(client, driver)
+
+    count = 0
+    t0 = time.monotonic()
+    for i in range(len(driver.samples)):
+        if boatimu.read():
+            count += 1
+        if i % 100 == 0:
+            server.poll()
+            client.poll()
+    t1 = time.monotonic()
+    if count:
+        print('BoatIMU.read', count, 'samples in %.3f seconds, %.1f us per sample' % (t1-t0, (t1-t0)*1e6/count))
+
+# compare the compiled imu math with the python implementation
+def benchmark_imu_math(filename):
+    import boatimu
+    samples = load_recording(filename)
+    compute = [('python', boatimu.boatimu_python)]
+    if boatimu.boatimu_compute != boatimu.boatimu_python:
+        compute.append(('compiled', boatimu.boatimu_compute))
+
+    results = {}
+    for name, boatimu_compute in compute:
+        r = [0]*14
+        lasttimestamp, result = 0, []
+        t0 = time.monotonic()
+        for data in samples:
+            r = boatimu_compute(data['fusionQPose'], data['gyro'], [1, 0, 0, 0],
+                                data['timestamp'], lasttimestamp, r[2], r[7],
+                                r[11], r[12], r[13], .2, .2, .1)
+            lasttimestamp = data['timestamp']
+            result.append(r)
+        t1 = time.monotonic()
+        results[name] = result
+        print('imu math', name, '%.2f us per sample' % ((t1-t0)*1e6/len(samples)))
+
+    if 'compiled' in results:
+        maxerr = 0
+        for a, b in zip(results['python'], results['compiled']):
+            maxerr = max(maxerr, max(map(lambda x, y : abs(x - y), a, b)))
+        print('imu math maximum difference', maxerr)
+
+def benchmark_calibration(filename):
+    import calibration_fit, quaternion
+
+    def debug(*args):
+        print(*args)
+
+    samples = load_recording(filename)
+    accel_points = calibration_fit.SigmaPoints(.05**2, 12, 10)
+    compass_points = calibration_fit.SigmaPoints(1.1**2, 24, 3)
+
+    t0 = time.monotonic()
+    for data in samples:
+        accel_points.AddPoint(list(data['accel']))
+        down = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(data['fusionQPose']))
+        compass_points.AddPoint(list(data['compass']), down)
+    t1 = time.monotonic()
+    print('sigma points', len(samples), 'samples in %.3f seconds' % (t1-t0))
+
+    accel_fit = calibration_fit.FitAccel(debug, accel_points)
+    t2 = time.monotonic()
+    print('accel fit %.3f seconds' % (t2-t1), accel_fit)
+
+    compass_fit = calibration_fit.FitCompass(debug, compass_points, [0, 0, 0, 30, 0], [0, 0, 1])
+    t3 = time.monotonic()
+    print('compass fit %.3f seconds' % (t3-t2), compass_fit)
+
+# original per point implementations of ComputeCoverage and ComputeDeviation
+# used to verify the vectorized versions produce the same results
+def reference_coverage(p, bias, norm):
+    import quaternion, vector
+    from resolv import resolv
+    q = quaternion.vec2vec2quat(norm, [0, 0, 1])
+    def ang(p):
+        c = quaternion.rotvecquat(vector.sub(p[:3], bias), q)
+        d = quaternion.rotvecquat(p[3:6], q)
+        v = quaternion.rotvecquat(c, quaternion.vec2vec2quat(d, [0, 0, 1]))
+        v = vector.normalize(v)
+        return math.degrees(math.atan2(v[1], v[0]))
+
+    spacing = 20
+    angles = [False] * int(360 / spacing)
+    count = 0
+    for a in map(ang, p):
+        i = int(resolv(a, 180) / spacing)
+        if not angles[i]:
+            angles[i] = True
+            count += 1
+    return count
+
+def reference_deviation(points, fit):
+    import vector
+    m, d  = 0, 0
+    for p in points:
+        v = vector.sub(p[:3], fit[:3])
+        m += (1 - vector.dot(v, v) / fit[3]**2)**2
+
+        if len(fit) > 4:
+            n = vector.dot(v, p[3:]) / vector.norm(v)
+            if abs(n) <= 1:
+                ang = math.degrees(math.asin(n))
+                d += (fit[4] - ang)**2
+            else:
+                d += 1e111
+    m /= len(points)
+    d /= len(points)
+    return [m**.5, d**.5]
+
+# relative difference allowed between the python and numpy deviation
+fit_metrics_tolerance = 1e-9
+
+def benchmark_fit_metrics(filename):
+    import calibration_fit, quaternion
+    samples = load_recording(filename)
+    points = []
+    for data in samples:
+        down = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(data['fusionQPose']))
+        points.append(list(data['compass']) + down)
+
+    # a few plausible calibrations and alignments to compare with
+    fits = [[0, 0, 0, 30, 0], [10, -5, 3, 40, 60], [12, -3, 0, 38, 55]]
+    norms = [[0, 0, 1], quaternion.rotvecquat([0, 0, 1], quaternion.angvec2quat(.2, [1, 0, 0]))]
+    maxerr, mismatch = 0, 0
+    for fit in fits:
+        for norm in norms:
+            a = reference_coverage(points, fit[:3], norm)
+            b = calibration_fit.ComputeCoverage(points, fit[:3], norm)
+            if a != b:
+                print('fit metrics coverage mismatch', fit, norm, a, b)
+                mismatch += 1
+        a = reference_deviation(points, fit)
+        b = calibration_fit.ComputeDeviation(points, fit)
+        err = max(map(lambda x, y : abs(x - y)/max(abs(x), 1e-9), a, b))
+        if err > fit_metrics_tolerance:
+            print('fit metrics deviation mismatch', fit, a, b)
+            mismatch += 1
+        maxerr = max(maxerr, err)
+    print('fit metrics mismatches', mismatch, 'deviation maximum relative difference', maxerr)
+    if mismatch:
+        exit(1)
+
+    fit, norm = fits[1], norms[0]
+    for name, coverage, deviation in [('python', reference_coverage, reference_deviation),
+                                      ('numpy', calibration_fit.ComputeCoverage, calibration_fit.ComputeDeviation)]:
+        t0 = time.monotonic()
+        coverage(points, fit[:3], norm)
+        t1 = time.monotonic()
+        deviation(points, fit)
+        t2 = time.monotonic()
+        print('fit metrics', name, len(points), 'points coverage %.2f ms deviation %.2f ms' % ((t1-t0)*1e3, (t2-t1)*1e3))
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: imureplay.py recording [--boatimu] [--math] [--calibration] [--metrics]')
+        exit(1)
+    filename = sys.argv[1]
+    everything = not '--boatimu' in sys.argv and not '--math' in sys.argv and \
+        not '--calibration' in sys.argv and not '--metrics' in sys.argv
+    if everything or '--math' in sys.argv:
+        benchmark_imu_math(filename)
+    if everything or '--calibration' in sys.argv:
+        benchmark_calibration(filename)
+    if everything or '--metrics' in sys.argv:
+        benchmark_fit_metrics(filename)
+    if everything or '--boatimu' in sys.argv:
+        benchmark_boatimu(filename)
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,8 @@
 #include <unistd.h>
 #include <string.h>
 
+#include <string>
+
 #include "linebuffer.h"
 
 // implement line buffering and
@@ -20,6 +22,15 @@ LineBuffer::LineBuffer(int _fd)
     : fd(_fd)
 {
     pos = len = b = 0;
+    ndropped = 0;
+}
+
+// number of lines dropped since the last call
+int LineBuffer::dropped()
+{
+    int ret = ndropped;
+    ndropped = 0;
+    return ret;
 }
 
 const char *LineBuffer::line()
@@ -41,6 +52,7 @@ bool LineBuffer::recv()
     if(len == sizeof buf[0]) {
         printf("linebuffer overflow!!!!\n");
         len = 0;
+        ndropped++;
     }
     int c = read(fd, buf[b] + len, sizeof buf[0] - len);
     if(c <= 0)
@@ -81,6 +93,38 @@ static bool check_nmea_cksum(char *buf, int len)
     return cksum == nmea_cksum(buf+1, len-4);
 }
 
+// assemble newline separated sentences into one output block with
+// checksums and line endings, complete sentences starting with $ or !
+// are passed through unchanged
+const char *nmea_block(const char *sentences)
+{
+    static std::string block;
+    static const char hex[] = "0123456789ABCDEF";
+    block.clear();
+    const char *s = sentences;
+    while(*s) {
+        const char *end = strchr(s, '\n');
+        int len = end ? end - s : strlen(s);
+        if(len) {
+            if(s[0] == '$' || s[0] == '!')
+                block.append(s, len);
+            else {
+                int cksum = nmea_cksum(s, len);
+                block += '$';
+                block.append(s, len);
+                block += '*';
+                block += hex[(cksum >> 4) & 15];
+                block += hex[cksum & 15];
+            }
+            block += "\r\n";
+        }
+        if(!end)
+            break;
+        s = end + 1;
+    }
+    return block.c_str();
+}
+
 // return true if a valid nmea line is in buf[!b]
 bool LineBuffer::readline_buf_nmea()
 {
@@ -95,6 +139,7 @@ bool LineBuffer::readline_buf_nmea()
         buf[!b][len] = 0;
         if(check_nmea_cksum(buf[!b], len))
             return true;
+        ndropped++;
     }
     return false;
 }
@@ -15,6 +15,7 @@ public:
     bool recv();
 
     const char *readline_nmea();
+    int dropped();
 private:
     bool next_nmea();
 #if 0    
@@ -26,5 +27,8 @@ private:
 
     int fd;
     int b, pos, len;
+    int ndropped; // lines discarded for checksum or overflow
     char buf[2][16384];
 };
+
+const char *nmea_block(const char *sentences);
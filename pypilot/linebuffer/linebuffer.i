@@ -13,4 +13,7 @@ public:
     const char *line_nmea();
     bool recv();
     const char *readline_nmea();
+    int dropped();
 };
+
+const char *nmea_block(const char *sentences);
@@ -22,7 +22,7 @@
 
 DEFAULT_PORT = 20220
 
-import sys, select, time, socket
+import os, sys, select, time, socket, errno, threading
 import multiprocessing
 import serial
 from client import pypilotClient
@@ -31,6 +31,7 @@ from nonblockingpipe import NonBlockingPipe
 from bufferedsocket import LineBufferedNonBlockingSocket
 from sensors import source_priority
 import serialprobe
+from nmeareplay import NMEARecorder
 
 import fcntl
 # these are not defined in python module
@@ -50,96 +51,11 @@ def check_nmea_cksum(line):
     except:
         return False
 
-    
-def parse_nmea_gps(line):
-    def degrees_minutes_to_decimal(n):
-        n/=100
-        degrees = int(n)
-        minutes = n - degrees
-        return degrees + minutes*10/6
-
-    if line[3:6] != 'RMC':
-        return False
-
-    try:
-        data = line[7:len(line)-3].split(',')
-        if data[1] == 'V':
-            return False
-        gps = {}
-
-        timestamp = float(data[0])
-
-        lat = degrees_minutes_to_decimal(float(data[2]))
-        if data[3] == 'S':
-            lat = -lat
-
-        lon = degrees_minutes_to_decimal(float(data[4]))
-        if data[5] == 'W':
-            lon = -lon
-
-        speed = float(data[6]) if data[6] else 0
-        gps = {'timestamp': timestamp, 'speed': speed, 'lat': lat, 'lon': lon}
-        if data[7]:
-            gps['track'] = float(data[7])
-
-    except Exception as e:
-        print('nmea failed to parse gps', line, e)
-        return False
-
-    return 'gps', gps
-
-
-'''
-   ** MWV - Wind Speed and Angle
-   **
-   **
-   **
-   ** $--MWV,x.x,a,x.x,a*hh<CR><LF>**
-   ** Field Number:
-   **  1) Wind Angle, 0 to 360 degrees
-   **  2) Reference, R = Relative, T = True
-   **  3) Wind Speed
-   **  4) Wind Speed Units, K/M/N
-   **  5) Status, A = Data Valid
-   **  6) Checksum
-'''
-def parse_nmea_wind(line):
-    if line[3:6] != 'MWV':
-        return False
-
-    data = line.split(',')
-    msg = {}
-    try:
-        msg['direction'] = float(data[1])
-    except:
-        return False  # require direction
-
-    try:
-        speed = float(data[3])
-        speedunit = data[4]
-        if speedunit == 'K': # km/h
-            speed *= .53995
-        elif speedunit == 'M': # m/s
-            speed *= 1.94384
-        msg['speed'] = speed
-    except Exception as e:
-        print('nmea failed to parse wind', line, e)
-        return False
-        
-    return 'wind', msg
-
-def parse_nmea_rudder(line):
-    if line[3:6] != 'RSA':
-        return False
-
-    data = line.split(',')
-    try:
-        angle = float(data[1])
-    except:
-        angle = False
-
-    return 'rudder', {'angle': angle}
-
+def degrees_minutes_to_decimal(n):
+    n/=100
+    degrees = int(n)
+    minutes = n - degrees
+    return degrees + minutes*10/6
 
 def parse_nmea_apb(line):
     # also allow ap commands (should we allow via serial too??)
@@ -192,7 +108,128 @@ def parse_nmea_apb(line):
         print('exception parsing apb', e, line)
         return False
 
-nmea_parsers = {'gps': parse_nmea_gps, 'wind': parse_nmea_wind, 'rudder': parse_nmea_rudder, 'apb': parse_nmea_apb}
+# xdr transducer measurements by type and name
+xdr_transducers = {('A', 'PTCH'): 'pitch', ('A', 'PITCH'): 'pitch', ('A', 'ROLL'): 'roll'}
+xdr_units = {('C', 'C'): ('temperature', 1), ('P', 'B'): ('pressure', 1), ('P', 'P'): ('pressure', 1e-5)}
+
+def parse_nmea_xdr(line):
+    f = line[7:line.rfind('*')].split(',')
+    msg = {}
+    # repeated groups of type, value, units, name
+    for i in range(0, len(f) - 3, 4):
+        try:
+            value = float(f[i+1])
+        except ValueError:
+            continue
+        if (f[i], f[i+3]) in xdr_transducers:
+            msg[xdr_transducers[(f[i], f[i+3])]] = value
+        elif (f[i], f[i+2]) in xdr_units:
+            name, scale = xdr_units[(f[i], f[i+2])]
+            msg[name] = value*scale
+    return msg and ('transducers', msg)
+
+# declarative table of the sentences parsed, keyed by sentence id
+#  sensor   the sensor the parsed data is written to
+#  invalid  (field, value) pairs which mark the sentence invalid
+#  fields   data keys parsed, where index counts the fields after the sentence id
+#           units:  (field, scales) scale by the unit letter in another field
+#           sign:   (field, letter) negate if the other field is this letter
+#           latlon: field of the hemisphere, value is degrees and minutes
+#           required: discard the sentence without this field
+#           default:  value used if the field is empty or invalid
+#  parser   function used in place of fields
+knots = {'N': 1, 'K': .53995, 'M': 1.94384} # from knots, km/h, m/s
+
+nmea_sentence_table = {
+    'RMC': {'sensor': 'gps', 'invalid': [(2, 'V')],
+            'fields': [{'key': 'timestamp', 'index': 1, 'required': True},
+                       {'key': 'lat', 'index': 3, 'latlon': 4, 'required': True},
+                       {'key': 'lon', 'index': 5, 'latlon': 6, 'required': True},
+                       {'key': 'speed', 'index': 7, 'default': 0},
+                       {'key': 'track', 'index': 8}]},
+    'GGA': {'sensor': 'gps', 'invalid': [(6, '0')],
+            'fields': [{'key': 'lat', 'index': 2, 'latlon': 3, 'required': True},
+                       {'key': 'lon', 'index': 4, 'latlon': 5, 'required': True}]},
+    'VTG': {'sensor': 'gps', 'invalid': [(9, 'N')],
+            'fields': [{'key': 'track', 'index': 1},
+                       {'key': 'speed', 'index': 5, 'units': (6, knots), 'required': True}]},
+    'MWV': {'sensor': 'wind',
+            'fields': [{'key': 'direction', 'index': 1, 'required': True},
+                       {'key': 'speed', 'index': 3, 'units': (4, knots), 'required': True}]},
+    'RSA': {'sensor': 'rudder',
+            'fields': [{'key': 'angle', 'index': 1, 'default': False}]},
+    'APB': {'sensor': 'apb', 'parser': parse_nmea_apb},
+    'HDG': {'sensor': 'heading',
+            'fields': [{'key': 'heading', 'index': 1, 'required': True},
+                       {'key': 'deviation', 'index': 2, 'sign': (3, 'W')},
+                       {'key': 'variation', 'index': 4, 'sign': (5, 'W')}]},
+    'HDT': {'sensor': 'heading',
+            'fields': [{'key': 'true', 'index': 1, 'required': True}]},
+    'VHW': {'sensor': 'water',
+            'fields': [{'key': 'speed', 'index': 5, 'units': (6, knots), 'required': True}]},
+    'XDR': {'sensor': 'transducers', 'parser': parse_nmea_xdr}}
+
+# compile a field definition into a function of the split sentence
+def compile_nmea_field(field):
+    index = field['index']
+    if 'latlon' in field:
+        hemisphere = field['latlon']
+        def value(f):
+            v = degrees_minutes_to_decimal(float(f[index]))
+            return -v if f[hemisphere] in ['S', 'W'] else v
+    elif 'units' in field:
+        unit, scales = field['units']
+        def value(f):
+            return float(f[index]) * scales[f[unit]] if f[unit] else float(f[index])
+    elif 'sign' in field:
+        sign, letter = field['sign']
+        def value(f):
+            return -float(f[index]) if f[sign] == letter else float(f[index])
+    else:
+        def value(f):
+            return float(f[index])
+    return value
+
+def compile_nmea_sentence(sensor, definition):
+    if 'parser' in definition:
+        return definition['parser']
+
+    invalid = definition.get('invalid', [])
+    fields = []
+    for field in definition['fields']:
+        fields.append((field['key'], compile_nmea_field(field),
+                       'required' in field, 'default' in field, field.get('default')))
+
+    def parse(line):
+        f = line[:line.rfind('*')].split(',')
+        for index, value in invalid:
+            if index < len(f) and f[index] == value:
+                return False
+        msg = {}
+        for key, value, required, has_default, default in fields:
+            try:
+                msg[key] = value(f)
+            except (ValueError, IndexError, KeyError):
+                if required:
+                    return False
+                if has_default:
+                    msg[key] = default
+        return sensor, msg
+    return parse
+
+# sentence id: (sensor, parser function)
+nmea_sentences = {}
+for sentence, definition in nmea_sentence_table.items():
+    nmea_sentences[sentence] = definition['sensor'], compile_nmea_sentence(definition['sensor'], definition)
+nmea_sensors = set(map(lambda definition : definition['sensor'], nmea_sentence_table.values()))
+
+# build a table of parsers by sentence id for the sensors accepted
+def nmea_dispatch(accept):
+    dispatch = {}
+    for sentence, (name, parser) in nmea_sentences.items():
+        if accept(name):
+            dispatch[sentence] = parser
+    return dispatch
 
 from pypilot.linebuffer import linebuffer
 class NMEASerialDevice(object):
@@ -206,18 +243,226 @@ class NMEASerialDevice(object):
     def readline(self):
         return self.b.readline_nmea()
 
+    # read all available data and return the complete sentences
+    def readlines(self):
+        self.b.recv()
+        lines = []
+        while True:
+            line = self.b.line_nmea()
+            if not line:
+                return lines
+            lines.append(line)
+
     def close(self):
         self.device.close()
 
+# probe all candidate serial devices at the same time, each device
+# tries its baud rates in turn until a valid nmea sentence is received
+class NMEASerialProbe(object):
+    def __init__(self, bauds=[38400, 4800], timeout=5, retry=20):
+        self.bauds = bauds
+        self.timeout = timeout # seconds at each baud
+        self.retry = retry # seconds before probing a device which failed again
+        self.probing = {} # device path: [NMEASerialDevice or False, bauds remaining, time, time added]
+        self.retry_time = {} # device path: time, time added
+        self.scan_time = 0
+
+    def open(self, path, t):
+        probe = self.probing[path]
+        probe[0] = False
+        while probe[1]:
+            try:
+                probe[0] = NMEASerialDevice((path, probe[1][0]))
+                probe[2] = t
+                return True
+            except Exception as e:
+                print('failed to open', path, probe[1][0], 'for nmea data', e)
+                probe[1] = probe[1][1:]
+        return False
+
+    def fail(self, path, t):
+        self.retry_time[path] = t + self.retry, self.probing[path][3]
+        del self.probing[path]
+        serialprobe.release(path)
+
+    # true if the device was removed, even if the path exists again
+    def removed(self, path):
+        return not path in serialprobe.devices or \
+            serialprobe.devices[path]['time'] != self.probing[path][3]
+
+    def poll(self):
+        t = time.monotonic()
+        # probe new devices immediately, otherwise check retries each second
+        if serialprobe.enumerate_devices() or t - self.scan_time > 1:
+            self.scan_time = t
+            for path in list(self.probing):
+                if self.removed(path):
+                    if self.probing[path][0]:
+                        self.probing[path][0].close()
+                    del self.probing[path]
+
+            for path, bauds in serialprobe.candidates('nmea', self.bauds):
+                added = serialprobe.devices[path]['time']
+                retry = self.retry_time.get(path)
+                if path in self.probing or (retry and retry[0] > t and retry[1] == added):
+                    continue
+                serialprobe.reserve('nmea', path)
+                self.probing[path] = [False, bauds, t, added]
+                if not self.open(path, t):
+                    self.fail(path, t)
+
+        found = []
+        for path in list(self.probing):
+            device, bauds, start, added = self.probing[path]
+            if device.readline():
+                print('nmea probe', device.path)
+                del self.probing[path] # stays reserved while in use
+                found.append(device)
+            elif t - start > self.timeout:
+                device.close()
+                self.probing[path][1] = bauds[1:]
+                if not self.open(path, t):
+                    self.fail(path, t)
+        return found
+
+# statistics for each serial device published once per second
+class NMEADeviceStats(object):
+    def __init__(self, client, index):
+        name = 'nmea.serial%d.' % index
+        self.device = client.register(StringValue(name + 'device', ''))
+        self.rate = client.register(SensorValue(name + 'rate', 0, fmt='%.1f'))
+        self.parse_time = client.register(SensorValue(name + 'parse_time', 0, fmt='%.6f'))
+        self.dropped = client.register(Value(name + 'dropped', 0))
+        # seconds from the device appearing to its first valid sentence
+        self.first_sentence = client.register(SensorValue(name + 'first_sentence', 0, fmt='%.3f'))
+        self.reset(False)
+
+    def reset(self, path):
+        self.device.set(path[0] if path else '')
+        self.rate.set(0)
+        self.parse_time.set(0)
+        self.dropped.set(0)
+        self.lines = 0
+        self.time = 0
+        self.last_update = time.monotonic()
+
+    def update(self, device):
+        t = time.monotonic()
+        dt = t - self.last_update
+        if dt < 1:
+            return
+        self.rate.set(self.lines / dt)
+        self.parse_time.set(self.time / self.lines if self.lines else 0)
+        dropped = device.b.dropped()
+        if dropped:
+            self.dropped.set(self.dropped.value + dropped)
+        self.lines = 0
+        self.time = 0
+        self.last_update = t
+
+# sentences relayed to a tcp client, given as space separated fields:
+#   allow=HDM,XDR     only these sentence ids
+#   deny=GSV,GSA      all sentence ids except these
+#   rate=HDM:2,XDR:1  maximum rate in hz for each sentence id
+# clients may send $PPYPF,<filter> to set their own filter, or
+# the filter can be configured for each port with nmea.ports
+class NMEAFilter(object):
+    def __init__(self, spec=''):
+        self.spec = spec
+        self.allow = self.deny = False
+        self.period = {}
+        self.times = {}
+        for field in spec.split():
+            try:
+                name, value = field.split('=')
+                ids = value.split(',')
+                if name == 'allow':
+                    self.allow = ids
+                elif name == 'deny':
+                    self.deny = ids
+                elif name == 'rate':
+                    for id_rate in ids:
+                        sentence, rate = id_rate.split(':')
+                        self.period[sentence] = 1/float(rate)
+                else:
+                    raise ValueError('unknown field ' + name)
+            except Exception as e:
+                print('nmea invalid filter', field, e)
+        self.all = not (self.allow or self.deny or self.period)
+
+    def accept(self, sentence, t):
+        if self.allow and not sentence in self.allow:
+            return False
+        if self.deny and sentence in self.deny:
+            return False
+        if sentence in self.period:
+            if sentence in self.times and t - self.times[sentence] < self.period[sentence]:
+                return False
+            self.times[sentence] = t
+        return True
+
+nmea_socket_max_buffer = 65536
+nmea_client_stable_time = 30 # seconds connected without data before failures reset
+
 nmeasocketuid = 0
 class NMEASocket(LineBufferedNonBlockingSocket):
-    def __init__(self, connection, address):
+    def __init__(self, connection, address, spec=''):
         super(NMEASocket, self).__init__(connection, address)
 
         global nmeasocketuid
         self.uid = nmeasocketuid
         nmeasocketuid += 1
-        
+
+        self.filter = NMEAFilter(spec)
+        # encoded sentences are shared between sockets
+        self.out_chunks = []
+        self.out_size = 0
+        self.partial = b'' # rest of a partly sent chunk, never dropped
+        self.dropped = 0 # since the bridge last published it
+        self.overflow = False
+        self.index = 0 # slot for published stats
+
+    def write(self, data):
+        self.out_chunks.append(data)
+        self.out_size += len(data)
+        if self.out_size > nmea_socket_max_buffer:
+            # slow client, drop the oldest sentences rather than everything
+            if not self.overflow:
+                print('nmea socket overflow, dropping sentences', self.address)
+                self.overflow = True
+            while self.out_size > nmea_socket_max_buffer/2 and len(self.out_chunks) > 1:
+                chunk = self.out_chunks.pop(0)
+                self.out_size -= len(chunk)
+                self.dropped += chunk.count(b'\n') # each chunk is a block of sentences
+
+    def flush(self):
+        if not (self.partial or self.out_chunks) or not self.socket:
+            return
+        try:
+            count = self.socket.send(self.partial + b''.join(self.out_chunks))
+        except BlockingIOError:
+            count = 0
+        except Exception as e:
+            print('nmea socket exception', self.address, e)
+            self.close()
+            return
+
+        if count < len(self.partial):
+            self.partial = self.partial[count:]
+            return
+        count -= len(self.partial)
+        self.partial = b''
+        while self.out_chunks and count >= len(self.out_chunks[0]):
+            chunk = self.out_chunks.pop(0)
+            count -= len(chunk)
+            self.out_size -= len(chunk)
+        if count: # keep the unsent part of this chunk whole
+            chunk = self.out_chunks.pop(0)
+            self.out_size -= len(chunk)
+            self.partial = chunk[count:]
+        if not self.out_chunks:
+            self.overflow = False
+
     def readline(self):
         if self.b: # optimized version in c
             return self.b.readline_nmea()
@@ -247,22 +492,31 @@ class Nmea(object):
         self.device_fd = {}
 
         self.nmea_times = {}
-        self.last_imu_time = time.monotonic()
-        self.last_rudder_time = time.monotonic()
+        # sentences generated for tcp output, rate=ID:hz limits each type
+        self.output = self.client.register(Property('nmea.output', 'rate=XDR:2,HDM:2,MWV:4,RSA:4', persistent=True))
+        self.output_filter = NMEAFilter(self.output.value)
+        self.output_sentences = []
 
         self.devices = []
         self.devices_lastmsg = {}
-        self.probedevice = None
-        self.probeindex = 0
+        self.device_stats = []
+        self.dispatch = {} # parsers by sentence id for each device
+        self.dispatch_state = False
+        self.probe = NMEASerialProbe()
 
         self.start_time = time.monotonic()
 
+        self.record = self.client.register(BooleanProperty('nmea.record', False))
+        self.recorder = False
+        self.replay_device = False
+        self.replay_stats = {'lines': 0, 'time': 0}
+
     def __del__(self):
         #print('terminate nmea process')
         #self.process.terminate()
         pass
 
-    def read_process_pipe(self):
+    def read_process_pipe(self, tcp_msgs):
       while True:
         msgs = self.pipe.recv()
         if not msgs:
@@ -278,13 +532,45 @@ class Nmea(object):
                 print('unhandled nmea pipe string', msgs)
         else:
             for name in msgs:
-                self.sensors.write(name, msgs[name], 'tcp')
-                
+                if name in tcp_msgs and tcp_msgs[name]['device'] == msgs[name]['device']:
+                    tcp_msgs[name].update(msgs[name])
+                else:
+                    tcp_msgs[name] = msgs[name]
+
+    def serial_dispatch(self, path):
+        if not path in self.dispatch:
+            # only process if
+            # 1) current source is lower priority
+            # 2) we do not have a source yet
+            # 3) this the correct device for this data
+            def accept(name):
+                name_device = self.sensors.sensors[name].device
+                current_source = self.sensors.sensors[name].source.value
+                return source_priority[current_source] > source_priority['serial'] or \
+                    not name_device or name_device[2:] == path
+            self.dispatch[path] = nmea_dispatch(accept)
+        return self.dispatch[path]
+
     def read_serial_device(self, device, serial_msgs):
         t = time.monotonic()
-        line = device.readline()
-        if not line:
+        lines = device.readlines()
+        if not lines:
             return
+
+        self.devices_lastmsg[device] = t
+        path = device.path[0]
+        if self.recorder:
+            self.recorder.write('serial', path, lines)
+        dispatch = self.serial_dispatch(path)
+
+        for line in lines:
+            self.read_serial_line(path, line, t, dispatch, serial_msgs)
+
+        stats = self.device_stats[self.devices.index(device)]
+        stats.lines += len(lines)
+        stats.time += time.monotonic() - t
+
+    def read_serial_line(self, path, line, t, dispatch, serial_msgs):
         if self.sockets:
             nmea_name = line[:6]
             # we output mwv and rsa messages after calibration
@@ -296,76 +582,106 @@ class Nmea(object):
 
                 dt = t-self.nmea_times[nmea_name] if nmea_name in self.nmea_times else 1
                 if dt > .25:
-                    self.pipe.send(line)
+                    self.send_nmea(line)
                     self.nmea_times[nmea_name] = t
 
-        self.devices_lastmsg[device] = t
-        parsers = []
-
-        # only process if
-        # 1) current source is lower priority
-        # 2) we do not have a source yet
-        # 3) this the correct device for this data
-        for name in nmea_parsers:
-            name_device = self.sensors.sensors[name].device
-            current_source = self.sensors.sensors[name].source.value
-            if source_priority[current_source] > source_priority['serial'] or \
-               not name_device or name_device[2:] == device.path[0]:
-                parsers.append(nmea_parsers[name])
-
         # parse the nmea line, and update serial messages
-        for parser in parsers:
-            result = parser(line)
-            if result:
-                name, msg = result
-                if name:
-                    msg['device'] = line[1:3] + device.path[0]
-                    serial_msgs[name] = msg
-                break
+        sentence = line[3:6]
+        if not sentence in dispatch:
+            return
+        result = dispatch[sentence](line)
+        if result:
+            name, msg = result
+            msg['device'] = line[1:3] + path
+            # combine sentences for the same sensor, eg: RMC, VTG and GGA
+            if name in serial_msgs and serial_msgs[name]['device'] == msg['device']:
+                serial_msgs[name].update(msg)
+            else:
+                serial_msgs[name] = msg
+
+    # feed sentences from a NMEAReplayDevice in place of serial and tcp inputs,
+    # sensors use the recording time so timeouts happen as when recorded
+    def replay(self, device):
+        self.replay_device = device
+        self.replay_dispatch = nmea_dispatch(lambda name : True)
+        self.sensors.clock = device.time
+
+    def read_replay(self, serial_msgs, tcp_msgs):
+        t = time.monotonic()
+        lines = self.replay_device.readlines()
+        for source, path, line in lines:
+            if source == 'serial':
+                self.read_serial_line(path, line, t, self.serial_dispatch(path), serial_msgs)
+            else:
+                self.read_serial_line(path, line, t, self.replay_dispatch, tcp_msgs)
+        self.replay_stats['lines'] += len(lines)
+        self.replay_stats['time'] += time.monotonic() - t
 
     def remove_serial_device(self, device):
         index = self.devices.index(device)
         print('lost serial nmea%d' % index)
         self.sensors.lostdevice(self.devices[index].path[0])
         self.devices[index] = False
+        self.device_stats[index].reset(False)
         self.poller.unregister(device.device.fileno())
         del self.devices_lastmsg[device]
         device.close()
+        serialprobe.release(device.path[0])
             
     def poll(self):
         t0 = time.monotonic()
         self.probe_serial()
 
+        if self.record.value != bool(self.recorder):
+            if self.recorder:
+                self.recorder.close()
+                self.recorder = False
+            else:
+                self.recorder = NMEARecorder()
+
         t1 = time.monotonic()
-        # handle tcp nmea messages
-        serial_msgs = {}
-        while True:
-            events = self.poller.poll(0)
-            if not events:
-                break
-            while events:
-                event = events.pop()
-                fd, flag = event
-                if fd == self.process_fd:
-                    if flag != select.POLLIN:
-                        print('nmea got flag for process pipe:', flag)
-                    else:
-                        self.read_process_pipe()
-                elif flag == select.POLLIN:
-                    #if flag & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
-                    self.read_serial_device(self.device_fd[fd], serial_msgs)
+        # handle tcp nmea messages, each device is drained of all
+        # complete sentences, so a single poll is enough
+        serial_msgs, tcp_msgs = {}, {}
+
+        # rebuild dispatch tables if a sensor source or device changed
+        state = list(map(lambda sensor : (sensor.source.value, sensor.device), self.sensors.sensors.values()))
+        if state != self.dispatch_state:
+            self.dispatch = {}
+            self.dispatch_state = state
+
+        events = self.poller.poll(0)
+        while events:
+            event = events.pop()
+            fd, flag = event
+            if fd == self.process_fd:
+                if flag != select.POLLIN:
+                    print('nmea got flag for process pipe:', flag)
                 else:
-                    self.remove_serial_device(self.device_fd[fd])
+                    self.read_process_pipe(tcp_msgs)
+                continue
+            device = self.device_fd[fd]
+            if flag & select.POLLIN:
+                self.read_serial_device(device, serial_msgs)
+            if flag & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                self.remove_serial_device(device)
 
+        if self.replay_device:
+            self.read_replay(serial_msgs, tcp_msgs)
+
+        # write each sensor at most once per source
         t2 = time.monotonic()
+        for name in tcp_msgs:
+            self.sensors.write(name, tcp_msgs[name], 'tcp')
         for name in serial_msgs:
             self.sensors.write(name, serial_msgs[name], 'serial')
         t3 = time.monotonic()
                 
-        for device in self.devices:
+        for index, device in enumerate(self.devices):
             # timeout serial devices
             if not device:
                 continue
+            self.device_stats[index].update(device)
             dt = time.monotonic() - self.devices_lastmsg[device]
             if dt > 2:
                 if dt < 2.3:
@@ -375,31 +691,33 @@ class Nmea(object):
                 self.remove_serial_device(device)
         t4 = time.monotonic()
 
-        # send imu nmea messages to sockets at 2hz
-        dt = time.monotonic() - self.last_imu_time
+        # send imu, wind and rudder nmea messages to sockets
+        if self.output.value != self.output_filter.spec:
+            self.output_filter = NMEAFilter(self.output.value)
         values = self.client.values.values
         if self.sockets:
-            if dt > .5 and 'imu.pitch' in values:
-                self.send_nmea('APXDR,A,%.3f,D,PTCH' % values['imu.pitch'].value)
-                self.send_nmea('APXDR,A,%.3f,D,ROLL' % values['imu.roll'].value)
-                self.send_nmea('APHDM,%.3f,M' % values['imu.heading_lowpass'].value)
-                self.last_imu_time = time.monotonic()
+            t = time.monotonic()
+            accept = self.output_filter.accept
+            if 'imu.pitch' in values:
+                if accept('XDR', t):
+                    self.send_nmea('APXDR,A,%.3f,D,PTCH' % values['imu.pitch'].value)
+                    self.send_nmea('APXDR,A,%.3f,D,ROLL' % values['imu.roll'].value)
+                if accept('HDM', t):
+                    self.send_nmea('APHDM,%.3f,M' % values['imu.heading_lowpass'].value)
 
             # should we output gps?  for now no
-            # limit to 4hz output of wind and rudder
-            t = time.monotonic()
-            for name in ['wind', 'rudder']:
-                dt = t - self.nmea_times[name] if name in self.nmea_times else 1
-                source = self.sensors.sensors[name].source.value
-                # only output to tcp if we have a better source
-                if dt > .25 and source_priority[source] < source_priority['tcp']:
-                    if name == 'wind':
-                        wind = self.sensors.wind
-                        self.send_nmea('APMWV,%.3f,R,%.3f,N,A' % (wind.direction.value, wind.speed.value))
-                    elif name == 'rudder':
-                        self.send_nmea('APRSA,%.3f,A,,' % self.sensors.rudder.angle.value)
-                    self.nmea_times[name] = t
-            
+            # only output wind and rudder to tcp if we have a better source
+            wind, rudder = self.sensors.wind, self.sensors.rudder
+            if source_priority[wind.source.value] < source_priority['tcp'] and accept('MWV', t):
+                self.send_nmea('APMWV,%.3f,R,%.3f,N,A' % (wind.direction.value, wind.speed.value))
+            if source_priority[rudder.source.value] < source_priority['tcp'] and accept('RSA', t):
+                self.send_nmea('APRSA,%.3f,A,,' % rudder.angle.value)
+
+        # send all sentences to the bridge as one block
+        if self.output_sentences:
+            self.pipe.send(linebuffer.nmea_block('\n'.join(self.output_sentences)))
+            self.output_sentences = []
+
         t5 = time.monotonic()
         if not self.nmea_bridge.process:
             self.nmea_bridge.poll()
@@ -409,48 +727,30 @@ class Nmea(object):
             print('nmea poll times', self.start_time-t0, t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5)
             
     def probe_serial(self):
-        # probe new nmea data devices
-        if not self.probedevice:
+        # add devices which probed with valid nmea data
+        for device in self.probe.poll():
             try:
                 index = self.devices.index(False)
             except:
                 index = len(self.devices)
-            if self.probeindex != index and \
-               (self.probeindex >= len(self.devices) or not self.devices[self.probeindex]):
-                serialprobe.relinquish('nmea%d' % self.probeindex)
-            self.probeindex = index
-
-            self.probedevicepath = serialprobe.probe('nmea%d' % self.probeindex, [38400, 4800], 8)
-            if self.probedevicepath:
-                print('nmea probe', self.probedevicepath)
-                try:
-                    self.probedevice = NMEASerialDevice(self.probedevicepath)
-                    self.probetime = time.monotonic()
-                except Exception as e: # serial.serialutil.SerialException:
-                    print('failed to open', self.probedevicepath, 'for nmea data', e)
-
-            return
-
-        # see if the probe device gets a valid nmea message
-        if self.probedevice.readline():
-            #print('nmea new device', self.probedevicepath)
-            serialprobe.success('nmea%d' % self.probeindex, self.probedevicepath)
-            if self.probeindex < len(self.devices):
-                self.devices[self.probeindex] = self.probedevice
+            serialprobe.success('nmea%d' % index, device.path)
+            if index < len(self.devices):
+                self.devices[index] = device
             else:
-                self.devices.append(self.probedevice)
-            fd = self.probedevice.device.fileno()
-            self.device_fd[fd] = self.probedevice
+                self.devices.append(device)
+                self.device_stats.append(NMEADeviceStats(self.client, index))
+            self.device_stats[index].reset(device.path)
+            if device.path[0] in serialprobe.devices:
+                added = serialprobe.devices[device.path[0]]['time']
+                self.device_stats[index].first_sentence.set(time.monotonic() - added)
+            fd = device.device.fileno()
+            self.device_fd[fd] = device
             self.poller.register(fd, select.POLLIN)
-            self.devices_lastmsg[self.probedevice] = time.monotonic()
-            self.probedevice = None
-        elif time.monotonic() - self.probetime > 5:
-            #print('nmea serial probe timeout', self.probeindex, index, self.probedevicepath)
-            self.probedevice = None # timeout
-
+            self.devices_lastmsg[device] = time.monotonic()
 
+    # queue a sentence with or without checksum for output at the end of poll
     def send_nmea(self, msg):
-        self.pipe.send(msg)
+        self.output_sentences.append(msg)
         
 class nmeaBridge(object):
     def __init__(self, server):
@@ -466,13 +766,22 @@ class nmeaBridge(object):
 
     def setup(self):
         self.sockets = []
+        self.socket_slots = [] # socket or False, index of published stats
+        self.socket_dropped = []
 
         self.nmea_client = self.client.register(Property('nmea.client', '', persistent=True))
+        self.client_state = self.client.register(StringValue('nmea.client.state', 'none'))
+        self.client_failures = self.client.register(Value('nmea.client.failures', 0))
 
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setblocking(0)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.client_socket = False
+        self.client_address = False # host:port of the outbound connection
+        self.client_connecting = False # socket while the connect is in progress
+        self.client_resolved = False # result of name resolution thread
+        self.client_retry_time = 0
+        self.client_stable = False # connection received data or stayed up
 
         port = DEFAULT_PORT
         while True:
@@ -485,11 +794,20 @@ class nmeaBridge(object):
         print('listening on port', port, 'for nmea connections')
 
         self.server.listen(5)
+        self.server_filters = {self.server: ''}
+
+        # additional ports with filters
+        self.nmea_ports = self.client.register(Property('nmea.ports', '', persistent=True))
+        self.ports = {}
 
-        self.failed_nmea_client_time = 0
-        self.last_values = {'gps.source' : 'none', 'wind.source' : 'none', 'rudder.source': 'none', 'apb.source': 'none'}
+        self.last_values = {}
+        for name in nmea_sensors:
+            self.last_values[name + '.source'] = 'none'
         for name in self.last_values:
             self.client.watch(name)
+        self.update_dispatch()
+        self.recorder = False
+        self.client.watch('nmea.record')
         self.addresses = {}
         cnt = 0
 
@@ -497,6 +815,7 @@ class nmeaBridge(object):
         
         self.poller.register(self.server, select.POLLIN)
         self.fd_to_socket = {self.server.fileno() : self.server}
+        self.setup_ports()
 
         self.poller.register(self.client.connection, select.POLLIN)
         self.fd_to_socket[self.client.connection.fileno()] = self.client
@@ -507,31 +826,72 @@ class nmeaBridge(object):
 
         self.msgs = {}
 
+    # nmea.ports is a ; separated list of port and filter, for example:
+    #   20221 allow=HDM,XDR rate=HDM:2; 20222 deny=GSV
+    def setup_ports(self):
+        self.ports_spec = self.nmea_ports.value
+        ports = {}
+        for entry in self.ports_spec.split(';'):
+            try:
+                fields = entry.strip().split(' ', 1)
+                if fields[0]:
+                    ports[int(fields[0])] = fields[1] if len(fields) > 1 else ''
+            except Exception as e:
+                print('nmea invalid port', entry, e)
+
+        for port in list(self.ports):
+            server = self.ports[port]
+            if not port in ports:
+                self.poller.unregister(server)
+                del self.fd_to_socket[server.fileno()]
+                del self.server_filters[server]
+                server.close()
+                del self.ports[port]
+
+        for port, spec in ports.items():
+            if not port in self.ports:
+                try:
+                    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    server.setblocking(0)
+                    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    server.bind(('0.0.0.0', port))
+                    server.listen(5)
+                except Exception as e:
+                    print('nmea failed to listen on port', port, e)
+                    continue
+                print('listening on port', port, 'for nmea connections with filter', spec)
+                self.ports[port] = server
+                self.poller.register(server, select.POLLIN)
+                self.fd_to_socket[server.fileno()] = server
+            self.server_filters[self.ports[port]] = spec
+
     def setup_watches(self, watch=True):
-        watchlist = ['gps.source', 'wind.source', 'rudder.source', 'apb.source']
-        for name in watchlist:
+        for name in self.last_values:
             self.client.watch(name, watch)
 
-    def receive_nmea(self, line, device):
-        parsers = []
-
-        # optimization to only to parse sentences here that would be discarded
-        # in the main process anyway because they are already handled by a source
-        # with a higher priority than tcp
+    # optimization to only to parse sentences here that would be discarded
+    # in the main process anyway because they are already handled by a source
+    # with a higher priority than tcp
+    def update_dispatch(self):
         tcp_priority = source_priority['tcp']
-        for name in nmea_parsers:
-            if source_priority[self.last_values[name + '.source']] >= tcp_priority:
-                parsers.append(nmea_parsers[name])
-
-        for parser in  parsers:
-            result = parser(line)
-            if result:
-                name, msg = result
-                msg['device'] = line[1:3] + device
+        def accept(name):
+            return source_priority[self.last_values[name + '.source']] >= tcp_priority
+        self.dispatch = nmea_dispatch(accept)
+
+    def receive_nmea(self, line, device):
+        sentence = line[3:6]
+        if not sentence in self.dispatch:
+            return
+        result = self.dispatch[sentence](line)
+        if result:
+            name, msg = result
+            msg['device'] = line[1:3] + device
+            if name in self.msgs and self.msgs[name]['device'] == msg['device']:
+                self.msgs[name].update(msg)
+            else:
                 self.msgs[name] = msg
-                return
 
-    def new_socket_connection(self, connection, address):
+    def new_socket_connection(self, connection, address, spec=''):
         max_connections = 10
         if len(self.sockets) == max_connections:
             connection.close()
@@ -542,8 +902,16 @@ class nmeaBridge(object):
             self.setup_watches()
             self.pipe.send('sockets')
 
-        sock = NMEASocket(connection, address)
+        sock = NMEASocket(connection, address, spec)
         self.sockets.append(sock)
+        try:
+            sock.index = self.socket_slots.index(False)
+        except:
+            sock.index = len(self.socket_slots)
+            self.socket_slots.append(False)
+            self.socket_dropped.append(self.client.register(Value('nmea.socket%d.dropped' % sock.index, 0)))
+        self.socket_slots[sock.index] = sock
+        self.socket_dropped[sock.index].set(0)
 
         self.addresses[sock] = address
         fd = sock.socket.fileno()
@@ -555,6 +923,11 @@ class nmeaBridge(object):
     def socket_lost(self, sock, fd):
         if sock == self.client_socket:
             self.client_socket = False
+            if self.client_stable:
+                self.client_retry_time = time.monotonic() + 1
+                self.client_state.set('waiting')
+            else: # closed right after connecting, back off
+                self.client_failed('closed before receiving data')
         try:
             self.sockets.remove(sock)
         except:
@@ -562,6 +935,7 @@ class nmeaBridge(object):
             return
         
         self.pipe.send('lostsocket' + str(sock.uid))
+        self.socket_slots[sock.index] = False
         if not self.sockets:
             self.setup_watches(False)
             self.pipe.send('nosockets')
@@ -583,28 +957,108 @@ class nmeaBridge(object):
 
         sock.close()
 
-    def connect_client(self):
-        if not ':' in self.nmea_client.value:
-            return
-        host, port = self.nmea_client.value.split(':')
-        port = int(port)
+    # the outbound connection to nmea.client never blocks the bridge:
+    #   none -> resolving -> connecting -> connected
+    # the host name is resolved in a thread, the connect is completed
+    # by the poller, and failures retry with exponential backoff
+    def client_failed(self, reason):
+        print('nmea client failed to connect to', self.client_address, ':', reason)
+        if self.client_connecting:
+            self.poller.unregister(self.client_connecting)
+            del self.fd_to_socket[self.client_connecting.fileno()]
+            self.client_connecting.close()
+            self.client_connecting = False
+        self.client_failures.set(self.client_failures.value + 1)
+        delay = min(2**self.client_failures.value, 64)
+        self.client_retry_time = time.monotonic() + delay
+        self.client_state.set('waiting')
+
+    def resolve_client(self, host, port, resolved):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tc0 = time.monotonic()
-            s.connect((host, port))
-            print('connected to', host, port, 'in', time.monotonic() - tc0, 'seconds')
-            self.client_socket = self.new_socket_connection(s, self.nmea_client.value)
-            self.client_socket.nmea_client = self.nmea_client.value
+            resolved.append(socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0])
         except Exception as e:
-            print('nmea client failed to connect to', self.nmea_client.value, ':', e)
-            self.client_socket = False
+            resolved.append(e)
+
+    def connect_client(self, t):
+        address = self.nmea_client.value
+        if address != self.client_address:
+            if self.client_connecting:
+                self.client_failed('address changed')
+            self.client_address = address
+            self.client_failures.set(0)
+            self.client_retry_time = 0
+            self.client_state.set('none')
+
+        if not ':' in address:
+            return
+
+        state = self.client_state.value
+        if state in ['none', 'waiting']:
+            if t < self.client_retry_time:
+                return
+            try:
+                host, port = address.split(':')
+                port = int(port)
+            except Exception as e:
+                self.client_failed(e)
+                return
+            self.client_resolved = []
+            threading.Thread(target=self.resolve_client, args=(host, port, self.client_resolved), daemon=True).start()
+            self.client_state.set('resolving')
+        elif state == 'resolving':
+            if not self.client_resolved:
+                return # still resolving
+            result = self.client_resolved[0]
+            if isinstance(result, Exception):
+                self.client_failed(result)
+                return
+            family, socktype, proto, canonname, sockaddr = result
+            s = socket.socket(family, socktype, proto)
+            s.setblocking(0)
+            err = s.connect_ex(sockaddr)
+            if err and err != errno.EINPROGRESS:
+                s.close()
+                self.client_failed(os.strerror(err))
+                return
+            self.client_connecting = s
+            self.client_connect_time = t
+            self.fd_to_socket[s.fileno()] = s
+            self.poller.register(s, select.POLLOUT)
+            self.client_state.set('connecting')
+        elif state == 'connecting' and t - self.client_connect_time > 10:
+            self.client_failed('timeout')
+
+    def client_connected(self):
+        s = self.client_connecting
+        err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.client_failed(os.strerror(err))
+            return
+        self.poller.unregister(s)
+        del self.fd_to_socket[s.fileno()]
+        self.client_connecting = False
+        print('nmea client connected to', self.client_address)
+        self.client_socket = self.new_socket_connection(s, self.client_address)
+        if self.client_socket:
+            self.client_socket.nmea_client = self.client_address
+            self.client_connected_time = time.monotonic()
+            self.client_stable = False
+            self.client_state.set('connected')
+        else:
+            self.client_failed('too many connections')
+
+    # reset the backoff only once the connection is known to work
+    def client_stable_connection(self):
+        self.client_stable = True
+        self.client_failures.set(0)
 
     def nmea_process(self):
         print('nmea process', os.getpid())
         self.setup()
         while True:
             t0 = time.monotonic()
-            timeout = 100 if self.sockets else 10000
+            # poll more often while the outbound connection is pending
+            timeout = 100 if self.sockets or self.client_state.value in ['resolving', 'connecting', 'waiting'] else 10000
             self.poll(timeout)
 
     def receive_pipe(self):
@@ -612,11 +1066,23 @@ class nmeaBridge(object):
             msg = self.pipe.recv()
             if not msg:
                 return
-            if msg[0] != '$': # perform checksum in this subprocess
-                msg = '$' + msg + ('*%02X' % nmea_cksum(msg))
-            # relay nmea message from server to all tcp sockets
+            # relay the block of sentences from the server to the tcp sockets,
+            # sockets with a filter only receive the sentences it accepts
+            t, data, lines = time.monotonic(), False, False
             for sock in self.sockets:
-                sock.write(msg + '\r\n')
+                if sock.filter.all:
+                    if not data:
+                        data = msg.encode()
+                    sock.write(data)
+                    continue
+                if not lines:
+                    lines = msg.split('\r\n')[:-1]
+                accepted = ''
+                for line in lines:
+                    if sock.filter.accept(line[3:6], t):
+                        accepted += line + '\r\n'
+                if accepted:
+                    sock.write(accepted.encode())
 
     def poll(self, timeout=0):
         t0 = time.monotonic()
@@ -628,16 +1094,22 @@ class nmeaBridge(object):
         while events:
             fd, flag = events.pop()
             sock = self.fd_to_socket[fd]
-            if flag & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+            if sock == self.client_connecting:
+                self.client_connected()
+            elif flag & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
                 if sock == self.server:
                     print('nmea bridge lost server connection')
                     exit(2)
+                if sock in self.server_filters:
+                    print('nmea bridge lost port server', sock)
+                    continue
                 if sock == self.pipe:
                     print('nmea bridge pipe to autopilot')
                     exit(2)
                 self.socket_lost(sock, fd)
-            elif sock == self.server:
-                self.new_socket_connection(*self.server.accept())
+            elif sock in self.server_filters:
+                connection, address = sock.accept()
+                self.new_socket_connection(connection, address, self.server_filters[sock])
             elif sock == self.pipe:
                 self.receive_pipe()
             elif sock == self.client:
@@ -650,6 +1122,13 @@ class nmeaBridge(object):
                         line = sock.readline()
                         if not line:
                             break
+                        if line[1:6] == 'PPYPF': # client filter request
+                            sock.filter = NMEAFilter(line[7:line.rfind('*')])
+                            continue
+                        if sock == self.client_socket and not self.client_stable:
+                            self.client_stable_connection()
+                        if self.recorder:
+                            self.recorder.write('tcp', 'socket' + str(sock.uid), [line])
                         self.receive_nmea(line, 'socket' + str(sock.uid))
             else:
                 print('nmea bridge unhandled poll flag', flag)
@@ -671,7 +1150,16 @@ class nmeaBridge(object):
         pypilot_msgs = self.client.receive()
         for name in pypilot_msgs:
             value = pypilot_msgs[name]
+            if name == 'nmea.record':
+                if value and not self.recorder:
+                    self.recorder = NMEARecorder()
+                elif not value and self.recorder:
+                    self.recorder.close()
+                    self.recorder = False
+                continue
             self.last_values[name] = value
+        if pypilot_msgs:
+            self.update_dispatch()
         #except Exception as e:
         #    print('nmea exception receiving:', e)
         t4 = time.monotonic()
@@ -679,20 +1167,72 @@ class nmeaBridge(object):
         # flush sockets
         for sock in self.sockets:
             sock.flush()
+            if sock.dropped:
+                dropped = self.socket_dropped[sock.index]
+                dropped.set(dropped.value + sock.dropped)
+                sock.dropped = 0
         t5 = time.monotonic()
 
+        if self.nmea_ports.value != self.ports_spec:
+            self.setup_ports()
+
         # reconnect client tcp socket
         if self.client_socket:
             if self.client_socket.nmea_client != self.nmea_client.value:
                 self.client_socket.socket.close() # address has changed, close connection
-        elif t5 - self.failed_nmea_client_time > 20:
-            try:
-                self.connect_client()
-            except Exception as e:
-                print('failed to create nmea socket as host:port', self.nmea_client.value, e)
-                self.failed_nmea_client_time = t5
+            elif not self.client_stable and t5 - self.client_connected_time > nmea_client_stable_time:
+                self.client_stable_connection()
+        else:
+            self.connect_client(t5)
                                 
         t6 = time.monotonic()
 
         if t6-t1 > .1:
             print('nmea process loop too slow:', t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5)
+
+# benchmark parsing of each sentence in the table
+def main():
+    lines = ['$GPRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W*6A',
+             '$GPGGA,123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,*47',
+             '$GPVTG,054.7,T,034.4,M,005.5,N,010.2,K,A*25',
+             '$WIMWV,214.8,R,0.1,K,A*28',
+             '$ERRSA,-3.5,A,,*51',
+             '$HCHDG,98.3,0.0,E,12.6,W*57',
+             '$HEHDT,274.07,T*03',
+             '$VWVHW,,T,,M,6.4,N,11.9,K*49',
+             '$IIXDR,A,-2.5,D,PTCH,A,4.1,D,ROLL,C,19.5,C,AIR,P,101325,P,BARO*7B',
+             '$GPAPB,A,A,0.10,R,N,V,V,011,M,DEST,011,M,011,M*3C']
+    count = 20000
+    dispatch = nmea_dispatch(lambda name : True)
+    for line in lines:
+        parse = dispatch[line[3:6]]
+        print(line[3:6], parse(line))
+        t0 = time.monotonic()
+        for i in range(count):
+            parse(line)
+        t1 = time.monotonic()
+        print('  %.2f us per sentence' % ((t1-t0)*1e6/count))
+
+    t0 = time.monotonic()
+    for i in range(count):
+        for line in lines:
+            sentence = line[3:6]
+            if sentence in dispatch:
+                dispatch[sentence](line)
+    t1 = time.monotonic()
+    print('mixed sentences %.0f per second' % (count*len(lines)/(t1-t0)))
+
+    # output block of sentences checksummed natively, compared with python
+    output = ['APXDR,A,%.3f,D,PTCH' % 1.5, 'APXDR,A,%.3f,D,ROLL' % -2.25,
+              'APHDM,%.3f,M' % 123.4, 'APMWV,%.3f,R,%.3f,N,A' % (33.1, 12.6), 'APRSA,%.3f,A,,' % 4.2]
+    t0 = time.monotonic()
+    for i in range(count):
+        python_block = ''.join(map(lambda msg : '$' + msg + ('*%02X' % nmea_cksum(msg)) + '\r\n', output))
+    t1 = time.monotonic()
+    for i in range(count):
+        block = linebuffer.nmea_block('\n'.join(output))
+    t2 = time.monotonic()
+    print('output block python %.2f us native %.2f us, identical' % ((t1-t0)*1e6/count, (t2-t1)*1e6/count), block == python_block)
+
+if __name__ == '__main__':
+    main()
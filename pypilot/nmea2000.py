@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# read nmea2000 sensor data directly from a linux socketcan interface
+#
+# to test without hardware:
+#   sudo ip link add dev vcan0 type vcan && sudo ip link set up vcan0
+#   set nmea2000.interface to vcan0 and run: python nmea2000.py vcan0
+
+import time, socket, struct, select, math
+from values import Property
+
+can_frame_format = '=IB3x8s'
+can_frame_size = struct.calcsize(can_frame_format)
+can_eff_flag = 0x80000000
+can_eff_mask = 0x1fffffff
+
+radians = 180/math.pi
+meters_s = 1.94384 # m/s to knots
+
+# pgns longer than 8 bytes sent as multiple frames
+fast_packet_pgns = [129029]
+
+def can_id_to_pgn(can_id):
+    pf = (can_id >> 16) & 0xff
+    pgn = (can_id >> 8) & 0x1ff00
+    if pf >= 240: # pdu2 format includes the group extension
+        pgn |= (can_id >> 8) & 0xff
+    return pgn
+
+def pgn_to_can_id(pgn, src, priority=2):
+    return can_eff_flag | (priority << 26) | (pgn << 8) | src
+
+# values with all bits set are not available
+def u16(data, offset, scale):
+    value = struct.unpack_from('<H', data, offset)[0]
+    return False if value >= 0xfffd else value*scale
+
+def s16(data, offset, scale):
+    value = struct.unpack_from('<h', data, offset)[0]
+    return False if value >= 0x7ffd else value*scale
+
+def s32(data, offset, scale):
+    value = struct.unpack_from('<i', data, offset)[0]
+    return False if value >= 0x7ffffffd else value*scale
+
+def s64(data, offset, scale):
+    value = struct.unpack_from('<q', data, offset)[0]
+    return False if value >= 0x7ffffffffffffffd else value*scale
+
+def parse_wind(data):
+    if data[5] & 7 != 2: # only apparent wind
+        return False
+    speed, direction = u16(data, 1, .01*meters_s), u16(data, 3, 1e-4*radians)
+    if direction is False:
+        return False
+    msg = {'direction': direction}
+    if not speed is False:
+        msg['speed'] = speed
+    return 'wind', msg
+
+def parse_rudder(data):
+    angle = s16(data, 4, 1e-4*radians)
+    if angle is False:
+        return False
+    return 'rudder', {'angle': angle}
+
+def parse_heading(data):
+    heading = u16(data, 1, 1e-4*radians)
+    if heading is False:
+        return False
+    if data[7] & 3 == 0:
+        return 'heading', {'true': heading}
+    msg = {'heading': heading}
+    deviation, variation = s16(data, 3, 1e-4*radians), s16(data, 5, 1e-4*radians)
+    if not deviation is False:
+        msg['deviation'] = deviation
+    if not variation is False:
+        msg['variation'] = variation
+    return 'heading', msg
+
+def parse_cogsog(data):
+    msg = {}
+    track, speed = u16(data, 2, 1e-4*radians), u16(data, 4, .01*meters_s)
+    if not track is False and data[1] & 3 == 0: # only true course
+        msg['track'] = track
+    if not speed is False:
+        msg['speed'] = speed
+    return msg and ('gps', msg)
+
+def parse_position(data):
+    lat, lon = s32(data, 0, 1e-7), s32(data, 4, 1e-7)
+    if lat is False or lon is False:
+        return False
+    return 'gps', {'lat': lat, 'lon': lon}
+
+def parse_gnss_position(data):
+    if len(data) < 23:
+        return False
+    lat, lon = s64(data, 7, 1e-16), s64(data, 15, 1e-16)
+    if lat is False or lon is False:
+        return False
+    return 'gps', {'lat': lat, 'lon': lon}
+
+nmea2000_pgns = {130306: parse_wind, 127245: parse_rudder, 127250: parse_heading,
+                 129026: parse_cogsog, 129025: parse_position, 129029: parse_gnss_position}
+
+# reassemble fast packets from each source
+#  first frame: sequence|index, length, 6 data bytes
+#  later frames: sequence|index, 7 data bytes
+class FastPacket(object):
+    def __init__(self):
+        self.packets = {}
+
+    def add(self, pgn, src, data):
+        key = pgn, src
+        sequence, index = data[0] >> 5, data[0] & 0x1f
+        if index == 0:
+            self.packets[key] = [sequence, data[1], bytearray(data[2:8]), 1]
+            packet = self.packets[key]
+        else:
+            if not key in self.packets:
+                return False
+            packet = self.packets[key]
+            if packet[0] != sequence or packet[3] != index:
+                del self.packets[key] # lost a frame
+                return False
+            packet[2] += data[1:8]
+            packet[3] += 1
+
+        if len(packet[2]) < packet[1]:
+            return False
+        del self.packets[key]
+        return bytes(packet[2][:packet[1]])
+
+class nmea2000(object):
+    def __init__(self, sensors):
+        self.sensors = sensors
+        self.interface = sensors.client.register(Property('nmea2000.interface', 'can0', persistent=True))
+        self.socket = False
+        self.current_interface = False
+        self.last_connect_time = 0
+        self.fast_packet = FastPacket()
+        self.msgs = {}
+
+    def connect(self):
+        self.current_interface = self.interface.value
+        if not self.current_interface:
+            return
+        try:
+            s = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+            s.bind((self.current_interface,))
+            s.setblocking(0)
+        except Exception:
+            # quietly retry, most systems have no can interface
+            return
+        print('nmea2000 reading from', self.current_interface)
+        self.socket = s
+        self.poller = select.poll()
+        self.poller.register(s, select.POLLIN)
+
+    def disconnect(self):
+        print('nmea2000 lost', self.current_interface)
+        device = 'N2' + self.current_interface + ':'
+        for sensor in self.sensors.sensors.values():
+            if sensor.source.value == 'can' and sensor.device.startswith(device):
+                self.sensors.lostsensor(sensor)
+        self.socket.close()
+        self.socket = False
+
+    def receive_frame(self, can_id, data):
+        if not can_id & can_eff_flag:
+            return # nmea2000 only uses extended frames
+        can_id &= can_eff_mask
+        pgn = can_id_to_pgn(can_id)
+        if not pgn in nmea2000_pgns:
+            return
+        src = can_id & 0xff
+        if pgn in fast_packet_pgns:
+            data = self.fast_packet.add(pgn, src, data)
+            if not data:
+                return
+        result = nmea2000_pgns[pgn](data)
+        if not result:
+            return
+        name, msg = result
+        msg['device'] = 'N2' + self.current_interface + ':%d' % src
+        # combine pgns for the same sensor, eg: cog/sog and position
+        if name in self.msgs and self.msgs[name]['device'] == msg['device']:
+            self.msgs[name].update(msg)
+        else:
+            self.msgs[name] = msg
+
+    def read(self):
+        while True:
+            try:
+                frame = self.socket.recv(can_frame_size)
+            except BlockingIOError:
+                return True
+            except Exception as e:
+                print('nmea2000 read failed', e)
+                return False
+            if len(frame) < can_frame_size:
+                return True
+            can_id, length, data = struct.unpack(can_frame_format, frame)
+            self.receive_frame(can_id, data[:length])
+
+    def poll(self):
+        if self.interface.value != self.current_interface and self.socket:
+            self.disconnect()
+        if not self.socket:
+            t = time.monotonic()
+            if t - self.last_connect_time < 10:
+                return
+            self.last_connect_time = t
+            self.connect()
+            if not self.socket:
+                return
+
+        for fd, flag in self.poller.poll(0):
+            if flag & select.POLLIN:
+                if not self.read():
+                    self.disconnect()
+                    break
+            if flag & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                self.disconnect()
+                break
+
+        for name in self.msgs:
+            self.sensors.write(name, self.msgs[name], 'can')
+        self.msgs = {}
+
+# encode frames of the supported pgns, used to test with a vcan interface
+def encode_frames(pgn, data, src, sequence=0):
+    can_id = pgn_to_can_id(pgn, src)
+    if not pgn in fast_packet_pgns:
+        return [(can_id, data)]
+    frames = [(can_id, bytes([sequence << 5, len(data)]) + data[:6])]
+    for i in range(6, len(data), 7):
+        frames.append((can_id, bytes([sequence << 5 | len(frames)]) + data[i:i+7]))
+    return frames
+
+def test_frames(t, src=35):
+    direction = 30 + 10*math.sin(t)
+    frames = []
+    for pgn, data in [(130306, struct.pack('<BHHB2x', 0, 1000, int(math.radians(direction % 360)*1e4), 2)),
+                      (127245, struct.pack('<BBhh2x', 0, 0, 0x7fff, int(math.radians(5*math.sin(t/3))*1e4))),
+                      (127250, struct.pack('<BHhhB', 0, int(math.radians(120)*1e4), 0, int(math.radians(-3)*1e4), 1)),
+                      (129026, struct.pack('<BBHH2x', 0, 0, int(math.radians(125)*1e4), 310)),
+                      (129025, struct.pack('<ii', int(48.1173*1e7), int(11.5167*1e7))),
+                      (129029, struct.pack('<BHIqq', 0, 0, 0, int(48.1173*1e16), int(11.5167*1e16)) + bytes(20))]:
+        frames += encode_frames(pgn, data, src, int(t) & 7)
+    return frames
+
+# transmit simulated sensor data on a can interface
+def main():
+    import sys
+    if len(sys.argv) < 2:
+        print('usage: nmea2000.py interface')
+        exit(1)
+    s = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    s.bind((sys.argv[1],))
+    while True:
+        for can_id, data in test_frames(time.monotonic()):
+            s.send(struct.pack(can_frame_format, can_id, len(data), data.ljust(8, b'\xff')))
+        time.sleep(.1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# record nmea sentences with their timing and source, and replay them
+# through Nmea as a pseudo device
+#
+# set nmea.record to true to append sentences received from serial
+# devices and tcp connections to the recording file, each line is:
+#   time source device sentence
+# the time is wall clock so appended sessions stay in order, and each
+# recording starts with a line:
+#   # session time
+
+import os, sys, time
+
+nmea_record_path = os.getenv('HOME') + '/.pypilot/nmea_recording.log'
+
+class NMEARecorder(object):
+    def __init__(self, filename=nmea_record_path):
+        print('recording nmea to', filename)
+        self.file = open(filename, 'a', buffering=1) # whole lines from each process
+        self.file.write('# session %.3f\n' % time.time())
+
+    def write(self, source, device, lines):
+        t = time.time()
+        for line in lines:
+            self.file.write('%.3f %s %s %s\n' % (t, source, device, line))
+
+    def close(self):
+        self.file.close()
+
+# the sensors and bridge processes each start a session when recording
+# is enabled, session lines closer than this begin the same session
+nmea_session_merge_time = 5
+
+# return a list of sessions, each a list of samples sorted by time
+def load_nmea_sessions(filename):
+    samples = []
+    starts = []
+    f = open(filename)
+    for line in f:
+        try:
+            if line.startswith('# session '):
+                starts.append(float(line[10:]))
+                continue
+            t, source, device, sentence = line.rstrip().split(' ', 3)
+            samples.append((float(t), source, device, sentence))
+        except Exception as e:
+            print('nmeareplay skipping invalid line', line, e)
+    f.close()
+    samples.sort(key=lambda sample : sample[0])
+
+    starts.sort()
+    boundaries = []
+    for start in starts:
+        if not boundaries or start - boundaries[-1] >= nmea_session_merge_time:
+            boundaries.append(start)
+
+    sessions = [[]]
+    index = 0 # next boundary
+    for sample in samples:
+        while index < len(boundaries) and sample[0] >= boundaries[index]:
+            sessions.append([])
+            index += 1
+        sessions[-1].append(sample)
+    return list(filter(lambda session : session, sessions))
+
+# samples of one session, by default the most recent
+def load_nmea_recording(filename, session=-1):
+    sessions = load_nmea_sessions(filename)
+    if not sessions:
+        return []
+    if len(sessions) > 1:
+        print('nmeareplay', filename, 'has', len(sessions), 'sessions, using', session)
+    return sessions[session]
+
+# replay a recording in real time, scaled by speed, or as fast as
+# possible (speed 0) where each read advances fast_period of recorded time
+class NMEAReplayDevice(object):
+    def __init__(self, filename, speed=1, loop=False, fast_period=.1, session=-1):
+        self.samples = load_nmea_recording(filename, session)
+        self.path = ('replay:' + filename, 0)
+        self.speed = speed
+        self.loop = loop
+        self.fast_period = fast_period
+        self.index = 0
+        self.starttime = False
+        self.recordtime = self.samples[0][0] - fast_period if self.samples else 0
+        self.offset = 0 # added to recorded times when looping
+        print('nmeareplay loaded', len(self.samples), 'sentences from', filename)
+
+    def finished(self):
+        return self.index >= len(self.samples) and not self.loop
+
+    # current time in the recording, used as the sensors clock
+    def time(self):
+        return self.recordtime + self.offset
+
+    # return (source, device, sentence) for each sentence now due
+    def readlines(self):
+        if not self.samples:
+            return []
+        if self.index >= len(self.samples):
+            if not self.loop:
+                return []
+            self.offset += self.samples[-1][0] - self.samples[0][0] + self.fast_period
+            self.index = 0
+            self.starttime = False
+            self.recordtime = self.samples[0][0] - self.fast_period
+
+        if self.speed:
+            t = time.monotonic()
+            if self.starttime is False:
+                self.starttime = t - (self.samples[self.index][0] - self.samples[0][0])/self.speed
+            self.recordtime = self.samples[0][0] + (t - self.starttime)*self.speed
+        else:
+            self.recordtime += self.fast_period
+
+        lines = []
+        while self.index < len(self.samples) and self.samples[self.index][0] <= self.recordtime:
+            t, source, device, sentence = self.samples[self.index]
+            lines.append((source, device, sentence))
+            self.index += 1
+        return lines
+
+# replay through Sensors, reporting parse throughput and sensor events
+def main():
+    import getopt
+    def usage():
+        print('usage: nmeareplay.py [-s speed] [-f] [-l] [-S session] recording')
+        print('  -s  playback speed, default 1 for real time')
+        print('  -f  as fast as possible')
+        print('  -l  loop')
+        print('  -S  session index in the recording, default -1 for the last')
+        exit(1)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's:flS:h')
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+
+    speed, loop, session = 1, False, -1
+    for opt, arg in opts:
+        if opt == '-s':
+            speed = float(arg)
+        elif opt == '-f':
+            speed = 0
+        elif opt == '-l':
+            loop = True
+        elif opt == '-S':
+            session = int(arg)
+        else:
+            usage()
+    if len(args) != 1:
+        usage()
+
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from server import pypilotServer
+    from client import pypilotClient
+    from sensors import Sensors
+
+    server = pypilotServer()
+    client = pypilotClient(server)
+    sensors = Sensors(client)
+    device = NMEAReplayDevice(args[0], speed, loop, session=session)
+    sensors.nmea.replay(device)
+
+    t0 = time.monotonic()
+    while not device.finished():
+        server.poll()
+        client.poll()
+        sensors.poll()
+        if speed:
+            time.sleep(.01)
+    t1 = time.monotonic()
+
+    print('replayed', len(device.samples), 'sentences in %.3f seconds' % (t1-t0))
+    print('%.1f seconds of recording' % (device.time() - device.samples[0][0]) if device.samples else '')
+    stats = sensors.nmea.replay_stats
+    if stats['time']:
+        print('parse %.1f us per sentence' % (stats['time']*1e6/max(stats['lines'], 1)))
+    for name, sensor in sensors.sensors.items():
+        print('%-12s source %-8s device %s' % (name, sensor.source.value, sensor.device))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# http requests and websocket connections (ws:// only) which never block,
+# call poll() from an event loop until the request is done or the
+# websocket is open, the socket can be polled for POLLIN with fileno()
+#
+# states: resolving -> connecting -> (request sent) -> done or open
+#         failed if anything went wrong, with the reason in error
+
+import os, time, socket, select, errno, threading, struct, base64, hashlib
+from urllib.parse import urlsplit
+
+class NonBlockingConnection(object):
+    timeout = 10 # seconds to connect and receive a response
+
+    def __init__(self, url):
+        u = urlsplit(url)
+        self.host, self.port = u.hostname, u.port or 80
+        self.path = (u.path or '/') + ('?' + u.query if u.query else '')
+        self.socket = False
+        self.address = False
+        self.error = False
+        self.inbuf = b''
+        self.outbuf = b''
+        self.start = time.monotonic()
+        if u.scheme in ['https', 'wss']:
+            self.fail('secure connections not supported ' + url)
+            return
+
+        self.state = 'resolving'
+        try:
+            socket.inet_aton(self.host)
+            self.address = self.host, self.port
+        except Exception:
+            # names are resolved in a thread as getaddrinfo may block
+            threading.Thread(target=self.resolve, daemon=True).start()
+
+    def resolve(self):
+        try:
+            self.address = socket.getaddrinfo(self.host, self.port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        except Exception as e:
+            self.error = 'failed to resolve %s: %s' % (self.host, e)
+
+    def fileno(self):
+        return self.socket.fileno() if self.socket else 0
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = False
+
+    def fail(self, error):
+        self.error = error
+        self.state = 'failed'
+        self.close()
+
+    def connect(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+        err = self.socket.connect_ex(self.address)
+        if err and err != errno.EINPROGRESS:
+            self.fail(os.strerror(err))
+            return
+        self.pollout = select.poll()
+        self.pollout.register(self.socket, select.POLLOUT)
+        self.state = 'connecting'
+
+    def write(self, data):
+        self.outbuf += data
+        self.flush()
+
+    def flush(self):
+        if not self.outbuf or not self.socket:
+            return
+        try:
+            count = self.socket.send(self.outbuf)
+        except BlockingIOError:
+            return
+        except Exception as e:
+            self.fail(str(e))
+            return
+        self.outbuf = self.outbuf[count:]
+
+    # read everything available, false if the connection closed
+    def fill(self):
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except BlockingIOError:
+                return True
+            except Exception as e:
+                self.error = str(e)
+                return False
+            if not data:
+                return False
+            self.inbuf += data
+
+    def poll(self):
+        if self.state == 'resolving':
+            if self.error:
+                self.fail(self.error)
+            elif self.address:
+                self.connect()
+        if self.state == 'connecting' and self.pollout.poll(0):
+            err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.fail(os.strerror(err))
+                return
+            self.state = 'connected'
+            self.connected()
+        if self.state in ['resolving', 'connecting', 'connected'] and \
+           time.monotonic() - self.start > self.timeout:
+            self.fail('timeout ' + self.state)
+        if not self.socket or self.state in ['resolving', 'connecting']:
+            return
+        self.flush()
+        self.receive(self.fill())
+
+    def request(self, method, headers, body=b''):
+        request = '%s %s HTTP/1.1\r\nHost: %s:%d\r\n' % (method, self.path, self.host, self.port)
+        for name, value in headers.items():
+            request += '%s: %s\r\n' % (name, value)
+        if body:
+            request += 'Content-Length: %d\r\n' % len(body)
+        self.write((request + '\r\n').encode() + body)
+
+    # split the status and headers from the response once they are received
+    def response_header(self):
+        i = self.inbuf.find(b'\r\n\r\n')
+        if i < 0:
+            return False
+        lines = self.inbuf[:i].decode(errors='replace').split('\r\n')
+        self.inbuf = self.inbuf[i+4:]
+        try:
+            self.status = int(lines[0].split()[1])
+        except Exception:
+            self.status = 0
+        self.headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                self.headers[name.strip().lower()] = value.strip()
+        return True
+
+class NonBlockingHTTPRequest(NonBlockingConnection):
+    def __init__(self, url, method='GET', body=False, headers={}):
+        self.method = method
+        self.body = body
+        self.request_headers = headers
+        self.status = False
+        super(NonBlockingHTTPRequest, self).__init__(url)
+
+    def done(self):
+        return self.state in ['done', 'failed']
+
+    def connected(self):
+        headers = dict(self.request_headers)
+        headers['Connection'] = 'close'
+        body = b''
+        if self.body:
+            body = self.body.encode()
+            headers['Content-Type'] = 'application/json'
+        self.request(self.method, headers, body)
+
+    def receive(self, open):
+        if self.status is False and not self.response_header():
+            if not open:
+                self.fail('connection closed')
+            return
+
+        length = self.headers.get('content-length')
+        chunked = self.headers.get('transfer-encoding') == 'chunked'
+        if chunked:
+            if not self.inbuf.endswith(b'0\r\n\r\n') and open:
+                return
+            body, data = b'', self.inbuf
+            while True:
+                i = data.find(b'\r\n')
+                size = int(data[:i].split(b';')[0] or b'0', 16)
+                if not size:
+                    break
+                body += data[i+2:i+2+size]
+                data = data[i+2+size+2:]
+            self.inbuf = body
+        elif length is not None:
+            if len(self.inbuf) < int(length):
+                if not open:
+                    self.fail('connection closed')
+                return
+        elif open:
+            return # read until closed
+        self.response = self.inbuf
+        self.state = 'done'
+        self.close()
+
+websocket_guid = '258EAFA5-E914-47DA-95CA-C5AB0DC11B63'
+
+def websocket_accept(key):
+    return base64.b64encode(hashlib.sha1((key + websocket_guid).encode()).digest()).decode()
+
+# xor data with the repeated 4 byte key
+def websocket_mask(key, data):
+    n = len(data)
+    key = (key * (n//4 + 1))[:n]
+    return (int.from_bytes(data, 'little') ^ int.from_bytes(key, 'little')).to_bytes(n, 'little')
+
+# encode a frame, clients must mask the payload, servers must not
+def websocket_frame(opcode, payload, mask):
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, n | (0x80 if mask else 0))
+    elif n < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126 | (0x80 if mask else 0), n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127 | (0x80 if mask else 0), n)
+    if not mask:
+        return header + payload
+    key = os.urandom(4)
+    return header + key + websocket_mask(key, payload)
+
+# decode frames from data, returns [(fin, opcode, payload)], remaining data
+def websocket_frames(data):
+    frames = []
+    while len(data) >= 2:
+        b0, b1 = data[0], data[1]
+        n, i = b1 & 0x7f, 2
+        if n == 126:
+            if len(data) < 4:
+                break
+            n, i = struct.unpack_from('!H', data, 2)[0], 4
+        elif n == 127:
+            if len(data) < 10:
+                break
+            n, i = struct.unpack_from('!Q', data, 2)[0], 10
+        key = False
+        if b1 & 0x80:
+            key, i = data[i:i+4], i+4
+        if len(data) < i + n:
+            break
+        payload = data[i:i+n]
+        if key:
+            payload = websocket_mask(key, payload)
+        frames.append((b0 & 0x80, b0 & 0x0f, payload))
+        data = data[i+n:]
+    return frames, data
+
+class NonBlockingWebSocket(NonBlockingConnection):
+    def __init__(self, url, headers={}):
+        self.request_headers = headers
+        self.key = base64.b64encode(os.urandom(16)).decode()
+        self.messages = []
+        self.fragments = False
+        self.status = False
+        super(NonBlockingWebSocket, self).__init__(url)
+
+    def connected(self):
+        headers = {'Upgrade': 'websocket', 'Connection': 'Upgrade',
+                   'Sec-WebSocket-Key': self.key, 'Sec-WebSocket-Version': '13'}
+        headers.update(self.request_headers)
+        self.request('GET', headers)
+
+    def receive(self, open):
+        if self.state == 'connected':
+            if not self.response_header():
+                if not open:
+                    self.fail('connection closed')
+                return
+            if self.status != 101 or self.headers.get('sec-websocket-accept') != websocket_accept(self.key):
+                self.fail('websocket handshake failed %d' % self.status)
+                return
+            self.state = 'open'
+
+        frames, self.inbuf = websocket_frames(self.inbuf)
+        for fin, opcode, payload in frames:
+            if opcode == 8: # close
+                self.write(websocket_frame(8, payload[:2], True))
+                self.fail('closed by server')
+                return
+            if opcode == 9: # ping
+                self.write(websocket_frame(10, payload, True))
+            elif opcode in [0, 1, 2]:
+                self.fragments = payload if opcode else (self.fragments or b'') + payload
+                if fin:
+                    self.messages.append(self.fragments.decode(errors='replace'))
+                    self.fragments = False
+        if not open:
+            self.fail('connection closed')
+
+    def send(self, message):
+        if self.state == 'open':
+            self.write(websocket_frame(1, message.encode(), True))
+
+    # return the messages received since the last call
+    def receive_messages(self):
+        self.poll()
+        messages, self.messages = self.messages, []
+        return messages
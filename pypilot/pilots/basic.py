@@ -86,7 +86,7 @@ class BasicPilot(AutopilotPilot):
     self.heading_command_rate.update(command_rate)
 
     # compute command
-    headingrate = ap.boatimu.SensorValues['headingrate_lowpass'].value
+    headingrate = ap.predicted_headingrate
     headingraterate = ap.boatimu.SensorValues['headingraterate_lowpass'].value
     feedforward_value = self.heading_command_rate.value
     reactive_value = self.servocommand_queue.take(t - self.reactive_time.value)
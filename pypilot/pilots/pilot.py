@@ -45,7 +45,7 @@ class AutopilotPilot(object):
 
     def compute_heading(self):        
         ap = self.ap
-        compass = ap.boatimu.SensorValues['heading_lowpass'].value
+        compass = ap.predicted_heading
 
         if ap.mode.value == 'true wind':
             true_wind = resolv(ap.true_wind_compass_offset.value - compass)
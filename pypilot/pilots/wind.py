@@ -129,7 +129,7 @@ class WindPilot(AutopilotPilot):
         return
 
     # compute command
-    headingrate = ap.boatimu.SensorValues['headingrate_lowpass'].value
+    headingrate = ap.predicted_headingrate
     headingraterate = ap.boatimu.SensorValues['headingraterate_lowpass'].value
     gain_values = {'P': self.heading_error.value,
                    'I': self.heading_error_int.value,
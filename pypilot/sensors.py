@@ -14,7 +14,7 @@ from resolv import resolv
 from gpsd import gpsd
 
 # favor lower priority sources
-source_priority = {'gpsd' : 1, 'servo': 1, 'serial' : 2, 'tcp' : 3, 'signalk' : 4, 'none' : 5}
+source_priority = {'gpsd' : 1, 'servo': 1, 'serial' : 2, 'can' : 3, 'tcp' : 4, 'signalk' : 5, 'none' : 6}
 
 class Sensor(object):
     def __init__(self, client, name):
@@ -24,7 +24,7 @@ class Sensor(object):
         self.name = name
         self.client = client
             
-    def write(self, data, source):
+    def write(self, data, source, t):
         if source_priority[self.source.value] < source_priority[source]:
             return False               
 
@@ -41,7 +41,7 @@ class Sensor(object):
             print('found', self.name, 'on', source, data['device'])
             self.source.set(source)
             self.device = data['device']
-        self.lastupdate = time.monotonic()
+        self.lastupdate = t
         
         return True
 
@@ -123,7 +123,8 @@ class gps(Sensor):
         self.lon = self.register(SensorValue, 'lon', fmt='%.11f')
 
     def update(self, data):
-        self.speed.set(data['speed'])
+        if 'speed' in data:
+            self.speed.set(data['speed'])
         if 'track' in data:
             self.track.set(data['track'])
         if 'lat' in data and 'lon' in data:
@@ -134,35 +135,97 @@ class gps(Sensor):
         self.track.set(False)
         self.speed.set(False)
 
+# heading from an external compass
+class Heading(Sensor):
+    def __init__(self, client):
+        super(Heading, self).__init__(client, 'heading')
+        self.magnetic = self.register(SensorValue, 'magnetic', directional=True)
+        self.true = self.register(SensorValue, 'true', directional=True)
+        self.variation = self.register(SensorValue, 'variation')
+
+    def update(self, data):
+        if 'heading' in data:
+            magnetic = data['heading']
+            if 'deviation' in data:
+                magnetic += data['deviation']
+            self.magnetic.set(magnetic % 360)
+            if 'variation' in data:
+                self.variation.set(data['variation'])
+                self.true.set((magnetic + data['variation']) % 360)
+        if 'true' in data:
+            self.true.set(data['true'])
+
+    def reset(self):
+        self.magnetic.set(False)
+        self.true.set(False)
+        self.variation.set(False)
+
+# speed through water
+class Water(Sensor):
+    def __init__(self, client):
+        super(Water, self).__init__(client, 'water')
+        self.speed = self.register(SensorValue, 'speed')
+
+    def update(self, data):
+        self.speed.set(data['speed'])
+
+    def reset(self):
+        self.speed.set(False)
+
+# generic transducer measurements
+class Transducers(Sensor):
+    def __init__(self, client):
+        super(Transducers, self).__init__(client, 'transducers')
+        self.values = {}
+        for name in ['pitch', 'roll', 'temperature', 'pressure']:
+            self.values[name] = self.register(SensorValue, name)
+
+    def update(self, data):
+        for name in data:
+            if name in self.values:
+                self.values[name].set(data[name])
+
+    def reset(self):
+        for value in self.values.values():
+            value.set(False)
+
 class Sensors(object):
     def __init__(self, client):
         from rudder import Rudder
         from nmea import Nmea
         from signalk import signalk
+        from nmea2000 import nmea2000
 
         self.client = client
+        self.clock = time.monotonic # replaced by the recording time during nmea replay
 
         # services that can receive sensor data
         self.nmea = Nmea(self)
         self.signalk = signalk(self)
         self.gpsd = gpsd(self)
+        self.nmea2000 = nmea2000(self)
 
         # actual sensors supported
         self.gps = gps(client)
         self.wind = Wind(client)
         self.rudder = Rudder(client)
         self.apb = APB(client)
+        self.heading = Heading(client)
+        self.water = Water(client)
+        self.transducers = Transducers(client)
 
-        self.sensors = {'gps': self.gps, 'wind': self.wind, 'rudder': self.rudder, 'apb': self.apb}
+        self.sensors = {'gps': self.gps, 'wind': self.wind, 'rudder': self.rudder, 'apb': self.apb,
+                        'heading': self.heading, 'water': self.water, 'transducers': self.transducers}
 
     def poll(self):
         self.nmea.poll()
         self.signalk.poll()
         self.gpsd.poll()
+        self.nmea2000.poll()
         self.rudder.poll()
 
         # timeout sources
-        t = time.monotonic()
+        t = self.clock()
         for name in self.sensors:
             sensor = self.sensors[name]
             if sensor.source.value == 'none':
@@ -184,7 +247,7 @@ class Sensors(object):
         if not sensor in self.sensors:
             print('unknown data parsed!', sensor)
             return
-        self.sensors[sensor].write(data, source)
+        self.sensors[sensor].write(data, source, self.clock())
         
     def lostdevice(self, device):
         # optional routine  useful when a device is
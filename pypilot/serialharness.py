@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# virtual serial devices on pseudo terminals to exercise serialprobe,
+# serial nmea input and the arduino servo driver without hardware
+#
+# each device is registered with serialprobe as if it were a usb serial
+# adapter with the given identity.  The harness holds the master side of
+# the pty, writing scripted or recorded data to it and reading anything
+# pypilot sends.  If the baud rate pypilot opens the device with does not
+# match the baud rate of the device, the data is garbled like a real port
+
+import os, sys, time, pty, tty, termios, math
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import serialprobe
+
+class VirtualSerialDevice(object):
+    def __init__(self, identity=False, baud=38400):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.identity = identity
+        self.baud = baud
+        self.output = b''
+        self.stream = []
+        self.index = 0
+        self.start = 0
+        self.written = 0
+        serialprobe.add_virtual_device(self.path, identity)
+
+    # the slave holds the settings pypilot opened the device with
+    def baud_matches(self):
+        speed = termios.tcgetattr(self.slave)[5]
+        return speed == getattr(termios, 'B%d' % self.baud, None)
+
+    def write(self, data):
+        if not self.baud_matches():
+            data = bytes(map(lambda b : b ^ 0x55, data))
+        self.output += data
+        self.flush()
+
+    # keep any data that does not fit in the pty buffer for the next poll
+    def flush(self):
+        if not self.output:
+            return
+        try:
+            count = os.write(self.master, self.output)
+        except BlockingIOError:
+            return
+        self.written += count
+        self.output = self.output[count:]
+
+    def read(self):
+        try:
+            return os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return b''
+
+    # play a list of (seconds, data) from now
+    def play(self, stream):
+        self.stream = stream
+        self.index = 0
+        self.start = time.monotonic()
+
+    def playing(self):
+        return self.index < len(self.stream)
+
+    def poll(self):
+        t = time.monotonic() - self.start
+        data = b''
+        while self.index < len(self.stream) and self.stream[self.index][0] <= t:
+            data += self.stream[self.index][1]
+            self.index += 1
+        if data:
+            self.write(data)
+        else:
+            self.flush()
+        return self.read()
+
+    # closing the master hangs up pypilot's side like pulling the usb cable
+    def unplug(self):
+        serialprobe.remove_virtual_device(self.path)
+        os.close(self.master)
+        os.close(self.slave)
+
+def nmea_sentence(msg):
+    from nmea import nmea_cksum
+    return ('$' + msg + '*%02X\r\n' % nmea_cksum(msg)).encode()
+
+# wind direction which identifies each simulated mwv sentence
+def wind_marker(sequence):
+    return 1 + (sequence % 1700) / 10
+
+# simulated sensor data at rate sentences per second
+def simulated_nmea_stream(duration, rate=20):
+    stream = []
+    sentences = [lambda t, i : 'IIMWV,%.1f,R,%.1f,N,A' % (wind_marker(i), 10 + math.sin(t)),
+                 lambda t, i : 'GPRMC,%06d,A,4807.038,N,01131.000,E,%.1f,%.1f,230394,003.1,W' %
+                               (int(t) % 240000, 6 + math.sin(t/7), 80 + 5*math.sin(t/5)),
+                 lambda t, i : 'IIVHW,,T,,M,%.2f,N,,K' % (5.5 + math.sin(t/3)),
+                 lambda t, i : 'IIHDG,%.1f,,,3.1,W' % (82 + 4*math.sin(t/4))]
+    for i in range(int(duration*rate)):
+        t = i / rate
+        stream.append((t, nmea_sentence(sentences[i % len(sentences)](t, i//len(sentences)))))
+    return stream
+
+# sentences from a recording made with nmea.record, optionally only
+# those received from one device
+def recorded_nmea_stream(filename, device=False):
+    from nmeareplay import load_nmea_recording
+    samples = load_nmea_recording(filename)
+    if device:
+        samples = list(filter(lambda sample : sample[2] == device, samples))
+    if not samples:
+        return []
+    t0 = samples[0][0]
+    return list(map(lambda sample : (sample[0] - t0, (sample[3] + '\r\n').encode()), samples))
+
+def crc8_table(poly=0x31):
+    table = []
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            crc = (crc << 1) ^ poly if crc & 0x80 else crc << 1
+        table.append(crc & 0xff)
+    return table
+crc8_table = crc8_table()
+
+def crc8(data):
+    crc = 0xff
+    for b in data:
+        crc = crc8_table[crc ^ b]
+    return crc
+
+# codes of the arduino servo packets, see arduino_servo.cpp
+COMMAND_CODE, RESET_CODE, DISENGAGE_CODE = 0xc7, 0xe7, 0x68
+EEPROM_READ_CODE, EEPROM_WRITE_CODE = 0x91, 0x53
+CURRENT_CODE, VOLTAGE_CODE, CONTROLLER_TEMP_CODE = 0x1c, 0xb3, 0xf9
+MOTOR_TEMP_CODE, RUDDER_SENSE_CODE, FLAGS_CODE, EEPROM_VALUE_CODE = 0x48, 0xa7, 0x8f, 0x9a
+SYNC, OVERCURRENT_FAULT, ENGAGED = 1, 4, 8
+
+# motor controller speaking the arduino servo protocol, the rudder moves
+# with the commanded speed and telemetry is sent every period
+class VirtualServo(VirtualSerialDevice):
+    def __init__(self, identity=False, baud=38400, period=.05):
+        super(VirtualServo, self).__init__(identity, baud)
+        self.period = period
+        self.input = b''
+        self.received = {}
+        self.packets = 0
+        self.invalid = 0
+        self.flags = 0
+        self.command = 1000
+        self.rudder = 0
+        self.eeprom = bytearray(256)
+        self.last_telemetry = time.monotonic()
+
+    def send(self, code, value):
+        packet = bytes([code, value & 0xff, (value >> 8) & 0xff])
+        self.write(packet + bytes([crc8(packet)]))
+
+    def receive(self, code, value):
+        self.received[code] = self.received.get(code, 0) + 1
+        if code == COMMAND_CODE:
+            self.command = value
+            self.flags |= ENGAGED
+        elif code == DISENGAGE_CODE:
+            self.flags &= ~ENGAGED
+        elif code == RESET_CODE:
+            self.flags &= ~OVERCURRENT_FAULT
+        elif code == EEPROM_READ_CODE:
+            for addr in range(value & 0xff, min(value >> 8, len(self.eeprom))):
+                self.send(EEPROM_VALUE_CODE, addr | self.eeprom[addr] << 8)
+        elif code == EEPROM_WRITE_CODE:
+            self.eeprom[value & 0xff] = value >> 8
+
+    def poll(self):
+        self.input += super(VirtualServo, self).poll()
+        while len(self.input) >= 4:
+            if crc8(self.input[:3]) != self.input[3]:
+                self.input = self.input[1:]
+                self.invalid += 1
+                continue
+            self.packets += 1
+            if self.packets >= 2:
+                self.flags |= SYNC
+            self.receive(self.input[0], self.input[1] | self.input[2] << 8)
+            self.input = self.input[4:]
+
+        t = time.monotonic()
+        dt = t - self.last_telemetry
+        if dt < self.period:
+            return
+        self.last_telemetry = t
+        if self.flags & ENGAGED:
+            self.rudder += (self.command - 1000) / 1000 * .1 * dt
+            self.rudder = min(max(self.rudder, -.5), .5)
+        self.send(CURRENT_CODE, 150 if self.flags & ENGAGED and self.command != 1000 else 0)
+        self.send(VOLTAGE_CODE, 1260)
+        self.send(CONTROLLER_TEMP_CODE, 2500)
+        self.send(MOTOR_TEMP_CODE, 2400)
+        self.send(RUDDER_SENSE_CODE, int((self.rudder + .5)*65472))
+        self.send(FLAGS_CODE, self.flags)
+
+def percentiles(values):
+    if not values:
+        return '-'
+    values = sorted(values)
+    return 'min %.4f median %.4f max %.4f' % (values[0], values[len(values)//2], values[-1])
+
+# run pypilot sensors (and servo) against virtual devices reporting probe,
+# reconnect and timeout events, throughput and latency of the serial paths
+def main():
+    import getopt, tempfile
+    def usage():
+        print('usage: serialharness.py [-t seconds] [-n count] [-b baud] [-r rate] [-R recording] [-u period] [-q seconds] [-p period] [-s] [-k]')
+        print('  -t  run time, default 30')
+        print('  -n  nmea devices, default 1')
+        print('  -b  baud of the nmea devices, default 38400')
+        print('  -r  simulated sentences per second, 0 for as fast as possible, default 20')
+        print('  -R  play a recording from nmea.record instead of simulated data')
+        print('  -u  unplug and replug the devices every period seconds')
+        print('  -q  the nmea devices go quiet after seconds')
+        print('  -p  poll period, default .01')
+        print('  -s  add a virtual arduino servo')
+        print('  -k  keep serial probe results in ~/.pypilot rather than a temporary directory')
+        exit(1)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 't:n:b:r:R:u:q:p:skh')
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+
+    duration, count, baud, rate, recording = 30, 1, 38400, 20, False
+    unplug_period, quiet, period, use_servo, keep = False, False, .01, False, False
+    for opt, arg in opts:
+        if opt == '-t':
+            duration = float(arg)
+        elif opt == '-n':
+            count = int(arg)
+        elif opt == '-b':
+            baud = int(arg)
+        elif opt == '-r':
+            rate = float(arg)
+        elif opt == '-R':
+            recording = arg
+        elif opt == '-u':
+            unplug_period = float(arg)
+        elif opt == '-q':
+            quiet = float(arg)
+        elif opt == '-p':
+            period = float(arg)
+        elif opt == '-s':
+            use_servo = True
+        elif opt == '-k':
+            keep = True
+        else:
+            usage()
+    if args:
+        usage()
+
+    if not keep:
+        serialprobe.pypilot_dir = tempfile.mkdtemp(prefix='serialharness') + '/'
+        print('serial probe results in', serialprobe.pypilot_dir)
+
+    from server import pypilotServer
+    from client import pypilotClient
+    from sensors import Sensors
+
+    server = pypilotServer()
+    client = pypilotClient(server)
+    sensors = Sensors(client)
+    servo = False
+    if use_servo:
+        from servo import Servo
+        servo = Servo(client, sensors)
+
+    # start the server process first so it does not inherit the ptys,
+    # otherwise unplugging would not hang up the devices
+    server.poll()
+
+    start = time.monotonic()
+    def event(*args):
+        print('harness %.3f' % (time.monotonic() - start), *args)
+
+    stream = False
+    if recording:
+        stream = recorded_nmea_stream(recording)
+    elif rate:
+        stream = simulated_nmea_stream(duration, rate)
+
+    stats = {'detect': [], 'latency': [], 'timeout': []}
+    devices = [] # [device, plugged time, detected]
+    def plug(identity, cls=VirtualSerialDevice):
+        device = cls(identity, baud if cls == VirtualSerialDevice else 38400)
+        if cls == VirtualSerialDevice and stream:
+            device.play(stream)
+        devices.append([device, time.monotonic(), False])
+        event('plugged', device.path, identity)
+
+    for i in range(count):
+        plug('1a86:7523:harness%d:0' % i)
+    if servo:
+        plug('2341:0043:harnessservo:0', VirtualServo)
+
+    markers = {} # wind direction: time written
+    fast_sequence = 0
+    last_unplug = start
+    quiet_time = False
+    while time.monotonic() - start < duration:
+        t = time.monotonic()
+        if unplug_period and t - last_unplug > unplug_period:
+            last_unplug = t
+            for device, plugged, detected in list(devices):
+                event('unplug', device.path)
+                device.unplug()
+            plugged = devices
+            devices = []
+            for device, plugged, detected in plugged:
+                plug(device.identity, type(device))
+
+        if quiet and t - start > quiet and not quiet_time:
+            event('nmea devices go quiet')
+            quiet_time = t
+        paths = list(map(lambda device : device.path[0], filter(bool, sensors.nmea.devices)))
+        for d in devices:
+            device, plugged, detected = d
+            if type(device) == VirtualServo:
+                device.poll()
+                if not detected and servo.driver and servo.device.path == device.path and \
+                   servo.controller.value != 'none':
+                    d[2] = t
+                    stats['detect'].append(t - plugged)
+                    event('servo detected', device.path, 'after %.3f' % (t - plugged))
+                continue
+
+            if quiet_time:
+                device.stream = []
+            elif not rate and not recording:
+                # as fast as possible, keep the pty buffer full
+                while not device.output:
+                    fast_sequence += 1
+                    markers[wind_marker(fast_sequence)] = t
+                    device.write(nmea_sentence('IIMWV,%.1f,R,10.0,N,A' % wind_marker(fast_sequence)))
+            index = device.index
+            device.poll()
+            if not recording:
+                for i in range(index, device.index):
+                    sentence = device.stream[i][1].decode()
+                    if 'MWV' in sentence:
+                        markers[float(sentence.split(',')[1])] = t
+
+            if not detected and device.path in paths:
+                d[2] = t
+                stats['detect'].append(t - plugged)
+                event('nmea detected', device.path, 'after %.3f' % (t - plugged))
+            elif detected and not device.path in paths and quiet_time:
+                stats['timeout'].append(t - quiet_time)
+                event('nmea timed out', device.path, 'after %.3f quiet' % (t - quiet_time))
+                d[2] = False
+
+        if servo:
+            servo.poll()
+        sensors.poll()
+        client.poll()
+        server.poll()
+
+        direction = sensors.wind.direction.value
+        if direction is not False and sensors.wind.source.value == 'serial':
+            direction = round(direction, 1)
+            if direction in markers:
+                written = markers[direction]
+                stats['latency'].append(time.monotonic() - written)
+                markers = dict(filter(lambda marker : marker[1] > written, markers.items()))
+
+        dt = period - (time.monotonic() - t)
+        if dt > 0:
+            time.sleep(dt)
+
+    print()
+    print('detection seconds', percentiles(stats['detect']))
+    if quiet:
+        print('timeout seconds', percentiles(stats['timeout']))
+    if not recording:
+        print('wind latency seconds', percentiles(stats['latency']))
+    for index, device in enumerate(sensors.nmea.devices):
+        if device:
+            s = sensors.nmea.device_stats[index]
+            print('nmea%d %s rate %.1f lines/s parse %.2f us/line dropped %d' %
+                  (index, device.path[0], s.rate.value, s.parse_time.value*1e6, s.dropped.value))
+    for device, plugged, detected in devices:
+        if type(device) == VirtualServo:
+            print('servo', device.path, 'received', device.packets, 'packets', device.invalid, 'invalid bytes',
+                  'commands', device.received.get(COMMAND_CODE, 0), 'eeprom writes', device.received.get(EEPROM_WRITE_CODE, 0))
+        else:
+            print('nmea', device.path, 'wrote', device.written, 'bytes')
+        device.unplug()
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,7 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import sys, os, time
+import sys, os, time, struct
 import pyjson
 
 pypilot_dir = os.getenv('HOME') + '/.pypilot/'
@@ -44,6 +44,53 @@ def read_allowed():
         allowed_serial_ports = read_config('serial_ports', 'any')
     return allowed_serial_ports
 
+# stable identity of a usb serial adapter from sysfs, independent of
+# the enumeration order: vendor:product:serial (or usb port):interface
+def usb_identity(device):
+    try:
+        tty = os.path.basename(os.path.realpath(device))
+        path = os.path.realpath('/sys/class/tty/' + tty + '/device')
+    except Exception:
+        return False
+
+    def read(name):
+        try:
+            f = open(os.path.join(path, name))
+            value = f.read().strip()
+            f.close()
+            return value
+        except Exception:
+            return False
+
+    interface = read('bInterfaceNumber') or ''
+    while path != '/' and not os.path.exists(os.path.join(path, 'idVendor')):
+        if not interface:
+            interface = read('bInterfaceNumber') or ''
+        path = os.path.dirname(path)
+    if path == '/':
+        return False # not a usb device
+    serial = read('serial') or os.path.basename(path)
+    return '%s:%s:%s:%s' % (read('idVendor'), read('idProduct'), serial, interface)
+
+# probe results by usb identity: {'name', 'baud', 'protocol'}
+probe_cache_file = 'serial_probe_cache'
+probe_cache = 'init'
+def read_probe_cache():
+    global probe_cache
+    if probe_cache == 'init':
+        probe_cache = {}
+        try:
+            f = open(pypilot_dir + probe_cache_file)
+            probe_cache = pyjson.loads(f.read())
+            f.close()
+        except Exception as e:
+            if os.path.exists(pypilot_dir + probe_cache_file):
+                print('serialprobe failed to read probe cache', e)
+    return probe_cache
+
+def probe_protocol(name):
+    return name.rstrip('0123456789')
+
 probes = {}
 def new_probe(name):
     global probes
@@ -108,11 +155,14 @@ def scan_devices():
                 path = '/dev/'+dev
                 realpath = os.path.realpath(path)
                 for device in devices:
-                    if device[1] == realpath:
+                    if devices[device]['realpath'] == realpath:
                         break
                 else:
                     devices[path] = {'realpath': realpath}
 
+    for path in virtual_devices:
+        devices[path] = {'realpath': os.path.realpath(path)}
+
     for device in list(devices):
         if devices[device]['realpath'] in devgpsdevices:
             print('serialprobe removing gps device', device)
@@ -144,80 +194,114 @@ def scan_devices():
             if devices[device]['realpath'] == realpath:
                 break
         else:
-            allowed_devices[path]['realpath'] = realpath
+            allowed_devices[path] = {'realpath': realpath}
     
     return allowed_devices
 
+# inotify on /dev so devices are scanned as soon as they are added or removed
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+class DeviceMonitor(object):
+    def __init__(self):
+        import ctypes, ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}
+        self.removed = set() # paths removed, they may already exist again
+        self.dev = self.watch('/dev')
+
+    # watching a path again returns the same watch
+    def watch(self, path):
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(), mask)
+        self.paths[wd] = path
+        return wd
+
+    # true if any serial device may have changed
+    def poll(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return changed
+            i = 0
+            while i + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, i)
+                name = data[i+16:i+16+length].rstrip(b'\0')
+                i += 16 + length
+                # anything in /dev/serial, otherwise only possible serial devices in /dev
+                if wd != self.dev or name.startswith((b'tty', b'serial', b'gps')):
+                    debug('serialprobe inotify', wd, hex(mask), name)
+                    changed = True
+                    if mask & (IN_DELETE | IN_MOVED_FROM) and wd in self.paths:
+                        self.removed.add(os.path.join(self.paths[wd], name.decode()))
+
 devices = {}
 gpsdevices = []
 enumstate = 'init'
 
+# devices which are not found by scanning, eg: the pseudo terminals
+# of serialharness, by path with the usb identity they pretend to have
+virtual_devices = {}
+removed_virtual_devices = set()
+def add_virtual_device(path, identity=False):
+    virtual_devices[path] = identity
+    rescan()
+
+def remove_virtual_device(path):
+    if path in virtual_devices:
+        del virtual_devices[path]
+        removed_virtual_devices.add(path)
+        rescan()
+
+# scan devices on the next enumeration
+def rescan():
+    if enumstate != 'init':
+        enumstate['scantime'] = 0
+
 def enumerate_devices():
     global devices
     global enumstate
 
     t0 = time.monotonic()
     if enumstate == 'init':
-        enumstate = {'monitor': False, 'starttime': t0, 'scantime': 0, 'retries': 0, 'pyudevwarning': False}
+        enumstate = {'monitor': False, 'scantime': 0}
         devices = {}
         read_last_working_devices()
+        try:
+            enumstate['monitor'] = DeviceMonitor()
+        except Exception as e:
+            print('serialprobe no inotify, will scan devices often', e)
 
     if enumstate['monitor']:
         # only scan devices if they change
-        ret = enumstate['monitor'].poll(0)
-        if ret:
-            enumstate['scantime'] = t0
-            enumstate['retries'] = 5 # up to 5 retries
-            while ret:
-                debug('serialprobe pyudev monitor', ret)
-                ret = enumstate['monitor'].poll(0) # flush events
-        if enumstate['retries'] == 0 or t0 < enumstate['scantime']:
+        if not enumstate['monitor'].poll() and enumstate['scantime']:
             return False
-
+        enumstate['scantime'] = t0
     else:
-        # delay monitor slightly to ensure startup speed
-        if t0 > enumstate['starttime'] + 5:
-            # try to start pyudev
-            import signal
-            # need to temporary disable sigchld while loading pyudev
-            cursigchld_handler = signal.getsignal(signal.SIGCHLD)
-            signal.signal(signal.SIGCHLD, signal.SIG_IGN)
-            try:
-                import pyudev
-                context = pyudev.Context()
-                enumstate['monitor'] = pyudev.Monitor.from_netlink(context)
-                enumstate['monitor'].filter_by(subsystem='usb')
-            except Exception as e:
-                # try pyudev/scanning again in 10 seconds if it is delayed loading
-                enumstate['starttime'] = time.monotonic() + 10
-                if not enumstate['pyudevwarning']:
-                    print('no pyudev module! will scan usb devices often!', e)
-                    enumstate['pyudevwarning'] = True
-
-            signal.signal(signal.SIGCHLD, cursigchld_handler)
-
         if t0 < enumstate['scantime']:
             return False
         enumstate['scantime'] = t0 + 20 # scan every 20 seconds
 
     scanned_devices = scan_devices()
     if enumstate['monitor']:
-        prev_devices = {}
-        for name in devices:
-            prev_devices[name] = {'realpath': devices[name]['realpath']}
-        if prev_devices == scanned_devices: # compare path and realpath
-            if enumstate['retries'] > 0:
-                enumstate['scantime'] += 2 #try again in 2 seconds until we get a change
-                enumstate['retries'] -= 1
-            return False
-        elif enumstate['monitor']:
-            debug('serialprobe pyudev found it', devices, scanned_devices)
-            enumstate['retries'] = 0
-    
+        # symlinks are created by udev after the device
+        for by in ['/dev/serial/by-id', '/dev/serial/by-path']:
+            if os.path.exists(by):
+                enumstate['monitor'].watch(by)
+
     debug('serialprobe scan', scanned_devices)
-    # remove devices not scanned
+    # remove devices not scanned, or removed since the last scan even
+    # if the path exists again as it may be a different device
+    removed = set(removed_virtual_devices)
+    removed_virtual_devices.clear()
+    if enumstate['monitor']:
+        removed |= enumstate['monitor'].removed
+        enumstate['monitor'].removed = set()
     for device in list(devices):
-        if not device in scanned_devices:
+        if not device in scanned_devices or device in removed:
             del devices[device]
 
     # add new devices and set the time the device was added
@@ -225,11 +309,94 @@ def enumerate_devices():
         if not device in devices:
             devices[device] = scanned_devices[device]
             devices[device]['time'] = t0
+            identity = virtual_devices[device] if device in virtual_devices else usb_identity(device)
+            cache = read_probe_cache()
+            devices[device]['identity'] = identity
+            devices[device]['cached'] = cache[identity] if identity in cache else False
+            if devices[device]['cached']:
+                debug('serialprobe known device', device, identity, devices[device]['cached'])
+
+    # relinquish any probes and reservations for devices that no longer exist
+    for n, probe in probes.items():
+        if probe['device'] and (not probe['device'] in devices or probe['device'] in removed):
+            probe['device'] = False
+    for device in list(reserved):
+        if not device in devices or device in removed:
+            del reserved[device]
     return True
 
+# devices reserved by parallel probes or in use
+reserved = {}
+def reserve(name, device):
+    reserved[device] = name
+
+def release(device):
+    if device in reserved:
+        del reserved[device]
+
+# devices likely to be a motor controller are left to the servo probe
+# until it has tried them, or for this many seconds after they appear
+servo_turn_time = 30
+servo_vendors = ['2341', '2a03'] # arduino usb vendor ids
+
+def servo_first(device, t0):
+    if 'servo' in devices[device].get('probed', []) or t0 - devices[device]['time'] > servo_turn_time:
+        return False
+    if device.startswith('/dev/ttyACM'):
+        return True
+    identity = devices[device]['identity']
+    if identity and identity.split(':')[0] in servo_vendors:
+        return True
+    return 'servo' in probes and probes['servo']['lastworking'] and \
+        probes['servo']['lastworking'][0] == device
+
+# devices free to be probed in parallel by name, each with the bauds
+# ordered so the cached or last working baud of the device is tried first
+def candidates(name, bauds):
+    enumerate_devices()
+    t0 = time.monotonic()
+    unavailable = gpsdevices + list(map(os.path.realpath, reserved))
+    for probe in probes.values():
+        if probe['device']:
+            unavailable.append(devices[probe['device']]['realpath'])
+
+    lastworking = {}
+    for probe_name, probe in probes.items():
+        if probe['lastworking']:
+            last_device, last_baud = probe['lastworking']
+            lastworking[last_device] = probe_name, last_baud
+
+    ret = []
+    for device in devices:
+        if device == '/dev/ttyAMA0' and name != 'servo':
+            continue # only let servo have AMA0
+        if devices[device]['realpath'] in unavailable:
+            continue
+        if name != 'servo' and not devices[device]['cached'] and servo_first(device, t0):
+            continue
+        device_bauds = bauds
+        cached = devices[device]['cached']
+        if cached:
+            if cached['protocol'] != probe_protocol(name):
+                continue # known to be used by another probe
+            if cached['baud'] in bauds:
+                device_bauds = [cached['baud']] + [baud for baud in bauds if baud != cached['baud']]
+        elif device in lastworking:
+            probe_name, last_baud = lastworking[device]
+            if probe_name.startswith(name):
+                if last_baud in bauds:
+                    device_bauds = [last_baud] + [baud for baud in bauds if baud != last_baud]
+            elif t0 - devices[device]['time'] < 10:
+                continue # give the other probe a chance at its last working device
+        ret.append((device, device_bauds))
+    return ret
+
 # called to find a new serial device and baud to try to use
 def relinquish(name):
     if name in probes:
+        device = probes[name]['device']
+        if device in devices:
+            devices[device].pop('claimed', None) # claim again from the cache
         probes[name]['device'] = False
 
 
@@ -239,17 +406,27 @@ def probe(name, bauds, timeout=5):
     
     t0 = time.monotonic()
 
-    if enumerate_devices():
-        # relinquish any probes that are assigned to devices that no longer exist
-        for n, probe in probes.items():
-            device = probe['device']
-            if device and not device in devices:
-                probe['device'] = False
+    enumerate_devices()
     
     if not name in probes:
         new_probe(name)
     probe = probes[name]
 
+    # claim a device known from the probe cache as soon as it appears,
+    # if the claim fails (not answering yet) retry it after the timeout
+    if not probe['device']:
+        for device in devices:
+            cached = devices[device]['cached']
+            claimed = devices[device].get('claimed')
+            if cached and cached['name'] == name and (claimed is None or t0 - claimed >= timeout) and \
+               not device in reserved and cached['baud'] in bauds:
+                devices[device]['claimed'] = t0
+                devices[device].setdefault('probed', []).append(name)
+                probe['device'] = device
+                probe['bauds'] = [cached['baud']]
+                debug('serialprobe claim cached', name, device, cached)
+                return device, cached['baud']
+
     # current device probed, try next baud rate
     if probe['device']:
         probe['bauds'] = probe['bauds'][1:]
@@ -331,12 +508,27 @@ def probe(name, bauds, timeout=5):
         debug('serial probe abort', name, 'reserved for servo')
         return False # only let servo have AMA0
 
+    if name != 'servo' and not devices[device]['cached'] and servo_first(device, t0):
+        debug('serial probe abort', name, 'device', device, 'waiting for servo probe')
+        return False
+
     if devices[device]['realpath'] in gpsdevices:
         debug('serial probe abort', name, 'device', device, 'is a gps device')
         return False
+
+    if device in reserved:
+        debug('serial probe abort', name, 'device', device, 'reserved by', reserved[device])
+        return False
+
+    cached = devices[device]['cached']
+    if cached and cached['protocol'] != probe_protocol(name):
+        debug('serial probe abort', name, 'device', device, 'is known as', cached['name'])
+        return False
     
     probe['device'] = device
     probe['bauds'] = bauds
+    if not name in devices[device].setdefault('probed', []):
+        devices[device]['probed'].append(name)
     
     debug('serial probing', name, device, bauds[0])
     return device, bauds[0]
@@ -354,6 +546,8 @@ def success(name, device):
     global probes
     filename = pypilot_dir + name + 'device'
     print('serialprobe success:', filename, device)
+    if not name in probes:
+        new_probe(name)
     probes[name]['lastworking'] = device
     try:
         file = open(filename, 'w')
@@ -363,6 +557,28 @@ def success(name, device):
     except:
         print('serialprobe failed to record device', name)
 
+    # cache the result by usb identity
+    path, baud = device
+    if path in devices:
+        identity = devices[path]['identity']
+    else:
+        identity = virtual_devices[path] if path in virtual_devices else usb_identity(path)
+    if not identity:
+        return
+    cache = read_probe_cache()
+    entry = {'name': name, 'baud': baud, 'protocol': probe_protocol(name)}
+    if cache.get(identity) == entry:
+        return
+    cache[identity] = entry
+    if path in devices:
+        devices[path]['cached'] = entry
+    try:
+        f = open(pypilot_dir + probe_cache_file, 'w')
+        f.write(pyjson.dumps(cache) + '\n')
+        f.close()
+    except Exception as e:
+        print('serialprobe failed to write probe cache', e)
+
 if __name__ == '__main__':
     print('testing serial probe')
     while True:
@@ -562,11 +562,16 @@ class Servo(object):
                 self.device = device
                 self.device.path = device_path[0]
                 self.lastpolltime = time.monotonic()
+                # reads do not fail when a usb device is unplugged
+                self.hangup = select.poll()
+                self.hangup.register(device.fileno(), select.POLLHUP | select.POLLERR)
 
         if not self.driver:
             return
 
         result = self.driver.poll()
+        if self.hangup.poll(0):
+            result = -1
         if result == -1:
             print('servo lost')
             self.close_driver()
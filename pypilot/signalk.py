@@ -7,11 +7,12 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import time, socket, multiprocessing, os
+import time, socket, multiprocessing, os, sys, select
 from nonblockingpipe import NonBlockingPipe
+from nonblockingwebsocket import NonBlockingHTTPRequest, NonBlockingWebSocket
 import pyjson
 from client import pypilotClient
-from values import Property, RangeProperty
+from values import Property, RangeProperty, SensorValue
 from sensors import source_priority
 
 signalk_priority = source_priority['signalk']
@@ -29,6 +30,32 @@ signalk_table = {'wind': {('environment.wind.speedApparent', meters_s): 'speed',
                  'imu': {('navigation.headingMagnetic', radians): 'heading_lowpass',
                          ('navigation.attitude', radians): {'pitch': 'pitch', 'roll': 'roll', 'yaw': 'heading_lowpass'}}}
 
+# signalk path: (sensor, converter) where the converter fills in the
+# pypilot fields of a sensor from the signalk value
+def compile_signalk_path(pypilot_path, conversion):
+    if type(pypilot_path) == type({}): # single path translates to multiple pypilot
+        keys = list(pypilot_path.items())
+        def convert(value, data):
+            for signalk_key, pypilot_key in keys:
+                data[pypilot_key] = value[signalk_key] / conversion
+    else:
+        def convert(value, data):
+            data[pypilot_path] = value / conversion
+    return convert
+
+signalk_index = {}
+signalk_converters = {} # sensor: [(signalk path, converter)]
+signalk_required = {} # paths needed before a sensor is written, those with conversion of 1 are optional
+for sensor in signalk_table:
+    signalk_converters[sensor] = []
+    signalk_required[sensor] = []
+    for (signalk_path, conversion), pypilot_path in signalk_table[sensor].items():
+        convert = compile_signalk_path(pypilot_path, conversion)
+        signalk_index[signalk_path] = sensor, convert
+        signalk_converters[sensor].append((signalk_path, convert))
+        if conversion != 1:
+            signalk_required[sensor].append(signalk_path)
+
 token_path = os.getenv('HOME') + '/.pypilot/signalk-token'
 
 def debug(*args):
@@ -69,16 +96,6 @@ class signalk(object):
             print('signalk failed to read token', token_path)
             self.token = False
 
-        try:
-            from zeroconf import ServiceBrowser, ServiceStateChange, Zeroconf
-        except Exception as e:
-            if not self.missingzeroconfwarned:
-                print('signalk: failed to import zeroconf, autodetection not possible')
-                print('try pip3 install zeroconf or apt install python3-zeroconf')
-                self.missingzeroconfwarned = True
-            time.sleep(20)
-            return
-            
         self.last_values = {}
         self.last_sources = {}
         self.signalk_last_msg_time = {}
@@ -94,11 +111,31 @@ class signalk(object):
 
         self.period = self.client.register(RangeProperty('signalk.period', .5, .1, 2, persistent=True))
         self.uid = self.client.register(Property('signalk.uid', 'pypilot', persistent=True))
+        # host:port of the signalk server, otherwise found with zeroconf
+        self.host = self.client.register(Property('signalk.host', '', persistent=True))
+        self.delta_rate = self.client.register(SensorValue('signalk.delta_rate', 0, fmt='%.1f'))
+        self.delta_time = self.client.register(SensorValue('signalk.delta_time', 0, fmt='%.6f'))
+        self.deltas = 0
+        self.deltas_time = 0
+        self.last_stats_time = time.monotonic()
 
         self.signalk_host_port = False
+        self.zeroconf_host_port = False
         self.signalk_ws_url = False
         self.ws = False
-        
+        self.http = False # request in progress, and the function to handle it
+        self.retry_time = 0
+        self.initialized = True
+
+        try:
+            from zeroconf import ServiceBrowser, ServiceStateChange, Zeroconf
+        except Exception as e:
+            if not self.missingzeroconfwarned:
+                print('signalk: failed to import zeroconf, autodetection not possible')
+                print('try pip3 install zeroconf or apt install python3-zeroconf')
+                self.missingzeroconfwarned = True
+            return
+
         class Listener:
             def __init__(self, signalk):
                 self.signalk = signalk
@@ -107,8 +144,7 @@ class signalk(object):
             def remove_service(self, zeroconf, type, name):
                 print('signalk zeroconf service removed', name, type)
                 if self.name_type == (name, type):
-                    self.signalk.signalk_host_port = False
-                    self.signalk.disconnect_signalk()
+                    self.signalk.zeroconf_host_port = False
                     print('signalk server lost')
 
             def add_service(self, zeroconf, type, name):
@@ -125,113 +161,129 @@ class signalk(object):
                         host_port = socket.inet_ntoa(info.addresses[0]) + ':' + str(info.port)
                     except Exception as e:
                         host_port = socket.inet_ntoa(info.address) + ':' + str(info.port)
-                    self.signalk.signalk_host_port = host_port
+                    self.signalk.zeroconf_host_port = host_port
                     print('signalk server found', host_port)
 
         zeroconf = Zeroconf()
         listener = Listener(self)
         browser = ServiceBrowser(zeroconf, "_http._tcp.local.", listener)
         #zeroconf.close()
-        self.initialized = True
+
+    # make a request in the background, handler is called with the result
+    def request(self, handler, url, method='GET', body=False):
+        self.http = NonBlockingHTTPRequest(url, method, body), handler
+
+    def request_json(self, request):
+        if request.state == 'failed':
+            raise Exception(request.error)
+        return pyjson.loads(request.response)
+
+    def retry(self, seconds):
+        self.retry_time = time.monotonic() + seconds
 
     def probe_signalk(self):
         print('signalk probe...', self.signalk_host_port)
-        try:
-            import requests
-        except Exception as e:
-            print('signalk could not import requests', e)
-            print("try 'sudo apt install python3-requests' or 'pip3 install requests'")
-            time.sleep(50)
-            return
+        self.request(self.probe_signalk_response, 'http://' + self.signalk_host_port + '/signalk')
 
+    def probe_signalk_response(self, request):
         try:
-            r = requests.get('http://' + self.signalk_host_port + '/signalk')
-            contents = pyjson.loads(r.content)
+            contents = self.request_json(request)
             self.signalk_ws_url = contents['endpoints']['v1']['signalk-ws'] + '?subscribe=none'
         except Exception as e:
             print('failed to retrieve/parse data from', self.signalk_host_port, e)
-            time.sleep(5)
+            self.retry(5)
             return
         print('signalk found', self.signalk_ws_url)
 
     def request_access(self):
-        import requests
         if self.signalk_access_url:
             dt = time.monotonic() - self.last_access_request_time            
             if dt < 10:
                 return
             self.last_access_request_time = time.monotonic()
-            try:
-                r = requests.get(self.signalk_access_url)
-                contents = pyjson.loads(r.content)
-                print('signalk see if token is ready', self.signalk_access_url, contents)
-                if contents['state'] == 'COMPLETED':
-                    if 'accessRequest' in contents:
-                        access = contents['accessRequest']
-                        if access['permission'] == 'APPROVED':
-                            self.token = access['token']
-                            print('signalk received token', self.token)
-                            try:
-                                f = open(token_path, 'w')
-                                f.write(self.token)
-                                f.close()
-                            except Exception as e:
-                                print('signalk failed to store token', token_path)
-                    else:
-                        self.signalk_access_url = False
-            except Exception as e:
-                print('signalk error requesting access', e)
-                self.signalk_access_url = False
+            self.request(self.access_response, self.signalk_access_url)
             return
 
-        try:
-            def random_number_string(n):
-                if n == 0:
-                    return ''
-                import random
-                return str(int(random.random()*10)) + random_number_string(n-1)
-            
-            if self.uid.value == 'pypilot':
-                self.uid.set('pypilot-' + random_number_string(11))
-            r = requests.post('http://' + self.signalk_host_port + '/signalk/v1/access/requests', data={"clientId":self.uid.value, "description": "pypilot"})
+        def random_number_string(n):
+            if n == 0:
+                return ''
+            import random
+            return str(int(random.random()*10)) + random_number_string(n-1)
             
-            contents = pyjson.loads(r.content)
+        if self.uid.value == 'pypilot':
+            self.uid.set('pypilot-' + random_number_string(11))
+        self.request(self.access_request_response, 'http://' + self.signalk_host_port + '/signalk/v1/access/requests',
+                     'POST', pyjson.dumps({"clientId":self.uid.value, "description": "pypilot"}))
+
+    def access_request_response(self, request):
+        try:
+            contents = self.request_json(request)
             print('signalk post', contents)
             if contents['statusCode'] == 202 or contents['statusCode'] == 400:
                 self.signalk_access_url = 'http://' + self.signalk_host_port + contents['href']
+                self.last_access_request_time = time.monotonic()
                 print('signalk request access url', self.signalk_access_url)
         except Exception as e:
             print('signalk error requesting access', e)
             self.signalk_ws_url = False
-        
-    def connect_signalk(self):
+            self.retry(5)
+
+    def access_response(self, request):
         try:
-            from websocket import create_connection
+            contents = self.request_json(request)
+            print('signalk see if token is ready', self.signalk_access_url, contents)
+            if contents['state'] == 'COMPLETED':
+                if 'accessRequest' in contents:
+                    access = contents['accessRequest']
+                    if access['permission'] == 'APPROVED':
+                        self.token = access['token']
+                        print('signalk received token', self.token)
+                        try:
+                            f = open(token_path, 'w')
+                            f.write(self.token)
+                            f.close()
+                        except Exception as e:
+                            print('signalk failed to store token', token_path)
+                else:
+                    self.signalk_access_url = False
         except Exception as e:
-            print('signalk cannot create connection:', e)
-            print('try pip3 install websocket-client or apt install python3-websocket')
-            self.signalk_host_port = False
-            return
+            print('signalk error requesting access', e)
+            self.signalk_access_url = False
 
+    def connect_signalk(self):
         self.subscribed = {}
         for sensor in list(signalk_table):
             self.subscribed[sensor] = False
         self.subscriptions = [] # track signalk subscriptions
         self.signalk_values = {}
-        try:
-            self.ws = create_connection(self.signalk_ws_url, header={'Authorization': 'JWT ' + self.token})
-            self.ws.settimeout(0) # nonblocking
-        except Exception as e:
-            print('signak failed to connect', e)
-            self.token = False
+        self.pending = {} # sensor: {source: True} with new values
+        self.ws = NonBlockingWebSocket(self.signalk_ws_url, {'Authorization': 'JWT ' + self.token})
+
+    def connected_signalk(self):
+        print('signalk connected to', self.signalk_ws_url)
+        # setup pypilot watches
+        watches = ['imu.heading_lowpass', 'imu.roll', 'imu.pitch', 'timestamp']
+        for watch in watches:
+            self.client.watch(watch, self.period.value)
+        for sensor in signalk_table:
+            self.client.watch(sensor+'.source')
+
+    # wait for data from pypilot or signalk
+    def wait(self, timeout):
+        poller = select.poll()
+        for connection in [self.client.connection, self.initialized and self.ws,
+                           self.initialized and self.http and self.http[0]]:
+            if connection and connection.fileno():
+                poller.register(connection.fileno(), select.POLLIN)
+        poller.poll(timeout*1000)
 
     def process(self):
         time.sleep(6) # let other stuff load
         print('signalk process', os.getpid())
         self.process = False
         while True:
-            time.sleep(.1)
-            self.poll(1)
+            self.poll()
+            self.wait(.1)
 
     def poll(self, timeout=0):
         if self.process:
@@ -242,37 +294,59 @@ class signalk(object):
                 msg = self.sensors_pipe_out.recv()
             return
 
-        t0 = time.monotonic()
         if not self.initialized:
             self.setup()
             return
 
         self.client.poll(timeout)
+        self.update_stats(time.monotonic())
+        host_port = self.host.value or self.zeroconf_host_port
+        if host_port != self.signalk_host_port:
+            if self.signalk_host_port:
+                print('signalk server changed', self.signalk_host_port, '->', host_port)
+            self.disconnect_signalk()
+            self.signalk_host_port = host_port
+            self.signalk_ws_url = False
+            self.signalk_access_url = False
+            self.http = False
+            self.retry_time = 0
         if not self.signalk_host_port:
             return # waiting for signalk to detect
 
-        t1 = time.monotonic()
+        if self.http:
+            request, handler = self.http
+            request.poll()
+            if request.done():
+                self.http = False
+                handler(request)
+            return
+
+        t0 = time.monotonic()
+        if t0 < self.retry_time:
+            return
+
         if not self.signalk_ws_url:
             self.probe_signalk()
             return
 
-        t2 = time.monotonic()
         if not self.token:
             self.request_access()
             return
-        t3 = time.monotonic()
 
         if not self.ws:
             self.connect_signalk()
-            if not self.ws:
-                return
-            print('signalk connected to', self.signalk_ws_url)
-            # setup pypilot watches
-            watches = ['imu.heading_lowpass', 'imu.roll', 'imu.pitch', 'timestamp']
-            for watch in watches:
-                self.client.watch(watch, self.period.value)
-            for sensor in signalk_table:
-                self.client.watch(sensor+'.source')
+            return
+
+        if self.ws.state != 'open':
+            self.ws.poll()
+            if self.ws.state == 'failed':
+                print('signalk failed to connect', self.ws.error)
+                if self.ws.status in [401, 403]:
+                    self.token = False # request access again
+                self.disconnect_signalk()
+                self.retry(5)
+            elif self.ws.state == 'open':
+                self.connected_signalk()
             return
 
         # at this point we have a connection
@@ -297,39 +371,51 @@ class signalk(object):
             else:
                 self.last_values[name] = value
 
-        t4 = time.monotonic()
-
-        while True:
-            try:
-                msg = self.ws.recv()
-                debug('signalk received', msg)
-            except:
-                break
+        t1 = time.monotonic()
+        messages = self.ws.receive_messages()
+        for msg in messages:
+            debug('signalk received', msg)
             self.receive_signalk(msg)
+        self.convert_signalk()
+        t2 = time.monotonic()
 
-        t5 = time.monotonic()
-        # convert received signalk values into sensor inputs if possible
-        for sensor, sensor_table in signalk_table.items():
-            for source, values in self.signalk_values.items():
-                data = {}
-                for signalk_path_conversion, pypilot_path in sensor_table.items():
-                    signalk_path, signalk_conversion = signalk_path_conversion
-                    if signalk_path in values:
-                        try:
-                            value = values[signalk_path]
-                            if type(pypilot_path) == type({}): # single path translates to multiple pypilot
-                                for signalk_key, pypilot_key in pypilot_path.items():
-                                    data[pypilot_key] = value[signalk_key] / signalk_conversion
-                            else:
-                                data[pypilot_path] = value / signalk_conversion
-                        except Exception as e:
-                            print('Exception converting signalk->pypilot', e, self.signalk_values)
-                            break
-                    elif signalk_conversion != 1: # don't require fields with conversion of 1
+        if messages:
+            self.deltas += len(messages)
+            self.deltas_time += t2 - t1
+
+        if self.ws.state == 'failed':
+            print('signalk lost connection', self.ws.error)
+            self.disconnect_signalk()
+            self.retry(1)
+
+    # delta rate and processing time per delta updated once a second
+    def update_stats(self, t):
+        dt = t - self.last_stats_time
+        if dt < 1:
+            return
+        self.delta_rate.set(self.deltas / dt)
+        self.delta_time.set(self.deltas_time / self.deltas if self.deltas else 0)
+        self.deltas = self.deltas_time = 0
+        self.last_stats_time = t
+
+    # convert received signalk values into sensor inputs if possible
+    def convert_signalk(self):
+        for sensor, sources in self.pending.items():
+            for source in sources:
+                values = self.signalk_values[source]
+                for signalk_path in signalk_required[sensor]:
+                    if not signalk_path in values:
                         break  # missing fields?  skip input this iteration
                 else:
-                    for signalk_path_conversion in sensor_table:
-                        signalk_path, signalk_conversion = signalk_path_conversion
+                    data = {}
+                    try:
+                        for signalk_path, convert in signalk_converters[sensor]:
+                            if signalk_path in values:
+                                convert(values[signalk_path], data)
+                    except Exception as e:
+                        print('Exception converting signalk->pypilot', e, self.signalk_values)
+                        continue
+                    for signalk_path, convert in signalk_converters[sensor]:
                         if signalk_path in values:
                             del values[signalk_path]
                     # all needed sensor data is found 
@@ -339,7 +425,7 @@ class signalk(object):
                     else:
                         print('signalk received', sensor, data)
                     break
-        #print('sigktimes', t1-t0, t2-t1, t3-t2, t4-t3, t5-t4)
+        self.pending = {}
 
     def send_signalk(self):
         # see if we can produce any signalk output from the data we have read
@@ -399,29 +485,33 @@ class signalk(object):
             print('signalk failed to parse msg:', msg)
             return
         
-        if 'updates' in data:
-            updates = data['updates']
-            for update in updates:
-                source = 'unknown'
-                if 'source' in update:
-                    source = update['source']['talker']
-                elif '$source' in update:
-                    source = update['$source']
-                if 'timestamp' in update:
-                    timestamp = update['timestamp']
-                if not source in self.signalk_values:
-                    self.signalk_values[source] = {}
-                for value in update['values']:
-                    path = value['path']
-                    if path in self.signalk_last_msg_time:
-                        if self.signalk_last_msg_time[path] == timestamp:
-                            debug('signalk skip duplicate timestamp', source, path, timestamp)
-                            continue
-                        self.signalk_values[source][path] = value['value']
-                    else:
+        if not 'updates' in data:
+            return
+        last_msg_time = self.signalk_last_msg_time
+        for update in data['updates']:
+            source = 'unknown'
+            if 'source' in update and 'talker' in update['source']:
+                source = update['source']['talker']
+            elif '$source' in update:
+                source = update['$source']
+            timestamp = update.get('timestamp')
+            values = False
+            for value in update['values']:
+                path = value['path']
+                if not path in last_msg_time:
+                    if path in signalk_index: # first message since subscribing
                         debug('signalk skip initial message', source, path, timestamp)
-                    self.signalk_last_msg_time[path] = timestamp
-                    
+                        last_msg_time[path] = timestamp
+                    continue # not a path pypilot uses
+                if last_msg_time[path] == timestamp:
+                    debug('signalk skip duplicate timestamp', source, path, timestamp)
+                    continue
+                last_msg_time[path] = timestamp
+                if not values:
+                    values = self.signalk_values.setdefault(source, {})
+                values[path] = value['value']
+                self.pending.setdefault(signalk_index[path][0], {})[source] = True
+
     def update_sensor_source(self, sensor, source):
         priority = source_priority[source]
         watch = priority < signalk_priority # translate from pypilot -> signalk
@@ -481,10 +571,61 @@ class signalk(object):
         debug('signalk subscribe', subscription)
         self.ws.send(pyjson.dumps(subscription)+'\n')
 
+# process synthetic deltas to measure the cost per delta
+def benchmark(count):
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from signalkserver import delta
+    class CountingPipe(object):
+        def __init__(self):
+            self.count = 0
+        def send(self, msg):
+            self.count += 1
+
+    sk = signalk.__new__(signalk) # no pypilot client or signalk server
+    sk.sensors_pipe = CountingPipe()
+    sk.pending = {}
+    sk.signalk_values = {}
+    sk.signalk_last_msg_time = {}
+    messages = []
+    for i in range(count):
+        msg = delta(i*.1, signalk_index)
+        # paths pypilot does not use are skipped
+        msg['updates'][0]['values'].append({'path': 'environment.depth.belowTransducer', 'value': 10})
+        messages.append(pyjson.dumps(msg))
+    for path in signalk_index:
+        sk.signalk_last_msg_time[path] = False # as if already subscribed
+
+    t0 = time.monotonic()
+    for msg in messages:
+        sk.receive_signalk(msg)
+        sk.convert_signalk()
+    t1 = time.monotonic()
+    print('processed', count, 'deltas in %.3f seconds, %.1f us per delta, %d sensor writes' %
+          (t1-t0, (t1-t0)*1e6/count, sk.sensors_pipe.count))
+
 def main():
+    import getopt
+    def usage():
+        print('usage: signalk.py [-b count]')
+        print('  -b  benchmark delta processing with count synthetic deltas')
+        exit(1)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'b:h')
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+
+    for opt, arg in opts:
+        if opt == '-b':
+            benchmark(int(arg))
+            return
+        usage()
+
     sk = signalk()
     while True:
-        sk.poll(1)
+        sk.poll()
+        sk.wait(.1)
             
 if __name__ == '__main__':
     main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# stand-in signalk server to test the signalk client without a real server
+#
+# serves the /signalk discovery document, approves access requests after
+# a delay, and streams simulated deltas of the subscribed paths over the
+# websocket.  Updates received from pypilot are counted.
+#
+# run it, then set signalk.host to localhost:3000 (no zeroconf needed)
+
+import os, sys, time, socket, select, math
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pyjson
+from nonblockingwebsocket import websocket_accept, websocket_frame, websocket_frames
+
+def simulated_values(t):
+    return {'environment.wind.speedApparent': 5 + math.sin(t/3),
+            'environment.wind.angleApparent': math.radians(30 + 10*math.sin(t)),
+            'navigation.courseOverGroundTrue': math.radians(84 + 3*math.sin(t/5)),
+            'navigation.speedOverGround': 3 + .2*math.sin(t/7),
+            'navigation.position': {'latitude': 48.1173, 'longitude': 11.5167},
+            'steering.rudderAngle': math.radians(5*math.sin(t/2)),
+            'navigation.headingMagnetic': math.radians(82 + 4*math.sin(t/4)),
+            'navigation.attitude': {'roll': math.radians(3*math.sin(t)), 'pitch': math.radians(1),
+                                    'yaw': math.radians(82)}}
+
+def timestamp(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + '.%03dZ' % (int(t*1000) % 1000)
+
+def delta(t, paths):
+    values = simulated_values(t)
+    return {'context': 'vessels.self',
+            'updates': [{'source': {'label': 'standin', 'type': 'NMEA0183', 'talker': 'II'},
+                         '$source': 'standin.II', 'timestamp': timestamp(t),
+                         'values': [{'path': path, 'value': values[path]} for path in paths if path in values]}]}
+
+class StandInConnection(object):
+    def __init__(self, connection, address):
+        connection.setblocking(0)
+        self.socket = connection
+        self.address = address
+        self.inbuf = b''
+        self.outbuf = b''
+        self.websocket = False
+        self.closing = False
+        self.subscriptions = set()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def write(self, data):
+        self.outbuf += data
+
+    def flush(self):
+        if not self.outbuf:
+            return
+        try:
+            count = self.socket.send(self.outbuf)
+            self.outbuf = self.outbuf[count:]
+        except BlockingIOError:
+            pass
+
+    def send(self, msg):
+        self.write(websocket_frame(1, pyjson.dumps(msg).encode(), False))
+
+class SignalKStandIn(object):
+    def __init__(self, port=3000, rate=10, approve_delay=1, verbose=False):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('0.0.0.0', port))
+        self.server.listen(5)
+        self.server.setblocking(0)
+        self.port = port
+        self.rate = rate
+        self.approve_delay = approve_delay
+        self.verbose = verbose
+        self.token = 'standin-token'
+        self.requests = {} # access request id: time requested
+        self.connections = []
+        self.last_delta = 0
+        self.stats = {'deltas': 0, 'updates': 0}
+        print('signalk stand-in server on port', port)
+
+    def response(self, connection, status, body):
+        reasons = {200: 'OK', 202: 'Accepted', 401: 'Unauthorized', 404: 'Not Found'}
+        body = pyjson.dumps(body).encode()
+        connection.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' %
+                          (status, reasons[status], len(body))).encode() + body)
+        connection.closing = True
+
+    def http_request(self, connection):
+        i = connection.inbuf.find(b'\r\n\r\n')
+        if i < 0:
+            return
+        lines = connection.inbuf[:i].decode().split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if len(connection.inbuf) < i + 4 + length:
+            return # wait for the body
+        connection.inbuf = connection.inbuf[i+4+length:]
+        method, path = lines[0].split()[:2]
+        host = headers.get('host', 'localhost:%d' % self.port)
+        if self.verbose:
+            print('signalk stand-in', method, path)
+
+        if path == '/signalk':
+            self.response(connection, 200, {'endpoints': {'v1': {'version': '1.0.0',
+                                                                 'signalk-http': 'http://%s/signalk/v1/api/' % host,
+                                                                 'signalk-ws': 'ws://%s/signalk/v1/stream' % host}},
+                                            'server': {'id': 'signalk-standin', 'version': '1.0.0'}})
+        elif path == '/signalk/v1/access/requests' and method == 'POST':
+            request_id = str(len(self.requests) + 1)
+            self.requests[request_id] = time.monotonic()
+            self.response(connection, 202, {'state': 'PENDING', 'requestId': request_id, 'statusCode': 202,
+                                            'href': '/signalk/v1/requests/' + request_id})
+        elif path.startswith('/signalk/v1/requests/') and path[21:] in self.requests:
+            if time.monotonic() - self.requests[path[21:]] < self.approve_delay:
+                self.response(connection, 200, {'state': 'PENDING', 'statusCode': 202})
+            else:
+                self.response(connection, 200, {'state': 'COMPLETED', 'statusCode': 200,
+                                                'accessRequest': {'permission': 'APPROVED', 'token': self.token}})
+        elif path.startswith('/signalk/v1/stream') and headers.get('upgrade', '').lower() == 'websocket':
+            if headers.get('authorization') != 'JWT ' + self.token:
+                self.response(connection, 401, {'message': 'unauthorized'})
+                return
+            connection.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n' %
+                              websocket_accept(headers['sec-websocket-key'])).encode())
+            connection.websocket = True
+            connection.send({'name': 'signalk-standin', 'version': '1.0.0', 'timestamp': timestamp(time.time()),
+                             'self': 'vessels.urn:mrn:signalk:uuid:standin', 'roles': ['master', 'main']})
+            print('signalk stand-in websocket from', connection.address)
+        else:
+            self.response(connection, 404, {'message': 'not found'})
+
+    def websocket_message(self, connection, msg):
+        if 'unsubscribe' in msg:
+            connection.subscriptions = set()
+        if 'subscribe' in msg:
+            for subscription in msg['subscribe']:
+                connection.subscriptions.add(subscription['path'])
+        if 'updates' in msg:
+            self.stats['updates'] += 1
+        if self.verbose:
+            print('signalk stand-in received', msg)
+
+    def receive(self, connection):
+        try:
+            data = connection.socket.recv(65536)
+        except BlockingIOError:
+            return True
+        except Exception:
+            return False
+        if not data:
+            return False
+        connection.inbuf += data
+        if not connection.websocket:
+            self.http_request(connection)
+            return True
+
+        frames, connection.inbuf = websocket_frames(connection.inbuf)
+        for fin, opcode, payload in frames:
+            if opcode == 8:
+                return False
+            if opcode == 9:
+                connection.write(websocket_frame(10, payload, False))
+            elif opcode == 1:
+                for line in payload.decode().split('\n'):
+                    if line.strip():
+                        self.websocket_message(connection, pyjson.loads(line))
+        return True
+
+    def close(self, connection):
+        connection.socket.close()
+        self.connections.remove(connection)
+
+    def poll(self, timeout):
+        poller = select.poll()
+        poller.register(self.server, select.POLLIN)
+        fds = {}
+        for connection in self.connections:
+            poller.register(connection.socket, select.POLLIN)
+            fds[connection.fileno()] = connection
+
+        for fd, flag in poller.poll(timeout*1000):
+            if fd == self.server.fileno():
+                connection, address = self.server.accept()
+                self.connections.append(StandInConnection(connection, address))
+            elif not self.receive(fds[fd]):
+                self.close(fds[fd])
+
+        # deltas at rate, or as fast as the client reads them with rate 0
+        t = time.time()
+        send = not self.rate or t - self.last_delta >= 1 / self.rate
+        if send:
+            self.last_delta = t
+        for connection in list(self.connections):
+            if send and connection.websocket and connection.subscriptions and \
+               (self.rate or len(connection.outbuf) < 65536):
+                connection.send(delta(t, connection.subscriptions))
+                self.stats['deltas'] += 1
+            connection.flush()
+            if connection.closing and not connection.outbuf:
+                self.close(connection)
+
+def main():
+    import getopt
+    def usage():
+        print('usage: signalkserver.py [-p port] [-r rate] [-d approve delay] [-v]')
+        print('  -r  deltas per second, 0 for as fast as possible, default 10')
+        exit(1)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'p:r:d:vh')
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+
+    port, rate, approve_delay, verbose = 3000, 10, 1, False
+    for opt, arg in opts:
+        if opt == '-p':
+            port = int(arg)
+        elif opt == '-r':
+            rate = float(arg)
+        elif opt == '-d':
+            approve_delay = float(arg)
+        elif opt == '-v':
+            verbose = True
+        else:
+            usage()
+
+    server = SignalKStandIn(port, rate, approve_delay, verbose)
+    t0 = time.monotonic()
+    while True:
+        server.poll(.01 if server.rate else 0)
+        t = time.monotonic()
+        if t - t0 > 5:
+            print('signalk stand-in sent %.1f deltas/s, received %.1f updates/s' %
+                  (server.stats['deltas']/(t-t0), server.stats['updates']/(t-t0)))
+            server.stats = {'deltas': 0, 'updates': 0}
+            t0 = t
+
+if __name__ == '__main__':
+    main()
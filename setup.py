@@ -26,6 +26,12 @@ arduino_servo_module = Extension('pypilot/arduino_servo/_arduino_servo',
                         swig_opts=['-c++']
 )
 
+imu_math_module = Extension('pypilot/imu_math/_imu_math',
+                        sources=['pypilot/imu_math/imu_math.cpp', 'pypilot/imu_math/imu_math.i'],
+                        extra_compile_args=['-Wno-unused-result'],
+                        swig_opts=['-c++']
+)
+
 ugfx_defs = ['-DWIRINGPI']
 try:
     import RPi.GPIO
@@ -58,7 +64,7 @@ for walk in os.walk('hat/locale'):
 
 from pypilot import version
 
-packages = ['pypilot', 'pypilot/pilots', 'pypilot/arduino_servo', 'ui', 'hat', 'web', 'pypilot/linebuffer', 'hat/ugfx']
+packages = ['pypilot', 'pypilot/pilots', 'pypilot/arduino_servo', 'ui', 'hat', 'web', 'pypilot/linebuffer', 'pypilot/imu_math', 'hat/ugfx']
 try:
     from setuptools import find_packages
     packages = find_packages()
@@ -81,7 +87,7 @@ setup (name = 'pypilot',
        url='http://pypilot.org/',
        packages=packages,
        package_dir=package_dirs,
-       ext_modules = [arduino_servo_module, linebuffer_module, ugfx_module],
+       ext_modules = [arduino_servo_module, linebuffer_module, imu_math_module, ugfx_module],
        package_data={'pypilot.hat': ['font.ttf', 'static/*', 'templates/*'] + locale_files,
                      'pypilot.ui': ['*.png', '*.mtl', '*.obj'],
                      'pypilot.web': ['static/*', 'templates/*']},
@@ -89,6 +95,7 @@ setup (name = 'pypilot',
            'console_scripts': [
                'pypilot=pypilot.autopilot:main',
                'pypilot_boatimu=pypilot.boatimu:main',
+               'pypilot_calibrate_offline=pypilot.calibrate_offline:main',
                'pypilot_servo=pypilot.servo:main',
                'pypilot_web=pypilot.web.web:main',
                'pypilot_hat=pypilot.hat.hat:main',